@@ -0,0 +1,211 @@
+import argparse
+import json
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import reprovision_quota
+
+
+def main():
+    """
+    Benchmark harness for reprovision_quota.py.
+    Generates a synthetic customer file, times each stage of the script against it, and prints the results as JSON so that releases can be compared.
+    """
+
+    args = parseArguments()
+    results = {"parameters": vars(args), "stages": {}}
+    results["startup"] = measureStartup(args.startup_runs)
+    output_file = os.path.abspath(args.output) if args.output else None
+    original_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        # The script keeps its snapshot, cache and target list in the working directory.
+        os.chdir(work_dir)
+        customer_file = os.path.join(work_dir, "customers.xml")
+        NPVR_bundle_data = generateCustomerFile(customer_file, args.customers, args.subscriptions, args.mismatch_rate, args.bundles, args.seed)
+        results["file_size_bytes"] = os.path.getsize(customer_file)
+        bundle_index = reprovision_quota.buildBundleIndex(NPVR_bundle_data)
+
+        stages = results["stages"]
+        customers = reprovision_quota.CustomerStore()
+        stages["parse"] = timeStage(lambda: customers.extend(reprovision_quota.loadCustomerStore(customer_file, args.workers)), args.customers)
+        stages["find_mismatches"] = timeStage(lambda: reprovision_quota.findMismatches(customers, bundle_index, False, args.engine), args.customers)
+        mismatchCount = len(reprovision_quota.reprovision_targets)
+        results["mismatches"] = mismatchCount
+        stages["write_target_list"] = timeStage(reprovision_quota.writeManualTargetList, mismatchCount)
+        reprovision_quota.reprovision_targets.clear()
+        stages["read_target_list"] = timeStage(readTargetList, mismatchCount)
+        stages["resolve_targets"] = timeStage(lambda: reprovision_quota.resolveManualTargets(customers, bundle_index), args.customers)
+        stages["reprovision"] = timeStage(lambda: reprovisionAgainstMockProdis(args.prodis_latency), mismatchCount)
+        os.chdir(original_dir)
+    results["peak_rss_kb"] = getPeakRSS()
+
+    output = json.dumps(results, indent=2)
+    if output_file:
+        with open(output_file, 'w') as results_file:
+            results_file.write(output + "\n")
+    print(output)
+
+
+def parseArguments():
+    """
+    Parses sys.args for the size and shape of the synthetic customer file.
+
+    Returns:
+        args | An argparse.Namespace holding the benchmark parameters.
+    """
+
+    parser = argparse.ArgumentParser(description="Benchmarks reprovision_quota.py against a synthetic customer file.")
+    parser.add_argument('--customers', type=int, default=100000, help="Number of customers in the generated file.")
+    parser.add_argument('--subscriptions', type=int, default=5, help="Number of subscription products per customer.")
+    parser.add_argument('--mismatch-rate', type=float, default=0.01, help="Fraction of customers generated with the wrong NPVRQuota.")
+    parser.add_argument('--bundles', type=int, default=500, help="Number of rows in the generated bundle table.")
+    parser.add_argument('--workers', type=int, default=1, help="Number of processes used to read the customer file.")
+    parser.add_argument('--engine', choices=['python', 'numpy'], default='python', help="Mismatch search to benchmark.")
+    parser.add_argument('--prodis-latency', type=float, default=0.0, help="Seconds the mocked Prodis takes to answer each request.")
+    parser.add_argument('--startup-runs', type=int, default=5, help="Number of fresh interpreters used to time importing the script.")
+    parser.add_argument('--seed', type=int, default=1, help="Seed for the random generator, so runs are repeatable.")
+    parser.add_argument('--output', help="File to write the JSON results to, in addition to printing them.")
+    return parser.parse_args()
+
+
+def generateCustomerFile(path, customer_count, subscriptions_per_customer, mismatch_rate, bundle_count, seed=1):
+    """
+    Writes a synthetic customer file in the same format as the nightly export.
+
+    Args:
+        path | String representing the path to write the customer file to.
+        customer_count | Integer number of customers to generate.
+        subscriptions_per_customer | Integer number of subscription products per customer.
+        mismatch_rate | Float between 0 and 1. The fraction of customers given the wrong NPVRQuota.
+        bundle_count | Integer number of bundles in the generated bundle table.
+        seed | Integer seed for the random generator.
+
+    Returns:
+        NPVR_bundle_data | A list of tuples reflecting the intended NPVR provisioning (in minutes) for each generated bundle.
+    """
+
+    rng = random.Random(seed)
+    bundle_ids = rng.sample(range(1, bundle_count * 10), bundle_count)
+    NPVR_bundle_data = [(bundle_id, rng.choice((0, 250, 500, 1000, 2000)) * 60) for bundle_id in bundle_ids]
+    bundle_index = reprovision_quota.buildBundleIndex(NPVR_bundle_data)
+    product_ids = bundle_ids + list(range(bundle_count * 10, bundle_count * 12))
+    with open(path, 'w', encoding='utf-8') as customer_file:
+        customer_file.write('<?xml version="1.0" encoding="utf-8"?>\n<Customers xmlns="urn:eventis:crm:2.0">\n')
+        for customer_id in range(100000, 100000 + customer_count):
+            subscriptions = [rng.choice(product_ids) for _ in range(subscriptions_per_customer)]
+            quota = max([bundle_index.get(subscription_id, 0) for subscription_id in subscriptions], default=0)
+            if rng.random() < mismatch_rate:
+                quota += 60
+            products = "".join(f'<SubscriptionProduct id="{subscription_id}" />' for subscription_id in subscriptions)
+            customer_file.write(f'  <Customer id="{customer_id}"><NPVRQuota>{quota}</NPVRQuota>'
+                                f'<CustomerData>PartnerSystemID:66;Zip:{customer_id % 9000 + 1000};PartnerId:25;Source:QMC;CustomerAT:Cable</CustomerData>'
+                                f'<SubscriptionProducts>{products}</SubscriptionProducts></Customer>\n')
+        customer_file.write('</Customers>\n')
+    return NPVR_bundle_data
+
+
+def measureStartup(runs):
+    """
+    Times how long a fresh interpreter takes to start and import reprovision_quota, as a cron run would, and which heavy
+    dependencies the import loads on its own.
+
+    Args:
+        runs | Integer number of fresh interpreters to start.
+
+    Returns:
+        result | A dict holding the median wall time of a whole interpreter run, the median time of the import alone, in seconds,
+                 and the heavy modules loaded by the import.
+    """
+
+    code = ("import json, sys, time\n"
+            "start = time.perf_counter()\n"
+            "import reprovision_quota\n"
+            "seconds = time.perf_counter() - start\n"
+            "heavy = ['mysql.connector', 'requests', 'urllib3', 'numpy', 'asyncio', 'multiprocessing', 'csv', 'xml.dom.minidom']\n"
+            "print(json.dumps({'import_seconds': seconds, 'heavy_modules_loaded': [name for name in heavy if name in sys.modules]}))\n")
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(reprovision_quota.__file__)), os.environ.get("PYTHONPATH")])))
+    process_seconds = []
+    import_seconds = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", code], env=env, check=True, capture_output=True, text=True).stdout
+        process_seconds.append(time.perf_counter() - start)
+        measurement = json.loads(output)
+        import_seconds.append(measurement["import_seconds"])
+    return {"process_seconds": round(statistics.median(process_seconds), 4),
+            "import_seconds": round(statistics.median(import_seconds), 4),
+            "heavy_modules_loaded": measurement["heavy_modules_loaded"]}
+
+
+def readTargetList():
+    """
+    Reads every shard of the target list back into the reprovision targets. A manual run reads them the same way, one shard at a time.
+    A list without rows, written when no mismatches were found, holds no targets.
+    """
+
+    target_list = reprovision_quota.scanTargetList(reprovision_quota.target_list_file)
+    if target_list is None:
+        return
+    for start, end in target_list.shards:
+        for customer_id, specifiedQuota, customer_data in reprovision_quota.readTargetShard(reprovision_quota.target_list_file, start, end):
+            reprovision_quota.reprovision_targets[customer_id] = specifiedQuota
+            reprovision_quota.target_customer_data[customer_id] = customer_data
+
+
+def reprovisionAgainstMockProdis(latency):
+    """
+    Runs the reprovision loop for the current reprovision targets, with Prodis replaced by an in-process mock.
+
+    Args:
+        latency | Float number of seconds each mocked request takes.
+    """
+
+    def respond(*args, **kwargs):
+        if latency:
+            time.sleep(latency)
+        return MagicMock(status_code=200, content=b'<Customer xmlns="urn:eventis:crm:2.0"><CustomerData>Zip:1000</CustomerData></Customer>')
+
+    session = MagicMock(get=MagicMock(side_effect=respond), put=MagicMock(side_effect=respond))
+    with patch.object(reprovision_quota, "getSession", return_value=session), \
+         patch.object(reprovision_quota, "max_requests_per_second", 0):
+        reprovision_quota.startReprovisionLoop()
+
+
+def timeStage(stage, item_count):
+    """
+    Runs one stage of the script and measures it.
+
+    Args:
+        stage | A callable running the stage.
+        item_count | Integer number of items (customers or targets) the stage processes, used to work out throughput.
+
+    Returns:
+        result | A dict holding the wall time in seconds, throughput in items per second and peak RSS in KB after the stage.
+    """
+
+    start = time.perf_counter()
+    stage()
+    seconds = time.perf_counter() - start
+    return {"seconds": round(seconds, 4),
+            "items": item_count,
+            "items_per_second": round(item_count / seconds, 1) if seconds else None,
+            "peak_rss_kb": getPeakRSS()}
+
+
+def getPeakRSS():
+    """Returns the peak resident set size of this process so far, in KB."""
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+if __name__ == '__main__':
+    main()
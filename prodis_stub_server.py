@@ -0,0 +1,236 @@
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import reprovision_quota
+
+
+def main():
+    """
+    Local stand-in for Prodis, for exercising reprovision_quota.py without touching the real service.
+    By default the stub is served until interrupted. With '--replay', the put requests recorded by a '--dry-run' of reprovision_quota.py
+    are fired through its reprovision loop against the stub instead, and the throughput, outcomes and latencies are printed as JSON.
+    """
+
+    args = parseArguments()
+    server = startStubServer(args.port, args.latency, args.error_rate, args.seed)
+    if args.replay is None:
+        print(f"Prodis stub listening on http://127.0.0.1:{server.server_address[1]}/customers", file=sys.stderr)
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.shutdown()
+        return
+    try:
+        results = replayPayloadJournal(server, args.replay, args.workers, args.rate, args.retry_backoff, args.skip_get)
+    finally:
+        server.shutdown()
+    results["parameters"] = vars(args)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as results_file:
+            results_file.write(output + "\n")
+    print(output)
+
+
+def parseArguments():
+    """
+    Parses sys.args for how the stub should behave and what it should replay.
+
+    Returns:
+        args | An argparse.Namespace holding the stub and replay parameters.
+    """
+
+    parser = argparse.ArgumentParser(description="Serves a local Prodis stub, or replays a dry run's put requests against it.")
+    parser.add_argument('--port', type=int, default=0, help="Port to listen on. Defaults to a free port.")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds the stub takes to answer each request.")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of requests answered with a 503, to exercise retries.")
+    parser.add_argument('--seed', type=int, default=1, help="Seed for the random generator deciding which requests fail, so runs are repeatable.")
+    parser.add_argument('--replay', help="Payload journal written by a '--dry-run' of reprovision_quota.py, to replay against the stub.")
+    parser.add_argument('--workers', type=int, default=reprovision_quota.max_workers, help="Worker threads used by the reprovision loop during a replay.")
+    parser.add_argument('--rate', type=float, default=reprovision_quota.max_requests_per_second,
+                        help="Requests per second allowed during a replay. 0 disables the rate limit.")
+    parser.add_argument('--retry-backoff', type=float, default=reprovision_quota.http_retry_backoff, help="Backoff factor for retries during a replay.")
+    parser.add_argument('--skip-get', action='store_true', help="Reprovision with the recorded CustomerData instead of fetching it from the stub first.")
+    parser.add_argument('--output', help="File to write the JSON results of a replay to, in addition to printing them.")
+    return parser.parse_args()
+
+
+class StubProdisHandler(BaseHTTPRequestHandler):
+    """
+    Answers get and put requests for any customer the way Prodis does, after the server's latency, failing a fraction of them with a 503.
+    Gets return the CustomerData the server holds for the customer, or a made-up one. Unknown customers are answered with a 404,
+    and puts for refused customers with a 500.
+    """
+
+    def do_GET(self):
+        customer_id = self.path.rsplit("/", 1)[-1]
+        if not self.server.respond(self, customer_id):
+            return
+        if customer_id in self.server.unknown_customers:
+            self.sendStatus(404)
+            return
+        customer_data = self.server.customer_data.get(customer_id, f"Zip:{customer_id}")
+        body = f'<Customer id="{customer_id}" xmlns="urn:eventis:crm:2.0"><CustomerData>{customer_data}</CustomerData></Customer>'.encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PUT(self):
+        customer_id = self.path.rsplit("/", 1)[-1]
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        if not self.server.respond(self, customer_id):
+            return
+        if customer_id in self.server.unknown_customers:
+            self.sendStatus(404)
+            return
+        if customer_id in self.server.refused_customers:
+            self.sendStatus(500)
+            return
+        with self.server.lock:
+            self.server.put_bodies[customer_id] = body
+        self.sendStatus(200)
+
+    def sendStatus(self, status_code):
+        """Sends an empty response with the given status code."""
+
+        self.send_response(status_code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubProdisServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server behind StubProdisHandler.
+
+    Args:
+        port | Integer port to listen on. 0 picks a free port.
+        latency | Float number of seconds each request takes.
+        error_rate | Float between 0 and 1. The fraction of requests answered with a 503.
+        seed | Integer seed for the random generator deciding which requests fail.
+
+    Tests can script the behaviour of single customers: customers in unknown_customers are answered with a 404, puts for customers
+    in refused_customers with a 500, and the next transient_failures[customer_id] requests for a customer with a 503.
+    get_counts counts the get requests per customer.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port, latency, error_rate, seed):
+        super().__init__(("127.0.0.1", port), StubProdisHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.put_bodies = {}
+        self.customer_data = {}
+        self.unknown_customers = set()
+        self.refused_customers = set()
+        self.transient_failures = {}
+        self.get_counts = {}
+        self.request_counts = {"GET": 0, "PUT": 0, "errors": 0}
+
+    def respond(self, handler, customer_id):
+        """
+        Counts a request, waits out the latency and decides whether it fails with a 503, either at random or because a transient failure was scripted.
+
+        Returns:
+            True if the handler should answer normally, False if a 503 has been sent instead.
+        """
+
+        with self.lock:
+            self.request_counts[handler.command] += 1
+            if handler.command == "GET":
+                self.get_counts[customer_id] = self.get_counts.get(customer_id, 0) + 1
+            failed = self.rng.random() < self.error_rate
+            if self.transient_failures.get(customer_id):
+                self.transient_failures[customer_id] -= 1
+                failed = True
+            if failed:
+                self.request_counts["errors"] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            handler.sendStatus(503)
+        return not failed
+
+
+def startStubServer(port=0, latency=0.0, error_rate=0.0, seed=1):
+    """
+    Starts a StubProdisServer on a background thread.
+
+    Returns:
+        server | The running StubProdisServer. Its URL for customers is http://127.0.0.1:<server.server_address[1]>/customers.
+    """
+
+    server = StubProdisServer(port, latency, error_rate, seed)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def replayPayloadJournal(server, payload_journal_path, workers, rate, retry_backoff, skip_get=False):
+    """
+    Runs the put requests recorded by a dry run through reprovision_quota.py's reprovision loop, against the stub.
+
+    Args:
+        server | A running StubProdisServer.
+        payload_journal_path | String representing the path of the payload journal written by the dry run.
+        workers | Integer number of worker threads for the reprovision loop.
+        rate | Float number of requests per second allowed. 0 disables the rate limit.
+        retry_backoff | Float backoff factor for retried requests.
+        skip_get | Boolean. If True, the recorded CustomerData is used without fetching it from the stub first. Otherwise the stub serves it.
+
+    Returns:
+        results | A dict holding the wall time, throughput, outcome counts, request counts and latencies of the replay,
+                  and how many of the bodies the stub received were identical to the recorded ones.
+    """
+
+    namespaces = {'ns': 'urn:eventis:crm:2.0'}
+    recorded_bodies = {}
+    for entry in reprovision_quota.readPayloadJournal(payload_journal_path):
+        customer = ET.fromstring(entry["body"])
+        reprovision_quota.reprovision_targets[entry["customer_id"]] = int(customer.find('ns:NPVRQuota', namespaces).text)
+        reprovision_quota.target_customer_data[entry["customer_id"]] = customer.find('ns:CustomerData', namespaces).text
+        server.customer_data[entry["customer_id"]] = reprovision_quota.target_customer_data[entry["customer_id"]]
+        recorded_bodies[entry["customer_id"]] = entry["body"]
+
+    reprovision_quota.prodisURL = f"http://127.0.0.1:{server.server_address[1]}/customers"
+    reprovision_quota.max_workers = workers
+    reprovision_quota.max_requests_per_second = rate
+    reprovision_quota.http_retry_backoff = retry_backoff
+    # Sessions are built with the retry settings in force when they're created, so start from new ones.
+    reprovision_quota.http_sessions.clear()
+    with tempfile.TemporaryDirectory() as work_dir:
+        # The replay keeps its own progress journal, so it can't mark targets as done for a real '--resume'.
+        reprovision_quota.journal_file = os.path.join(work_dir, "replay_journal.log")
+        start = time.perf_counter()
+        reprovision_quota.startReprovisionLoop(skip_get)
+        seconds = time.perf_counter() - start
+
+    outcomes = {}
+    for outcome in reprovision_quota.reprovision_results.values():
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    return {"targets": len(recorded_bodies),
+            "seconds": round(seconds, 4),
+            "targets_per_second": round(len(recorded_bodies) / seconds, 1) if seconds else None,
+            "outcomes": outcomes,
+            "stub_requests": dict(server.request_counts),
+            "identical_bodies": sum(1 for customer_id, body in server.put_bodies.items() if recorded_bodies.get(customer_id) == body),
+            "http_latency_seconds": {method: reprovision_quota.getPercentiles(latencies) for method, latencies in reprovision_quota.http_latencies.items()}}
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+import argparse
+import sqlite3
+import sys
+import time
+
+import reprovision_quota
+
+
+def main():
+    """
+    Query tool for the history store written by reprovision_quota.py.
+    Answers when a customer first drifted and what happened to them since, which bundles keep mismatching, which customers mismatch
+    run after run, and what recent runs did.
+    """
+
+    args = parseArguments()
+    try:
+        connection = connectHistory(args.db)
+    except sqlite3.OperationalError as e:
+        print(f"Could not open {args.db}: {e}", file=sys.stderr)
+        sys.exit(1)
+    since = time.time() - args.days * 24 * 60 * 60 if getattr(args, "days", None) else 0
+    with connection:
+        if args.query == "customer":
+            printRows(["run", "started", "file_quota", "intended_quota", "bundle", "reprovision"],
+                      [(run_id, formatTime(started_at), *rest) for run_id, started_at, *rest in getCustomerHistory(connection, args.customer_id)])
+        elif args.query == "bundles":
+            printRows(["bundle", "mismatches", "runs"], getBundleCounts(connection, since))
+        elif args.query == "offenders":
+            printRows(["customer", "runs", "first_seen", "last_seen"],
+                      [(customer_id, runs, formatTime(first_seen), formatTime(last_seen))
+                       for customer_id, runs, first_seen, last_seen in getRepeatOffenders(connection, args.min_runs, args.limit, since)])
+        else:
+            printRows(["run", "started", "outcome", "mismatches", "customer_file"],
+                      [(run_id, formatTime(started_at), outcome, mismatch_count, customer_file)
+                       for run_id, started_at, outcome, mismatch_count, customer_file in getRecentRuns(connection, args.limit)])
+
+
+def parseArguments():
+    """
+    Parses sys.args for the query to run.
+
+    Returns:
+        args | An argparse.Namespace. args.query names the query, and the other attributes hold its parameters.
+    """
+
+    parser = argparse.ArgumentParser(description="Queries the mismatch and reprovision history recorded by reprovision_quota.py.")
+    parser.add_argument('--db', default=reprovision_quota.history_file, help=f"Path of the history store. Defaults to {reprovision_quota.history_file}.")
+    queries = parser.add_subparsers(dest="query", required=True)
+    customer = queries.add_parser("customer", help="Every mismatch and reprovision attempt recorded for one customer, oldest first.")
+    customer.add_argument("customer_id")
+    bundles = queries.add_parser("bundles", help="Number of mismatches per determining bundle.")
+    bundles.add_argument('--days', type=float, help="Only count runs from the last this many days.")
+    offenders = queries.add_parser("offenders", help="Customers found mismatched in the most runs.")
+    offenders.add_argument('--min-runs', type=int, default=2, help="Only list customers mismatched in at least this many runs.")
+    offenders.add_argument('--limit', type=int, default=50, help="Maximum number of customers to list.")
+    offenders.add_argument('--days', type=float, help="Only count runs from the last this many days.")
+    runs = queries.add_parser("runs", help="The most recent runs, newest first.")
+    runs.add_argument('--limit', type=int, default=20, help="Maximum number of runs to list.")
+    return parser.parse_args()
+
+
+def connectHistory(path):
+    """Opens the history store read-only, so that a query can never change it or create an empty one."""
+
+    return sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+
+
+def getCustomerHistory(connection, customer_id):
+    """
+    Finds every run in which a customer was mismatched or had a reprovision attempt.
+
+    Args:
+        connection | A sqlite3.Connection to the history store.
+        customer_id | String representing the id of a specific customer.
+
+    Returns:
+        rows | A list of (run_id, started_at, file_quota, intended_quota, bundle_id, reprovision_outcome) tuples, oldest run first.
+               The mismatch fields are None for runs which only reprovisioned the customer, and the outcome is None for runs which didn't.
+    """
+
+    return connection.execute("""
+        SELECT m.run_id, r.started_at, m.file_quota, m.intended_quota, m.bundle_id, p.outcome
+        FROM mismatches m JOIN runs r ON r.run_id = m.run_id
+        LEFT JOIN reprovisions p ON p.run_id = m.run_id AND p.customer_id = m.customer_id
+        WHERE m.customer_id = ?
+        UNION ALL
+        SELECT p.run_id, r.started_at, NULL, NULL, NULL, p.outcome
+        FROM reprovisions p JOIN runs r ON r.run_id = p.run_id
+        WHERE p.customer_id = ? AND NOT EXISTS (SELECT 1 FROM mismatches m WHERE m.run_id = p.run_id AND m.customer_id = p.customer_id)
+        ORDER BY 1""", (str(customer_id), str(customer_id))).fetchall()
+
+
+def getBundleCounts(connection, since=0):
+    """
+    Counts mismatches per determining bundle, from the per-run totals in bundle_counts.
+
+    Args:
+        connection | A sqlite3.Connection to the history store.
+        since | Float timestamp. Only runs started at or after it are counted. If no run was, no rows are returned.
+
+    Returns:
+        rows | A list of (bundle_id, mismatches, runs) tuples, most mismatches first. bundle_id is None for customers without a bundle with NPVR.
+    """
+
+    return connection.execute("""
+        SELECT bundle_id, SUM(mismatches), COUNT(*)
+        FROM bundle_counts
+        WHERE run_id >= (SELECT COALESCE(MIN(run_id), (SELECT COALESCE(MAX(run_id), 0) + 1 FROM runs)) FROM runs WHERE started_at >= ?)
+        GROUP BY bundle_id
+        ORDER BY 2 DESC, bundle_id IS NULL, bundle_id""", (since,)).fetchall()
+
+
+def getRepeatOffenders(connection, min_runs=2, limit=50, since=0):
+    """
+    Finds the customers mismatched in the most runs. Over the whole history this is read from the running totals in customer_counts.
+    Limited to recent runs, the mismatches of those runs are counted instead.
+
+    Args:
+        connection | A sqlite3.Connection to the history store.
+        min_runs | Integer. Customers mismatched in fewer runs are left out.
+        limit | Integer maximum number of customers to return.
+        since | Float timestamp. Only runs started at or after it are counted.
+
+    Returns:
+        rows | A list of (customer_id, runs, first_seen, last_seen) tuples, most runs first.
+    """
+
+    if not since:
+        return connection.execute("""
+            SELECT c.customer_id, c.mismatch_runs, first_run.started_at, last_run.started_at
+            FROM customer_counts c
+            JOIN runs first_run ON first_run.run_id = c.first_run_id
+            JOIN runs last_run ON last_run.run_id = c.last_run_id
+            WHERE c.mismatch_runs >= ?
+            ORDER BY c.mismatch_runs DESC, c.customer_id
+            LIMIT ?""", (min_runs, limit)).fetchall()
+    return connection.execute("""
+        SELECT m.customer_id, COUNT(DISTINCT m.run_id) AS run_count, MIN(r.started_at), MAX(r.started_at)
+        FROM mismatches m JOIN runs r ON r.run_id = m.run_id
+        WHERE r.started_at >= ?
+        GROUP BY m.customer_id
+        HAVING run_count >= ?
+        ORDER BY run_count DESC, m.customer_id
+        LIMIT ?""", (since, min_runs, limit)).fetchall()
+
+
+def getRecentRuns(connection, limit=20):
+    """
+    Lists the most recent runs.
+
+    Returns:
+        rows | A list of (run_id, started_at, outcome, mismatch_count, customer_file) tuples, newest first.
+    """
+
+    return connection.execute("SELECT run_id, started_at, outcome, mismatch_count, customer_file FROM runs ORDER BY run_id DESC LIMIT ?",
+                              (limit,)).fetchall()
+
+
+def formatTime(timestamp):
+    """Formats a timestamp from the history store as local time."""
+
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)) if timestamp is not None else None
+
+
+def printRows(header, rows):
+    """Prints rows as tab-separated columns under a header line."""
+
+    print("\t".join(header))
+    for row in rows:
+        print("\t".join("" if value is None else str(value) for value in row))
+
+
+if __name__ == '__main__':
+    main()
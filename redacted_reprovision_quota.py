@@ -1,348 +1,2601 @@
-from xml.dom import minidom
-import glob
+import argparse
+import gzip
+import hashlib
+import importlib.util
 import os
-import mysql.connector
-import requests
 import json
-import logging.handlers
-import csv
+import logging
+import mmap
+import re
+import resource
+import shutil
+import socket
 import sys
+import threading
+import time
 import xml.etree.ElementTree as ET
+from array import array
+from collections import namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Heavy or rarely needed modules are imported by the functions that use them, so that a run only loads what its path needs:
+# mysql.connector in getNPVR_bundle_data(), requests in getSession(), numpy in findMismatchesVectorized(), asyncio for '--pipeline',
+# multiprocessing for parallel loads and '--config', csv for the target list, and sqlite3 for the history store.
 
 HOST = "REDACTED"
 USER = "REDACTED"
 PASSWORD = "REDACTED"
 PORT = 0000
 
-logger = logging.getLogger('Quota')
-hdlr = logging.handlers.TimedRotatingFileHandler('quota.log', when='midnight', interval=1, backupCount=30,
-                                                 encoding=None, delay=False, utc=True)
-formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
-hdlr.setFormatter(formatter)
-logger.addHandler(hdlr)
-logger.setLevel(logging.DEBUG)
+# Table holding the intended NPVR provisioning of each bundle.
+bundle_table = 'divitel_config_validator.product_bundle'
+# Local copy of the product_bundle table. Within the TTL (in seconds) it is used without contacting the DB at all.
+bundle_cache_file = 'bundle_cache.json'
+bundle_cache_ttl = 3600
+
+# Handlers are attached by configureLogging() when a run starts, so that importing this module has no side effects.
+# Records go through a queue to a background thread which writes quota.log, so logging never waits on file I/O.
+# log_format is 'text' or 'json' (one JSON object per line). Lines about single customers go to customer_logger, which
+# customer_logging either lets through ('per-customer') or limits to warnings and errors ('summary').
+logger = logging.getLogger('Quota')
+customer_logger = logging.getLogger('Quota.customers')
+log_format = 'text'
+customer_logging = 'per-customer'
+log_environment = None
+hdlr = None
+log_queue_handler = None
+log_listener = None
+
+pendenzenURL = "REDACTED"
+prodisURL = "REDACTED"
+preprod_prodisURL = "REDACTED"
+headers = {"X-Atlassian-Token": "no-check"}
+auth = ('REDACTED', 'REDACTED')
+
+# Settings for the pooled HTTP sessions used to talk to Prodis and Jira. Timeouts are in seconds.
+connect_timeout = 5
+read_timeout = 30
+http_retries = 3
+http_retry_backoff = 0.5
+http_sessions = {}
+http_sessions_lock = threading.Lock()
+
+# Customer files are nightly exports, either plain (.xml) or gzip-compressed (.xml.gz).
+# If the exporter writes the name of the newest export to latest_pointer_file, that is used without listing the directory.
+# Otherwise the result of the last directory listing is remembered in customer_file_manifest, and only redone when the directory changes.
+customer_file_dir = '/home/divitel/customerfiles'
+latest_pointer_file = 'LATEST'
+customer_file_manifest = 'customer_file_manifest.json'
+
+cutoff = 25
+# With '--early-abort', the ticket is raised as soon as the number of mismatches passes the cutoff. The target list is then written
+# through a buffer of abort_write_buffer bytes, and the log gets a summary with up to abort_sample_size example customer ids.
+abort_write_buffer = 1024 * 1024
+abort_sample_size = 20
+# Record of the customers found to be correctly provisioned on the previous run, used to skip unchanged customers.
+snapshot_file = 'customer_snapshot.json'
+# A parallel load splits the customer file into this many shards per worker process, so that uneven shards still keep every worker busy.
+shards_per_worker = 4
+shard_read_size = 1024 * 1024
+# Customers which fail validation while the customer file is read are skipped, and written here with the reason, one JSON object per line.
+# Rewritten by every run that reads the customer file, and removed when nothing was quarantined.
+quarantine_file = 'quarantined_customers.jsonl'
+# Maps the customer id of each reprovision target to the NPVR quota (in minutes) it should have. None until resolved on a manual run.
+reprovision_targets = {}
+# Maps the customer id of each reprovision target to the CustomerData read for it from the customer file.
+target_customer_data = {}
+# Maps the customer id of each reprovision target to the outcome of its reprovision attempt.
+reprovision_results = {}
+# With --skip-get, CustomerData from a customer file younger than this (in seconds) is used instead of fetching it from Prodis.
+customer_data_max_age = 24 * 60 * 60
+# Target list written by the abort path for a manual run. After a header line holding the run id, the modification time of the customer file
+# the CustomerData was read from and the sha256 checksum of the rows,
+# each row holds a customer id, the NPVR quota (in minutes) it should have and its CustomerData. Lists holding only customer ids,
+# as written by older versions of the script, are still read.
+target_list_file = 'manual_reprovision_targets.csv'
+target_list_header = '# reprovision targets v2 run_id='
+# A manual run processes the target list in shards of up to target_shard_size targets. Shards are claimed through files in target_shard_dir,
+# so that several manual runs can share one list. The run holding a claim touches it every time its journal is synced. A claim is taken over
+# only if the process holding it has died on this host, or if it hasn't been touched for target_claim_timeout (in seconds).
+target_shard_size = 10000
+target_shard_dir = 'manual_reprovision_shards'
+target_claim_timeout = 6 * 60 * 60
+
+# Append-only record of the outcome of each reprovision attempt, so that an interrupted run can be resumed with '--resume'.
+# Outcomes are flushed to disk every journal_sync_every attempts rather than after every line.
+journal_file = 'reprovision_journal.log'
+journal_sync_every = 100
+
+# With '--dry-run', put requests are recorded in payload_journal_file instead of being sent to Prodis, and no ticket is raised.
+# A dry run keeps its progress in dry_run_journal_file, so that it can't mark targets as done for a real '--resume'.
+payload_journal_file = 'dry_run_payloads.jsonl.gz'
+dry_run_journal_file = 'dry_run_journal.log'
+payload_journal = None
+
+# SQLite store of every run's mismatches and reprovision outcomes, queried with quota_history.py. None disables it.
+# Dry runs are not recorded.
+history_file = 'quota_history.sqlite'
+history_store = None
+
+# Limits on how hard the reprovision loop may hit Prodis.
+max_workers = 8
+max_requests_per_second = 10
+
+# Machine-readable report of each run: wall time per stage, counts, HTTP latencies and peak memory.
+# If prometheus_textfile is set, the same figures are also written there for the node exporter's textfile collector.
+run_report_file = 'quota_run_report.json'
+prometheus_textfile = None
+run_metrics = {"stages": {}, "counts": {}}
+http_latencies = {"GET": [], "PUT": []}
+metrics_lock = threading.Lock()
+
+# Settings an environment in a '--config' file may override, mapped to the module globals they replace.
+# prodis_url may also be "prod" or "preprod", for prodisURL or preprod_prodisURL.
+environment_settings = {"customer_file_dir": "customer_file_dir", "bundle_table": "bundle_table", "prodis_url": "prodisURL",
+                        "cutoff": "cutoff", "max_workers": "max_workers", "max_requests_per_second": "max_requests_per_second",
+                        "prometheus_textfile": "prometheus_textfile"}
+
+# Compact representation of a single customer from the customer file, as produced by streamCustomers().
+CustomerRecord = namedtuple('CustomerRecord', ['customer_id', 'npvr_quota', 'subscription_ids', 'customer_data'], defaults=[None])
+
+
+def main(args=None):
+    """
+    Main function for the reprovision_quota.py script. 
+    This script is for the purpose of correcting mistakes in Quickline customers NPVR (Network Personal Video Recording) provisioning.
+    Mismatches are detected from customer files and fixed. 
+
+    This script has three paths:
+    1. Main: Default path that detects mismatches and reprovisions.
+    2. Manual: Path for a manual script run. Does not detect mismatches, but reprovisions based on the content of manual_reprovision_targets.csv, shard by shard.
+    3. Abort: Path for when the number of misprovisioned customers is above a cutoff. Raises alert and prepares manual_reprovision_targets.csv for manual run.
+    With '--pipeline', the main and abort paths are run by runPipeline() instead, which overlaps their stages.
+    With '--config', each environment in the config file is run through these paths by runEnvironments() instead.
+
+    Args:
+        args | Optional argparse.Namespace, used instead of parsing sys.args. Given when an environment of a '--config' run is started.
+    """
+
+    # Main branch.
+    run_metrics["started_at"] = time.time()
+    run_metrics["outcome"] = "failed"
+    configureLogging()
+    try:
+        if args is None:
+            args = parseArguments()
+        configureLogging(args)
+        if args.config:
+            runEnvironments(args)
+            return
+        if args.dry_run:
+            startDryRun()
+        elif history_file:
+            openHistoryStore()
+        manual_run = args.manual
+        logger.info("reprovision_quota.py has been run. Hello!")
+        if args.pipeline and manual_run == False:
+            import asyncio
+            asyncio.run(runPipeline(args))
+            return
+        if manual_run == True:
+            # Side branch 1: Manual.
+            logger.info("Beginning manual branch.")
+            startManualRun(args)
+            run_metrics["outcome"] = "manual"
+            logger.info("Customer reprovisioning attempts complete. Manual run has concluded. ")
+            return
+        with timeStage("get_latest_customer_file"):
+            customer_file = getLatestCustomerFile()
+        run_metrics["customer_file"] = customer_file
+        with timeStage("load_customers"):
+            customers = loadCustomerStore(customer_file, args.workers)
+        countEvent("customers_loaded", len(customers))
+        with timeStage("get_npvr_bundle_data"):
+            NPVR_bundle_data = getNPVR_bundle_data()
+            bundle_index = buildBundleIndex(NPVR_bundle_data)
+        # Continuation of main branch. Search for mismatches and then continue or abort.
+        early_abort = EarlyAbort(bundle_index) if args.early_abort else None
+        with timeStage("find_mismatches"):
+            findMismatches(customers, bundle_index, args.incremental and not args.full_rescan, args.engine, early_abort.record if early_abort else None)
+        logger.info("Checking number of reprovision targets against cutoff.")
+        mismatchCount = len(reprovision_targets)
+        countEvent("mismatches", mismatchCount)
+        if mismatchCount > cutoff:
+            # Side branch 2: Abort.
+            abortRun(mismatchCount, early_abort)
+        else:
+            # Continuation of main branch: Reprovision mismatched customers.
+            with timeStage("start_reprovision_loop"):
+                startReprovisionLoop(canSkipGet(customer_file, args.skip_get), args.resume)
+            run_metrics["outcome"] = "reprovisioned"
+            logger.info("Customer reprovisioning attempts complete.")
+    except Exception as e:
+        logger.error(f"An error occured during the running of this script. Exception object = {e}")
+        sys.exit(1)
+    finally:
+        if payload_journal is not None:
+            payload_journal.close()
+        if history_store is not None:
+            closeHistoryStore()
+        writeRunReport()
+        stopLogging()
+
+# -----------------
+# INITIAL FUNCTIONS
+# -----------------
+
+def getLatestCustomerFile():
+    """
+    Finds the latest customer file and returns its path. The file itself is read later, one customer at a time, by streamCustomers().
+    The latest pointer is used if present. Otherwise the directory is only listed if it has changed since the last listing.
+
+    Returns:
+        customer_file | String representing the path of the latest customer file.
+    """
+
+    logger.info(f"Fetching latest customer list from {customer_file_dir}.")
+    try:
+        with open(os.path.join(customer_file_dir, latest_pointer_file), 'r') as pointer:
+            customer_file = os.path.join(customer_file_dir, pointer.read().strip())
+        if os.path.isfile(customer_file):
+            return customer_file
+        logger.error(f"{latest_pointer_file} points to {customer_file}, which does not exist. Searching {customer_file_dir} instead.")
+    except FileNotFoundError:
+        pass
+    dir_mtime = os.stat(customer_file_dir).st_mtime_ns
+    try:
+        with open(customer_file_manifest, 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest["dir"] == customer_file_dir and manifest["dir_mtime_ns"] == dir_mtime and os.path.isfile(manifest["latest"]):
+            return manifest["latest"]
+    except (OSError, ValueError, KeyError):
+        pass
+    customer_file = None
+    latest_ctime = None
+    with os.scandir(customer_file_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith(('.xml', '.xml.gz')) and entry.is_file():
+                ctime = entry.stat().st_ctime
+                if customer_file is None or ctime > latest_ctime:
+                    customer_file = entry.path
+                    latest_ctime = ctime
+    if customer_file is None:
+        raise FileNotFoundError(f"No customer files found in {customer_file_dir}.")
+    try:
+        with open(customer_file_manifest, 'w') as manifest_file:
+            json.dump({"dir": customer_file_dir, "dir_mtime_ns": dir_mtime, "latest": customer_file}, manifest_file)
+    except OSError as e:
+        logger.error(f"Error writing {customer_file_manifest}. Exception object = {e}")
+    return customer_file
+
+
+@contextmanager
+def openCustomerFile(customer_file):
+    """
+    Opens a customer file for parsing. Compressed (.gz) files are decompressed on the fly, and uncompressed files are read through a memory map.
+
+    Args:
+        customer_file | String representing the path of the customer file.
+
+    Yields:
+        source | A binary file-like object.
+    """
+
+    if customer_file.endswith('.gz'):
+        with gzip.open(customer_file, 'rb') as source:
+            yield source
+        return
+    with open(customer_file, 'rb') as xml_file:
+        if os.fstat(xml_file.fileno()).st_size == 0:
+            yield xml_file
+            return
+        with mmap.mmap(xml_file.fileno(), 0, access=mmap.ACCESS_READ) as source:
+            yield source
+
+
+def streamCustomers(customer_file, quarantined=None):
+    """
+    Incrementally parses the customer file and yields one compact record per customer.
+    Each customer element is freed as soon as it has been read, so memory use stays flat no matter how large the file is.
+
+    Args:
+        customer_file | String representing the path of the customer file.
+        quarantined | Optional list. Customers which fail validation are skipped, and an entry for each is appended to it.
+
+    Yields:
+        customer | A CustomerRecord holding the customer's id, NPVR quota (in minutes), subscription product ids and CustomerData.
+    """
+
+    with openCustomerFile(customer_file) as source:
+        yield from readCustomerEvents(ET.iterparse(source, events=('start', 'end')), quarantined)
+
+
+def readCustomerEvents(events, quarantined=None):
+    """
+    Turns a stream of ElementTree parse events into CustomerRecords, freeing each customer element once it has been read.
+    Customers which fail validation are logged and skipped, so that one bad record can't stop the run.
+
+    Args:
+        events | An iterable of ('start' or 'end', element) pairs, as produced by ET.iterparse or ET.XMLPullParser.
+        quarantined | Optional list. A dict holding the customer_id, reason and record of each skipped customer is appended to it.
+
+    Yields:
+        customer | A validated CustomerRecord holding the customer's id, NPVR quota (in minutes), subscription product ids and CustomerData.
+    """
+
+    open_elements = []
+    for event, element in events:
+        if event == 'start':
+            open_elements.append(element)
+            continue
+        open_elements.pop()
+        if getLocalName(element.tag) != "Customer":
+            continue
+        try:
+            customer = parseCustomerElement(element)
+        except ValueError as e:
+            customer = None
+            customer_logger.warning("Customer %s failed validation and will be skipped: %s", element.get('id'), e,
+                                    extra={"customer_id": element.get('id')})
+            if quarantined is not None:
+                quarantined.append({"customer_id": element.get('id'), "reason": str(e), "record": ET.tostring(element, encoding='unicode').strip()})
+        element.clear()
+        if open_elements:
+            open_elements[-1].remove(element)
+        if customer is not None:
+            yield customer
+
+
+def parseCustomerElement(element):
+    """
+    Converts an ElementTree element representing a customer into a CustomerRecord, validating it on the way.
+    Every later stage can rely on the record having an id and integer quota and subscription ids which fit a CustomerStore.
+
+    Args:
+        element | An xml.etree element representing a customer.
+
+    Returns:
+        customer | A CustomerRecord holding the customer's id, NPVR quota (in minutes), subscription product ids and CustomerData.
+
+    Raises:
+        ValueError | If the customer has no id, or its NPVRQuota or a SubscriptionProduct id is not a 64-bit integer. The message gives the reason.
+    """
+
+    customer_id = element.get("id")
+    if not customer_id:
+        raise ValueError("Customer has no id")
+    fileQuota = None
+    customer_data = None
+    subscription_ids = []
+    for child in element.iter():
+        tag = getLocalName(child.tag)
+        if tag == "NPVRQuota" and fileQuota is None:
+            fileQuota = parseCustomerInteger(child.text, "NPVRQuota")
+        elif tag == "SubscriptionProduct":
+            subscription_ids.append(parseCustomerInteger(child.get("id"), "SubscriptionProduct id"))
+        elif tag == "CustomerData" and customer_data is None:
+            customer_data = child.text
+    if fileQuota is None:
+        fileQuota = 0
+    return CustomerRecord(customer_id, fileQuota, tuple(subscription_ids), customer_data)
+
+
+def parseCustomerInteger(text, field):
+    """Converts the text of a field of a customer to an integer, raising a ValueError naming the field if it isn't a 64-bit integer."""
+
+    try:
+        value = int(text)
+    except (TypeError, ValueError):
+        raise ValueError(f"{field} {text!r} is not an integer") from None
+    if not -2**63 <= value < 2**63:
+        raise ValueError(f"{field} {text!r} is out of range")
+    return value
+
+
+def parseCustomerNode(customer):
+    """
+    Converts an xml.dom node representing a customer into a CustomerRecord.
+
+    Args:
+        customer | an xml.dom node representing a customer.
+
+    Returns:
+        customer | A CustomerRecord holding the customer's id, NPVR quota (in minutes), subscription product ids and CustomerData.
+    """
+
+    npvr_quota = customer.getElementsByTagName("NPVRQuota")
+    if npvr_quota.length > 0:
+        fileQuota = int(npvr_quota[0].firstChild.data)
+    else:
+        fileQuota = 0
+    subscriptions = customer.getElementsByTagName("SubscriptionProduct")
+    subscription_ids = tuple(int(subscriptionProduct.getAttribute("id")) for subscriptionProduct in subscriptions)
+    customer_data = customer.getElementsByTagName("CustomerData")
+    if customer_data.length > 0 and customer_data[0].firstChild is not None:
+        customer_data = customer_data[0].firstChild.data
+    else:
+        customer_data = None
+    return CustomerRecord(customer.getAttribute("id"), fileQuota, subscription_ids, customer_data)
+
+
+class CustomerStore:
+    """
+    Compact, column-oriented store of every customer in a customer file. It is built once while parsing and read by every later stage.
+    Customer ids, NPVR quotas and subscription product ids are held in flat arrays, and each distinct CustomerData string is stored once.
+    Iterating over the store yields a CustomerRecord per customer, in file order.
+    """
+
+    def __init__(self):
+        # Numeric customer ids are stored as integers. Any other id is kept in text_ids under its row, with -1 in customer_ids.
+        self.customer_ids = array('q')
+        self.text_ids = {}
+        self.npvr_quotas = array('q')
+        # The subscriptions of row i are subscription_ids[subscription_offsets[i]:subscription_offsets[i + 1]].
+        self.subscription_offsets = array('q', [0])
+        self.subscription_ids = array('q')
+        # Index into customer_data_values for each row, or -1 if the customer has no CustomerData.
+        self.customer_data_refs = array('i')
+        self.customer_data_values = []
+        self.customer_data_lookup = {}
+
+    def __len__(self):
+        return len(self.npvr_quotas)
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self.getRecord(row)
+
+    def append(self, customer):
+        """Adds a CustomerRecord to the end of the store."""
+
+        customer_id = customer.customer_id
+        if customer_id is not None and customer_id.isascii() and customer_id.isdigit() and len(customer_id) < 19 \
+                and (customer_id == "0" or customer_id[0] != "0"):
+            self.customer_ids.append(int(customer_id))
+        else:
+            self.text_ids[len(self.customer_ids)] = customer_id
+            self.customer_ids.append(-1)
+        self.npvr_quotas.append(customer.npvr_quota)
+        self.subscription_ids.extend(customer.subscription_ids)
+        self.subscription_offsets.append(len(self.subscription_ids))
+        self.customer_data_refs.append(self.internCustomerData(customer.customer_data))
+
+    def extend(self, other):
+        """Adds every customer of another CustomerStore to the end of this one."""
+
+        row_offset = len(self)
+        subscription_offset = len(self.subscription_ids)
+        self.customer_ids.extend(other.customer_ids)
+        for row, customer_id in other.text_ids.items():
+            self.text_ids[row_offset + row] = customer_id
+        self.npvr_quotas.extend(other.npvr_quotas)
+        self.subscription_ids.extend(other.subscription_ids)
+        self.subscription_offsets.extend(offset + subscription_offset for offset in other.subscription_offsets[1:])
+        refs = [self.internCustomerData(customer_data) for customer_data in other.customer_data_values]
+        self.customer_data_refs.extend(refs[ref] if ref >= 0 else -1 for ref in other.customer_data_refs)
+
+    def internCustomerData(self, customer_data):
+        """Returns the index of a CustomerData string in customer_data_values, adding it if it is new. None is stored as -1."""
+
+        if customer_data is None:
+            return -1
+        ref = self.customer_data_lookup.get(customer_data)
+        if ref is None:
+            ref = len(self.customer_data_values)
+            self.customer_data_values.append(customer_data)
+            self.customer_data_lookup[customer_data] = ref
+        return ref
+
+    def getCustomerId(self, row):
+        """Returns the customer id of a row, as the string found in the customer file."""
+
+        customer_id = self.customer_ids[row]
+        if customer_id == -1:
+            return self.text_ids[row]
+        return str(customer_id)
+
+    def getRecord(self, row):
+        """Returns the CustomerRecord of a row."""
+
+        ref = self.customer_data_refs[row]
+        return CustomerRecord(self.getCustomerId(row), self.npvr_quotas[row],
+                              tuple(self.subscription_ids[self.subscription_offsets[row]:self.subscription_offsets[row + 1]]),
+                              self.customer_data_values[ref] if ref >= 0 else None)
+
+
+def loadCustomerStore(customer_file, workers=1):
+    """
+    Parses the customer file once into a CustomerStore.
+
+    Args:
+        customer_file | String representing the path of the customer file.
+        workers | Integer number of processes to use. Above 1 the file is parsed in parallel shards.
+
+    Returns:
+        customers | A CustomerStore holding every valid customer from the customer file, in file order.
+
+    Modifies:
+        quarantine_file | Rewritten with the customers which failed validation, or removed if there were none.
+    """
+
+    logger.info("Reading all customers from the customer file.")
+    customers = None
+    if workers > 1 and customer_file.endswith('.gz'):
+        logger.info("Compressed customer files can't be split into shards, so the customer file will be read serially.")
+    elif workers > 1:
+        try:
+            customers, quarantined = loadInParallel(customer_file, workers)
+        except ET.ParseError as e:
+            logger.error(f"The customer file could not be split into shards. Falling back to a serial read. Exception object = {e}")
+    if customers is None:
+        customers = CustomerStore()
+        quarantined = []
+        for customer in streamCustomers(customer_file, quarantined):
+            customers.append(customer)
+    writeQuarantine(quarantined)
+    return customers
+
+
+def writeQuarantine(quarantined):
+    """
+    Writes the customers which failed validation to quarantine_file, so that they can be fixed at the source.
+
+    Args:
+        quarantined | A list of dicts holding the customer_id, reason and record of each customer, as collected by readCustomerEvents().
+    """
+
+    countEvent("customers_quarantined", len(quarantined))
+    try:
+        if not quarantined:
+            if os.path.exists(quarantine_file):
+                os.remove(quarantine_file)
+            return
+        logger.warning(f"{len(quarantined)} customers failed validation and were skipped. They have been written to {quarantine_file}.")
+        with open(quarantine_file, 'w') as quarantine:
+            for entry in quarantined:
+                quarantine.write(json.dumps(entry) + "\n")
+    except OSError as e:
+        logger.error(f"Could not write {quarantine_file}. Exception object = {e}")
+
+
+def getLocalName(tag):
+    """Strips any XML namespace from an ElementTree tag, so '{urn:eventis:crm:2.0}Customer' becomes 'Customer'."""
+
+    return tag.rpartition('}')[2]
+
+
+def getNPVR_bundle_data():
+    """
+    Fetches data on how many NPVR hours a given bundle should have, and stores this in variable 'NPVR_bundle_data' after converting it to minutes.
+    The data is cached in bundle_cache.json. A cache younger than bundle_cache_ttl is used as is. An older cache is kept if a row count/checksum query shows the table is unchanged.
+    If the DB cannot be reached, the last cached copy is used regardless of its age.
+    
+    Returns:
+        NPVR_bundle_data | A list of tuples reflecting the intended NPVR provisioning (in minutes) for each bundle. 
+    """
+
+    logger.info("Fetching data on bundles and intended NPVR provisioning.")
+    cache = loadBundleCache()
+    if cache is not None and time.time() - cache["fetched_at"] < bundle_cache_ttl:
+        logger.info(f"Using bundle data cached in {bundle_cache_file}.")
+        return [tuple(line) for line in cache["rows"]]
+    import mysql.connector
+    try:
+        connection = mysql.connector.connect(host=HOST, user=USER, password=PASSWORD, port=PORT)
+        try:
+            myCursor = connection.cursor()
+            myCursor.execute(f"SELECT COUNT(*), SUM(CRC32(CONCAT_WS(',', bundle_id, npvr))) FROM {bundle_table};")
+            row_count, checksum = myCursor.fetchone()
+            checksum = str(checksum)
+            if cache is not None and cache["row_count"] == row_count and cache["checksum"] == checksum:
+                logger.info(f"Bundle data is unchanged since it was cached in {bundle_cache_file}.")
+                NPVR_bundle_data = [tuple(line) for line in cache["rows"]]
+            else:
+                myCursor.execute(f"SELECT bundle_id, npvr*60 FROM {bundle_table};")
+                NPVR_bundle_data = myCursor.fetchall()
+        finally:
+            connection.close()
+    except mysql.connector.Error as e:
+        if cache is None:
+            raise
+        logger.error(f"Could not fetch bundle data from the DB. Falling back to the copy cached in {bundle_cache_file}. Exception object = {e}")
+        return [tuple(line) for line in cache["rows"]]
+    saveBundleCache(NPVR_bundle_data, row_count, checksum)
+    return NPVR_bundle_data
+
+
+def loadBundleCache():
+    """
+    Loads the cached copy of the product_bundle table.
+
+    Returns:
+        cache | A dict with keys "fetched_at", "row_count", "checksum" and "rows", or None if there is no usable cache.
+    """
+
+    try:
+        with open(bundle_cache_file, 'r') as cache_file:
+            return json.load(cache_file)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.error(f"Error reading {bundle_cache_file}. Exception object = {e}")
+        return None
+
+
+def saveBundleCache(NPVR_bundle_data, row_count, checksum):
+    """
+    Writes the product_bundle table to the cache, stamped with the current time. The file is replaced atomically.
+
+    Args:
+        NPVR_bundle_data | A list of tuples reflecting the intended NPVR provisioning (in minutes) for each bundle.
+        row_count | Integer number of rows in the product_bundle table.
+        checksum | String checksum of the product_bundle table, as returned by the checksum query.
+    """
+
+    try:
+        with open(bundle_cache_file + '.tmp', 'w') as cache_file:
+            json.dump({"fetched_at": time.time(), "row_count": row_count, "checksum": checksum,
+                       "rows": [list(line) for line in NPVR_bundle_data]}, cache_file, default=str)
+        os.replace(bundle_cache_file + '.tmp', bundle_cache_file)
+    except Exception as e:
+        logger.error(f"Error writing {bundle_cache_file}. Exception object = {e}")
+
+
+def buildBundleIndex(NPVR_bundle_data):
+    """
+    Builds a lookup table from bundle id to intended NPVR provisioning, so that each subscription can be resolved with a single dict lookup.
+    If a bundle appears more than once, the highest NPVR provisioning is kept.
+
+    Args:
+        NPVR_bundle_data | A list of tuples reflecting the intended NPVR provisioning (in minutes) for each bundle.
+
+    Returns:
+        bundle_index | A dict mapping each bundle id (integer) to its intended NPVR provisioning in minutes (integer).
+    """
+
+    bundle_index = {}
+    for line in NPVR_bundle_data:
+        bundle_id = int(line[0])
+        bundle_npvr = int(line[1])
+        if bundle_id not in bundle_index or bundle_index[bundle_id] < bundle_npvr:
+            bundle_index[bundle_id] = bundle_npvr
+    return bundle_index
+
+
+def configureLogging(args=None):
+    """
+    Creates the rotating quota.log handler on the first call, and starts the background thread writing to it if it isn't running.
+    Every call applies the current log format and per-customer verbosity.
+
+    Args:
+        args | Optional argparse.Namespace returned by parseArguments(). If given, its log_format and customer_logging replace the defaults.
+
+    Modifies:
+        hdlr | Set to the TimedRotatingFileHandler writing quota.log.
+        log_format | Set to args.log_format.
+        customer_logging | Set to args.customer_logging.
+    """
+
+    global hdlr, log_format, customer_logging
+    import logging.handlers
+    if args is not None:
+        log_format = args.log_format
+        customer_logging = args.customer_logging
+    if hdlr is None:
+        hdlr = logging.handlers.TimedRotatingFileHandler('quota.log', when='midnight', interval=1, backupCount=30,
+                                                         encoding=None, delay=False, utc=True)
+    logger.setLevel(logging.DEBUG)
+    if log_format == 'json':
+        hdlr.setFormatter(JsonLogFormatter())
+    else:
+        environment_tag = f" [{log_environment}]" if log_environment else ""
+        hdlr.setFormatter(logging.Formatter(f'%(asctime)s %(levelname)s{environment_tag} %(message)s'))
+    customer_logger.setLevel(logging.INFO if customer_logging == 'per-customer' else logging.WARNING)
+    if log_listener is None:
+        startLogListener()
+
+
+def startLogListener():
+    """
+    Routes the logger through a new queue, emptied into hdlr by a QueueListener thread. Also used by a forked process,
+    which doesn't inherit the thread of its parent.
+
+    Modifies:
+        log_queue_handler | Set to the QueueHandler attached to the logger, replacing any earlier one.
+        log_listener | Set to the running QueueListener.
+    """
+
+    global log_queue_handler, log_listener
+    import logging.handlers
+    import queue
+    if log_queue_handler is not None:
+        logger.removeHandler(log_queue_handler)
+    log_queue = queue.SimpleQueue()
+    log_queue_handler = logging.handlers.QueueHandler(log_queue)
+    logger.addHandler(log_queue_handler)
+    log_listener = logging.handlers.QueueListener(log_queue, hdlr)
+    log_listener.start()
+
+
+def stopLogging():
+    """
+    Writes out every queued record, stops the background thread and detaches the queue from the logger.
+
+    Modifies:
+        log_queue_handler | Set back to None.
+        log_listener | Set back to None.
+    """
+
+    global log_queue_handler, log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+    if log_queue_handler is not None:
+        logger.removeHandler(log_queue_handler)
+        log_queue_handler = None
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Formats each record as one JSON object per line. Lines about a single customer carry its id as their own customer_id field."""
+
+    def format(self, record):
+        entry = {"time": self.formatTime(record), "level": record.levelname, "message": record.getMessage()}
+        if log_environment:
+            entry["environment"] = log_environment
+        if hasattr(record, "customer_id"):
+            entry["customer_id"] = str(record.customer_id)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def parseArguments():
+    """
+    Parses sys.args to determine which type of run this is.
+
+    Returns:
+        args | An argparse.Namespace. args.manual is True for a manual run, args.incremental is True if customers unchanged since the
+               previous run may be skipped, args.full_rescan is True if every customer must be checked anyway, args.workers is the number of processes used to read the customer file, args.resume is True if an interrupted run is being continued,
+               args.engine names the mismatch search to use, args.skip_get is True if CustomerData may be taken from the customer file,
+               args.pipeline is True if the stages of the run should overlap, and args.early_abort is True if the ticket should be raised
+               as soon as the cutoff is passed. args.config is the path of a config file listing environments to run, or None.
+               args.dry_run is True if put requests should be recorded rather than sent. args.log_format and args.customer_logging
+               set the format of quota.log and whether it gets a line per customer.
+    """
+
+    parser = argparse.ArgumentParser(description="Detects and corrects mismatches in customers' NPVR provisioning.")
+    parser.add_argument('--manual', action='store_true',
+                        help=f"Reprovision based on the contents of {target_list_file} instead of searching for mismatches. "
+                             "Several manual runs may be started on the same list, and share its shards between them.")
+    parser.add_argument('--incremental', action='store_true',
+                        help=f"Skip customers found correctly provisioned by the previous incremental run, as recorded in {snapshot_file}.")
+    parser.add_argument('--full-rescan', action='store_true',
+                        help=f"Check every customer, without reading or writing {snapshot_file}, even with '--incremental'.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of processes used to read the customer file. Defaults to 1, a serial read.")
+    parser.add_argument('--resume', action='store_true',
+                        help=f"Continue an interrupted run: targets recorded as reprovisioned in {journal_file} are skipped, and failed ones are retried.")
+    parser.add_argument('--engine', choices=['python', 'numpy'], default='python',
+                        help="How to search for mismatches. 'numpy' checks every customer at once with NumPy, and needs no snapshot. Defaults to 'python'.")
+    parser.add_argument('--skip-get', action='store_true',
+                        help="Take CustomerData from the customer file, if it is recent enough, instead of fetching it from Prodis before each reprovision.")
+    parser.add_argument('--early-abort', action='store_true',
+                        help="Raise the ticket as soon as the number of mismatches passes the cutoff, and log a summary of the mismatches instead of one line per customer.")
+    parser.add_argument('--dry-run', action='store_true',
+                        help=f"Record the put requests that would be sent to Prodis in {payload_journal_file} instead of sending them, and don't raise a ticket. "
+                             "The recording can be replayed against prodis_stub_server.py.")
+    parser.add_argument('--log-format', choices=['text', 'json'], default=log_format,
+                        help=f"Write quota.log as plain text or as one JSON object per line. Defaults to '{log_format}'.")
+    parser.add_argument('--customer-logging', choices=['per-customer', 'summary'], default=customer_logging,
+                        help="'summary' leaves out the log lines about single customers, apart from warnings and errors. "
+                             f"Defaults to '{customer_logging}'.")
+    parser.add_argument('--config',
+                        help="JSON file listing several environments to run in one invocation, each with its own directory, settings and cache. "
+                             "The environments run concurrently and their reports are combined.")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="Overlap the stages of the run: the bundle query runs while the customer file is read, and CustomerData is fetched while mismatches are still being searched for.")
+    try:
+        args = parser.parse_args()
+    except SystemExit as e:
+        if e.code:
+            logger.error("Invalid sys.args have been provided. Run the script with '--help' to see which sys.args are accepted.")
+            sys.exit(1)
+        raise
+    if args.manual and args.pipeline:
+        logger.info("'--pipeline' only applies to the main path and is ignored on a manual run.")
+    if args.manual:
+        logger.info(f"Script has been run manually. Reprovisioning will occur based on the contents of {target_list_file}")
+    return args
+
+
+# -----------
+# MANUAL PATH
+# -----------
+
+def startManualRun(args):
+    """
+    Runs the manual path over the target list, one shard at a time. Each shard is claimed before it is read, so several manual runs
+    started on the same list share it between them. Only one shard of targets is held in memory at a time, and the list is only cleared
+    once every shard has been processed, so a run that dies loses nothing: its shard is claimed again by the next manual run, as described
+    in claimTargetShard(), and carries on from the shard's progress journal.
+
+    Args:
+        args | The argparse.Namespace returned by parseArguments().
+
+    Modifies:
+        reprovision_targets | Holds the targets of the shard being processed.
+        target_customer_data | Holds the CustomerData of the targets of the shard being processed.
+        reprovision_results | Holds the outcomes of the shard being processed.
+    """
+
+    with timeStage("scan_target_list"):
+        target_list = scanTargetList(target_list_file)
+    if target_list is None:
+        return
+    countEvent("manual_targets", target_list.target_count)
+    logger.info(f"{target_list_file} holds {target_list.target_count} targets of run {target_list.run_id}, in {len(target_list.shards)} shards.")
+    customers = None
+    if target_list.legacy:
+        # Lists holding only customer ids don't say what the targets should have, so it is worked out from the customer file.
+        with timeStage("get_latest_customer_file"):
+            customer_file = getLatestCustomerFile()
+        run_metrics["customer_file"] = customer_file
+        with timeStage("load_customers"):
+            customers = loadCustomerStore(customer_file, args.workers)
+        countEvent("customers_loaded", len(customers))
+        with timeStage("get_npvr_bundle_data"):
+            bundle_index = buildBundleIndex(getNPVR_bundle_data())
+        # Every shard is resolved against the same customers, so they are searched once for the targets of the whole list.
+        with timeStage("index_manual_targets"):
+            target_ids = {customer_id for start, end in target_list.shards for customer_id, _, _ in readTargetShard(target_list_file, start, end)}
+            target_rows = indexTargetRows(customers, target_ids)
+        skip_get = canSkipGet(customer_file, args.skip_get)
+    else:
+        skip_get = canSkipGet(target_list_file, args.skip_get, target_list.customer_file_time)
+    # A dry run mustn't mark shards as done for a real run, so it works through every shard without claiming any.
+    shard_dir = None if payload_journal is not None else getTargetShardDir(target_list)
+    if shard_dir:
+        os.makedirs(shard_dir, exist_ok=True)
+    for shard, (start, end) in enumerate(target_list.shards):
+        if shard_dir and not claimTargetShard(shard_dir, shard):
+            continue
+        reprovision_targets.clear()
+        target_customer_data.clear()
+        reprovision_results.clear()
+        for customer_id, specifiedQuota, customer_data in readTargetShard(target_list_file, start, end):
+            reprovision_targets[customer_id] = specifiedQuota
+            target_customer_data[customer_id] = customer_data
+        logger.info(f"Processing shard {shard + 1} of {len(target_list.shards)}, holding {len(reprovision_targets)} targets.")
+        if customers is not None:
+            with timeStage("resolve_manual_targets"):
+                resolveManualTargets(customers, bundle_index, target_rows)
+        if shard_dir:
+            shard_journal = os.path.join(shard_dir, f"shard-{shard:05d}.journal")
+            shard_claim = os.path.join(shard_dir, f"shard-{shard:05d}.claim")
+            resume = args.resume or os.path.exists(shard_journal)
+        else:
+            shard_journal = shard_claim = None
+            resume = args.resume
+        with timeStage("start_reprovision_loop"):
+            startReprovisionLoop(skip_get, resume, journal_path=shard_journal, claim_path=shard_claim)
+        if shard_dir:
+            markTargetShardDone(shard_dir, shard)
+        countEvent("target_shards_processed")
+    if shard_dir is None:
+        clearManualTargetList()
+    elif all(os.path.exists(os.path.join(shard_dir, f"shard-{shard:05d}.done")) for shard in range(len(target_list.shards))):
+        clearManualTargetList()
+        shutil.rmtree(shard_dir, ignore_errors=True)
+    else:
+        logger.info(f"Other manual runs are still processing shards of {target_list_file}. The last of them to finish will clear it.")
+
+
+def getRunId():
+    """Returns the id of this run, written into the header of the target list. Made up of the start time and process id."""
+
+    with metrics_lock:
+        if "run_id" not in run_metrics:
+            started_at = run_metrics.get("started_at", time.time())
+            run_metrics["run_id"] = f"{time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(started_at))}-{os.getpid()}"
+        return run_metrics["run_id"]
+
+
+class TargetListWriter:
+    """
+    Writes a target list for a manual run: a header line, then one CSV row of customer id, NPVR quota (in minutes) and CustomerData per target.
+    The header holds the run id, the modification time of the customer file this run read (0 if none was read) and the sha256 checksum of the rows.
+    The checksum is only known once every row has been written, so the header is first written with a placeholder of the same width, and
+    rewritten by close(). A list whose writer never finished keeps the placeholder,
+    and is refused by a manual run.
+
+    Args:
+        path | String representing the path of the target list.
+        buffering | Integer buffer size in bytes, as for open(). -1 uses the default.
+    """
+
+    def __init__(self, path, buffering=-1):
+        import csv
+        self.target_list = open(path, 'w', newline='', encoding='utf-8', buffering=buffering)
+        customer_file = run_metrics.get("customer_file")
+        customer_file_time = int(os.path.getmtime(customer_file)) if customer_file and os.path.exists(customer_file) else 0
+        self.header = f"{target_list_header}{getRunId()} customer_file_time={customer_file_time} sha256="
+        self.target_list.write(self.header + "0" * 64 + "\n")
+        self.checksum = hashlib.sha256()
+        self.writer = csv.writer(self, delimiter=',', quoting=csv.QUOTE_MINIMAL)
+        self.target_count = 0
+
+    def write(self, text):
+        """Called by the csv writer with each row. Adds the row to the checksum before writing it."""
+
+        self.checksum.update(text.encode('utf-8'))
+        self.target_list.write(text)
+
+    def writeTarget(self, customer_id, specifiedQuota, customer_data):
+        """Writes one target. CustomerData of None is written as an empty field."""
+
+        self.writer.writerow([str(customer_id), specifiedQuota, customer_data if customer_data is not None else ""])
+        self.target_count += 1
+
+    def close(self):
+        """Rewrites the header with the checksum of the rows, and closes the list."""
+
+        self.target_list.seek(0)
+        self.target_list.write(self.header + self.checksum.hexdigest())
+        self.target_list.close()
+
+
+# Summary of a target list, as returned by scanTargetList(). shards is a list of (start, end) byte ranges, each holding whole rows.
+# customer_file_time is the modification time of the customer file the CustomerData was read from, or None if the list doesn't record it.
+TargetList = namedtuple('TargetList', ['run_id', 'checksum', 'legacy', 'target_count', 'shards', 'customer_file_time'])
+
+
+def scanTargetList(path):
+    """
+    Reads the target list once, as a stream, to check it and split it into shards of up to target_shard_size targets.
+    Lists without a header, which hold one customer id per row as written by older versions of the script, are still accepted.
+
+    Args:
+        path | String representing the path of the target list.
+
+    Returns:
+        target_list | A TargetList, or None if the list is missing, empty, or its rows don't match the checksum in its header.
+    """
+
+    logger.info(f"Reading {path} to split the reprovision targets of this manual run into shards.")
+    try:
+        with open(path, 'rb') as target_list:
+            header = target_list.readline()
+            match = re.match(rb'#[^\n]* run_id=(\S+)(?: customer_file_time=(\d+))? sha256=([0-9a-f]{64})', header)
+            if match is None:
+                target_list.seek(0)
+            offset = target_list.tell()
+            boundaries = [offset]
+            checksum = hashlib.sha256()
+            target_count = 0
+            in_quotes = False
+            for line in target_list:
+                checksum.update(line)
+                offset += len(line)
+                # A quoted CustomerData may span lines. A row only ends on a line which leaves no quote open.
+                if line.count(b'"') % 2:
+                    in_quotes = not in_quotes
+                if in_quotes or not line.strip():
+                    continue
+                target_count += 1
+                if target_count % target_shard_size == 0:
+                    boundaries.append(offset)
+    except FileNotFoundError as e:
+        logger.error(f"Error, likely because no {path} was found. Exception object = {e}")
+        return None
+    if target_count == 0:
+        logger.info(f"{path} holds no reprovision targets.")
+        return None
+    if match is not None and checksum.hexdigest() != match.group(3).decode():
+        logger.error(f"The rows of {path} don't match the checksum in its header. It was not finished, or has been changed since, and will not be used.")
+        return None
+    if boundaries[-1] != offset:
+        boundaries.append(offset)
+    if match is None:
+        logger.info(f"{path} holds only customer ids. Their intended NPVR provisioning will be worked out from the customer file.")
+        return TargetList("unknown", checksum.hexdigest(), True, target_count, list(zip(boundaries, boundaries[1:])), None)
+    customer_file_time = int(match.group(2)) if match.group(2) else 0
+    return TargetList(match.group(1).decode(), match.group(3).decode(), False, target_count, list(zip(boundaries, boundaries[1:])), customer_file_time)
+
+
+def readTargetShard(path, start, end):
+    """
+    Streams the targets in one shard of the target list.
+
+    Args:
+        path | String representing the path of the target list.
+        start | Integer byte offset at which the shard begins.
+        end | Integer byte offset at which the shard ends.
+
+    Yields:
+        (customer_id, specifiedQuota, customer_data) | The NPVR quota (in minutes) and CustomerData are None in lists holding only customer ids.
+    """
+
+    import csv
+
+    def readLines(target_list):
+        while target_list.tell() < end:
+            line = target_list.readline()
+            if not line:
+                return
+            yield line.decode('utf-8')
+
+    with open(path, 'rb') as target_list:
+        target_list.seek(start)
+        for row in csv.reader(readLines(target_list), delimiter=','):
+            if not row:
+                continue
+            if len(row) < 3:
+                yield row[0], None, None
+            else:
+                yield row[0], int(row[1]), row[2] or None
+
+
+def getTargetShardDir(target_list):
+    """Returns the directory holding the claims and journals of a target list's shards. It is named after the list's run id and checksum."""
+
+    return os.path.join(target_shard_dir, f"{target_list.run_id}-{target_list.checksum[:16]}")
+
+
+def claimTargetShard(shard_dir, shard):
+    """
+    Claims a shard of the target list for this run, by creating its claim file. Creating the file is atomic, so only one run can claim a shard.
+    An existing claim is only taken over if isClaimAbandoned() finds it was left by a run that died.
+
+    Args:
+        shard_dir | String representing the directory holding the claim files and journals of the target list's shards.
+        shard | Integer index of the shard.
+
+    Returns:
+        True if this run now holds the shard, False if it is done or held by another run.
+    """
+
+    claim_path = os.path.join(shard_dir, f"shard-{shard:05d}.claim")
+    if os.path.exists(os.path.join(shard_dir, f"shard-{shard:05d}.done")):
+        return False
+    for attempt in range(2):
+        try:
+            claim = os.open(claim_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                claim_stat = os.stat(claim_path)
+                if attempt or not isClaimAbandoned(claim_path):
+                    return False
+                # Renaming is atomic as well, so only one run can take over the claim. Another run may have taken it over and claimed the shard
+                # again since it was checked, so the renamed claim is compared with the one that was checked, and put back if it isn't that one.
+                stale_path = f"{claim_path}.stale-{os.getpid()}"
+                os.rename(claim_path, stale_path)
+                stale_stat = os.stat(stale_path)
+                if (stale_stat.st_ino, stale_stat.st_mtime_ns) != (claim_stat.st_ino, claim_stat.st_mtime_ns):
+                    try:
+                        os.link(stale_path, claim_path)
+                    except FileExistsError:
+                        pass
+                    os.remove(stale_path)
+                    return False
+                os.remove(stale_path)
+                logger.info(f"Taking over shard {shard + 1}, whose claim was left by a run that didn't finish it.")
+            except FileNotFoundError:
+                pass
+            continue
+        with os.fdopen(claim, 'w') as claim_file:
+            claim_file.write(f"{socket.gethostname()} {os.getpid()} {getRunId()}\n")
+        return True
+    return False
+
+
+def isClaimAbandoned(claim_path):
+    """
+    Decides whether a shard's claim was left by a run that died. That is the case if the process named in it no longer exists on this host,
+    or if the claim hasn't been touched for target_claim_timeout. A running manual run touches its claim every time its journal is synced.
+
+    Args:
+        claim_path | String representing the path of the claim file, which holds the host name, process id and run id of its run.
+
+    Returns:
+        True if the claim may be taken over, otherwise False.
+    """
+
+    if time.time() - os.path.getmtime(claim_path) >= target_claim_timeout:
+        return True
+    with open(claim_path) as claim_file:
+        fields = claim_file.read().split()
+    if len(fields) < 2 or fields[0] != socket.gethostname() or not fields[1].isdigit():
+        return False
+    try:
+        os.kill(int(fields[1]), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+def markTargetShardDone(shard_dir, shard):
+    """Creates the done marker of a shard, so that no later run claims it again."""
+
+    try:
+        os.close(os.open(os.path.join(shard_dir, f"shard-{shard:05d}.done"), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        pass
+
+
+def clearManualTargetList():
+    """Clears the external target list"""
+
+    if payload_journal is not None:
+        logger.info(f"Dry run: {target_list_file} is left as it is.")
+        return
+    logger.info(f"Clearing {target_list_file}")
+    try:
+        with open(target_list_file, 'w'):
+            pass
+        logger.info(f"{target_list_file} has been cleared.")
+    except Exception as e:
+        logger.error(f"Error clearing {target_list_file}. Exception object = {e}")
+
+
+def indexTargetRows(customers, target_ids):
+    """
+    Searches the customers once for the rows of the given targets.
+
+    Args:
+        customers | A CustomerStore holding every customer from the customer file.
+        target_ids | A set of customer ids to search for.
+
+    Returns:
+        target_rows | A dict mapping each target found in the customer file to its row in the store. If a customer appears twice, the last row is kept.
+    """
+
+    logger.info("Searching customer file for the reprovision targets of this manual run.")
+    target_rows = {}
+    for row in range(len(customers)):
+        customer_id = customers.getCustomerId(row)
+        if customer_id in target_ids:
+            target_rows[customer_id] = row
+    return target_rows
+
+
+def resolveManualTargets(customers, bundle_index, target_rows=None):
+    """
+    Works out the intended NPVR provisioning for each target of a manual run from its row in the customer file.
+    Targets which cannot be found in the customer file are dropped, as there is nothing to reprovision them to.
+
+    Args:
+        customers | A CustomerStore holding every customer from the customer file.
+        bundle_index | A dict mapping each bundle id to its intended NPVR provisioning (in minutes), as built by buildBundleIndex().
+        target_rows | Optional dict mapping targets to their rows in customers, as returned by indexTargetRows(). If omitted, the customers
+                      are searched for the current targets.
+
+    Modifies:
+        reprovision_targets | Dict mapping the customer IDs of customers which will be reprovisioned to the NPVR quota (in minutes) they should have.
+        target_customer_data | Dict mapping the customer IDs of the reprovision targets to their CustomerData from the customer file.
+    """
+
+    if target_rows is None:
+        target_rows = indexTargetRows(customers, reprovision_targets.keys())
+    for customer_id in reprovision_targets:
+        row = target_rows.get(customer_id)
+        if row is not None:
+            customer = customers.getRecord(row)
+            fileQuota, specifiedQuota = getIntendedNPVR(customer, bundle_index)
+            reprovision_targets[customer_id] = specifiedQuota
+            target_customer_data[customer_id] = customer.customer_data
+    missing_targets = [customer_id for customer_id, specifiedQuota in reprovision_targets.items() if specifiedQuota is None]
+    for customer_id in missing_targets:
+        logger.error(f"Customer {customer_id} was not found in the customer file and will not be reprovisioned.")
+        del reprovision_targets[customer_id]
+
+
+# -------
+# METRICS
+# -------
+
+@contextmanager
+def timeStage(stage):
+    """
+    Records the wall time of a stage of the run in run_metrics.
+
+    Args:
+        stage | String naming the stage.
+    """
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        run_metrics["stages"][stage] = round(time.perf_counter() - start, 3)
+
+
+def countEvent(event, amount=1):
+    """
+    Adds to one of the counts in run_metrics. Safe to call from worker threads.
+
+    Args:
+        event | String naming the count, e.g. "mismatches".
+        amount | Integer to add to the count.
+    """
+
+    with metrics_lock:
+        run_metrics["counts"][event] = run_metrics["counts"].get(event, 0) + amount
+
+
+def recordRequest(method, seconds, succeeded):
+    """
+    Records the latency and outcome of a request to Prodis.
+
+    Args:
+        method | String, "GET" or "PUT".
+        seconds | Float wall time of the request.
+        succeeded | Boolean, whether Prodis answered with a success status code.
+    """
+
+    with metrics_lock:
+        http_latencies[method].append(seconds)
+    countEvent(f"{method.lower()}_{'successes' if succeeded else 'failures'}")
+
+
+def getPercentiles(latencies):
+    """
+    Summarises a list of latencies.
+
+    Args:
+        latencies | A list of floats, in seconds.
+
+    Returns:
+        percentiles | A dict with the count, p50, p90, p99 and max latency in seconds. Empty apart from the count if there are no latencies.
+    """
+
+    percentiles = {"count": len(latencies)}
+    if latencies:
+        ordered = sorted(latencies)
+        for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+            percentiles[name] = round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))], 4)
+        percentiles["max"] = round(ordered[-1], 4)
+    return percentiles
+
+
+def getPeakMemory():
+    """Returns the peak resident memory of this run in KB, counting this process and the largest of any worker processes."""
+
+    own_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    worker_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own_peak, worker_peak)
+
+
+def buildRunReport():
+    """
+    Builds the report of this run from run_metrics.
+
+    Returns:
+        report | A JSON-serialisable dict.
+    """
+
+    with metrics_lock:
+        report = {key: value for key, value in run_metrics.items() if key not in ("stages", "counts")}
+        report["stages"] = dict(run_metrics["stages"])
+        report["counts"] = dict(run_metrics["counts"])
+        report["http_latency_seconds"] = {method: getPercentiles(latencies) for method, latencies in http_latencies.items()}
+    report["finished_at"] = time.time()
+    report["peak_memory_kb"] = getPeakMemory()
+    return report
+
+
+def writeRunReport():
+    """Writes the report of this run to run_report_file and, if configured, to prometheus_textfile. Failures are logged rather than raised."""
+
+    report = buildRunReport()
+    try:
+        with open(run_report_file, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+        logger.info(f"Run report written to {run_report_file}.")
+    except Exception as e:
+        logger.error(f"Error writing {run_report_file}. Exception object = {e}")
+    if prometheus_textfile:
+        try:
+            writePrometheusTextfile(report)
+        except Exception as e:
+            logger.error(f"Error writing {prometheus_textfile}. Exception object = {e}")
+
+
+def writePrometheusTextfile(report):
+    """
+    Writes a run report in the Prometheus text format. The file is replaced atomically, as the textfile collector requires.
+
+    Args:
+        report | A dict as returned by buildRunReport().
+    """
+
+    lines = ["# HELP reprovision_quota_stage_seconds Wall time of each stage of the last run.",
+             "# TYPE reprovision_quota_stage_seconds gauge"]
+    lines += [f'reprovision_quota_stage_seconds{{stage="{stage}"}} {seconds}' for stage, seconds in report["stages"].items()]
+    lines += ["# HELP reprovision_quota_events Counts from the last run.",
+              "# TYPE reprovision_quota_events gauge"]
+    lines += [f'reprovision_quota_events{{event="{event}"}} {count}' for event, count in report["counts"].items()]
+    lines += ["# HELP reprovision_quota_http_latency_seconds Latency of Prodis requests in the last run.",
+              "# TYPE reprovision_quota_http_latency_seconds gauge"]
+    for method, percentiles in report["http_latency_seconds"].items():
+        for name, fraction in (("p50", "0.5"), ("p90", "0.9"), ("p99", "0.99")):
+            if name in percentiles:
+                lines.append(f'reprovision_quota_http_latency_seconds{{method="{method}",quantile="{fraction}"}} {percentiles[name]}')
+    lines += ["# HELP reprovision_quota_peak_memory_bytes Peak resident memory of the last run.",
+              "# TYPE reprovision_quota_peak_memory_bytes gauge",
+              f"reprovision_quota_peak_memory_bytes {report['peak_memory_kb'] * 1024}",
+              "# HELP reprovision_quota_last_run_success Whether the last run completed without an error.",
+              "# TYPE reprovision_quota_last_run_success gauge",
+              f"reprovision_quota_last_run_success {0 if report.get('outcome') == 'failed' else 1}",
+              "# HELP reprovision_quota_last_run_timestamp_seconds Time the last run finished.",
+              "# TYPE reprovision_quota_last_run_timestamp_seconds gauge",
+              f"reprovision_quota_last_run_timestamp_seconds {report['finished_at']:.0f}"]
+    with open(prometheus_textfile + '.tmp', 'w') as textfile:
+        textfile.write("\n".join(lines) + "\n")
+    os.replace(prometheus_textfile + '.tmp', prometheus_textfile)
+
+
+# -----------
+# HTTP CLIENT
+# -----------
+
+def getSession(service):
+    """
+    Returns the keep-alive session for a service, creating it on first use. Sessions are shared between threads and reuse pooled connections.
+    Connection errors and 5xx responses are retried with exponential backoff. Posts are only retried if the connection could not be made.
+
+    Args:
+        service | String naming the service the session is for, e.g. "prodis" or "jira".
+
+    Returns:
+        session | A requests.Session for the service.
+    """
+
+    with http_sessions_lock:
+        if service not in http_sessions:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            retry = Retry(total=http_retries, backoff_factor=http_retry_backoff, status_forcelist=[500, 502, 503, 504],
+                          allowed_methods=["GET", "PUT"], raise_on_status=False)
+            adapter = HTTPAdapter(pool_maxsize=max_workers, max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            http_sessions[service] = session
+        return http_sessions[service]
+
+
+def getTimeout():
+    """Returns the (connect, read) timeout tuple passed with every HTTP request."""
+
+    return (connect_timeout, read_timeout)
+
+
+# --------------
+# REPROVISIONING
+# --------------
+
+class RateLimiter:
+    """
+    Spaces out calls across all worker threads so that no more than a given number happen per second.
+
+    Args:
+        requests_per_second | Number of calls allowed per second. 0 or None disables the limit.
+    """
+
+    def __init__(self, requests_per_second):
+        self.interval = 1 / requests_per_second if requests_per_second else 0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Blocks the calling thread until it is allowed to make its next call."""
+
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def canSkipGet(customer_file, skip_get, customer_file_time=None):
+    """
+    Decides whether the CustomerData read from the customer file may be used in place of a get request to Prodis.
+
+    Args:
+        customer_file | String representing the path of the customer file, or of the target list the CustomerData was copied to.
+        skip_get | Boolean, True if the script was run with '--skip-get'.
+        customer_file_time | Optional modification time of the customer file, as recorded in a target list. Defaults to the modification time of customer_file.
+
+    Returns:
+        True if skip_get is set and the customer file is younger than customer_data_max_age, otherwise False.
+    """
+
+    if not skip_get:
+        return False
+    if customer_file_time is None:
+        customer_file_time = os.path.getmtime(customer_file)
+    age = time.time() - customer_file_time
+    if age > customer_data_max_age:
+        logger.info(f"The CustomerData in {customer_file} is {age / 3600:.1f} hours old, so it will be fetched from Prodis for every target.")
+        return False
+    logger.info(f"CustomerData will be taken from {customer_file}. Prodis is only asked for it if a reprovision attempt fails.")
+    return True
+
+
+class ProgressJournal:
+    """
+    Append-only journal of reprovision outcomes, one "customer_id,outcome" line per attempt. Lines are fsynced in batches of journal_sync_every.
+
+    Args:
+        path | String representing the path of the journal file.
+        append | Boolean. If True, the existing journal is continued. Otherwise it is replaced by a new one.
+        heartbeat_path | Optional string representing the path of a shard's claim file, touched on every sync to show the run is still alive.
+    """
+
+    def __init__(self, path, append, heartbeat_path=None):
+        self.heartbeat_path = heartbeat_path
+        self.journal = open(path, 'a' if append else 'w')
+        self.journal.write(f"# run started {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
+        self.unsynced = 0
+        self.lock = threading.Lock()
+
+    def record(self, customer_id, outcome):
+        """Appends the outcome of one reprovision attempt."""
+
+        with self.lock:
+            self.journal.write(f"{customer_id},{outcome}\n")
+            self.unsynced += 1
+            if self.unsynced >= journal_sync_every:
+                self.sync()
+
+    def sync(self):
+        """Forces everything recorded so far onto disk."""
+
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.unsynced = 0
+        if self.heartbeat_path:
+            try:
+                os.utime(self.heartbeat_path)
+            except FileNotFoundError:
+                logger.error(f"{self.heartbeat_path} has gone. Another manual run may have taken over this shard.")
+
+    def close(self):
+        """Syncs and closes the journal."""
+
+        with self.lock:
+            self.sync()
+            self.journal.close()
+
+
+class PayloadJournal:
+    """
+    Records the put requests of a dry run, as gzip-compressed JSON lines holding the customer id and the exact body that would have been sent.
+
+    Args:
+        path | String representing the path of the payload journal. An existing journal is replaced.
+    """
+
+    def __init__(self, path):
+        self.journal = gzip.open(path, 'wt', encoding='utf-8')
+        self.lock = threading.Lock()
+
+    def record(self, customer_id, body):
+        """Appends one put request."""
+
+        line = json.dumps({"customer_id": customer_id, "body": body}, separators=(',', ':'))
+        with self.lock:
+            self.journal.write(line + "\n")
+
+    def close(self):
+        """Flushes and closes the payload journal."""
+
+        with self.lock:
+            self.journal.close()
+
+
+def readPayloadJournal(path):
+    """
+    Reads back the put requests recorded by a dry run.
+
+    Args:
+        path | String representing the path of the payload journal.
+
+    Yields:
+        entry | A dict with the "customer_id" and "body" of each recorded put request, in the order they were made.
+    """
+
+    with gzip.open(path, 'rt', encoding='utf-8') as journal:
+        for line in journal:
+            yield json.loads(line)
+
+
+def startDryRun():
+    """
+    Switches this run to a dry run.
+
+    Modifies:
+        payload_journal | Set to a new PayloadJournal writing to payload_journal_file.
+        journal_file | Set to dry_run_journal_file.
+    """
+
+    global payload_journal, journal_file
+    logger.info(f"Dry run: put requests will be recorded in {payload_journal_file} instead of being sent to Prodis, and no ticket will be raised.")
+    payload_journal = PayloadJournal(payload_journal_file)
+    journal_file = dry_run_journal_file
+
+
+def readJournal(journal_path=None):
+    """
+    Reads the progress journal left by earlier runs.
+
+    Args:
+        journal_path | Optional string representing the path of the journal. Defaults to journal_file.
+
+    Returns:
+        outcomes | A dict mapping each customer ID in the journal to the outcome of its most recent reprovision attempt.
+    """
+
+    journal_path = journal_path or journal_file
+    outcomes = {}
+    try:
+        with open(journal_path, 'r') as journal:
+            for line in journal:
+                if line.startswith('#') or ',' not in line:
+                    continue
+                customer_id, outcome = line.rstrip('\n').rsplit(',', 1)
+                outcomes[customer_id] = outcome
+    except FileNotFoundError:
+        logger.info(f"No {journal_path} found. All targets will be attempted.")
+    return outcomes
+
+
+def startReprovisionLoop(skip_get=False, resume=False, prefetched_customer_data=None, journal_path=None, claim_path=None):
+    """
+    Makes a reprovision attempt for every reprovision target, using a bounded pool of worker threads and a shared rate limit on Prodis requests.
+    Prodis has no endpoint for updating several customers at once, so each target still gets its own put request.
+    The outcome of each attempt is recorded in the progress journal as it completes.
+
+    Args:
+        skip_get | Boolean. If True, each target's CustomerData is taken from target_customer_data rather than fetched from Prodis first.
+        resume | Boolean. If True, targets the journal records as already reprovisioned are skipped and the journal is appended to.
+                 Otherwise a new journal is started.
+        prefetched_customer_data | Optional dict mapping customer IDs to CustomerData already fetched from Prodis, used when skip_get is False.
+        journal_path | Optional string representing the path of the progress journal. Defaults to journal_file.
+        claim_path | Optional string representing the path of the claim file of the shard being processed, touched whenever the journal is synced.
+
+    Modifies:
+        reprovision_results | Dict mapping the customer ID of each reprovision target to the outcome of its reprovision attempt.
+        history_store | If open, the outcomes of this loop are added to it in one batch.
+    """
+
+    completed_targets = set()
+    if resume:
+        completed_targets = {customer_id for customer_id, outcome in readJournal(journal_path).items() if outcome == "success"}
+        logger.info(f"Resuming an interrupted run. {len(completed_targets & reprovision_targets.keys())} targets were already reprovisioned and will be skipped.")
+    logger.info(f"Looping through all targets to make a reprovision attempt for each, using {max_workers} workers and at most {max_requests_per_second} requests per second.")
+    rate_limiter = RateLimiter(max_requests_per_second)
+    known_customer_data = target_customer_data if skip_get else (prefetched_customer_data or {})
+    journal = ProgressJournal(journal_path or journal_file, resume, claim_path)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(handleReprovision, customer_id, specifiedQuota, rate_limiter, known_customer_data.get(customer_id)): customer_id
+                       for customer_id, specifiedQuota in reprovision_targets.items() if customer_id not in completed_targets}
+            for future in as_completed(futures):
+                customer_id = futures[future]
+                reprovision_results[customer_id] = future.result()
+                journal.record(customer_id, reprovision_results[customer_id])
+    finally:
+        journal.close()
+        if history_store is not None:
+            history_store.recordReprovisions(reprovision_results.items())
+    successCount = sum(1 for outcome in reprovision_results.values() if outcome == "success")
+    logger.info(f"{successCount} of {len(reprovision_results)} reprovision attempts succeeded.")
+
+
+def handleReprovision(customer_id, specifiedQuota, rate_limiter, file_customer_data=None):
+    """
+    For a given customer, calls the functions to get the proper data for a put request, and the function to make the put request.
+    If CustomerData is already known, from the customer file or fetched earlier, the put request is made with it straight away, and Prodis
+    is only asked for the current CustomerData if that attempt fails.
+    
+    Args:
+        customer_id | A string representing the id of a specific customer.
+        specifiedQuota | Integer representing how many minutes of NPVR the customer is supposed to have provisioned.
+        rate_limiter | A RateLimiter shared by all workers, waited on before each request to Prodis.
+        file_customer_data | Optional string holding the customer's CustomerData from the customer file, or fetched from Prodis earlier in the run.
+
+    Returns:
+        outcome | String, one of "success", "get_failed", "put_failed" or "error".
+    """
+
+    try:
+        if file_customer_data is not None:
+            countEvent("gets_skipped")
+            rate_limiter.wait()
+            if reprovisionCustomer(customer_id, file_customer_data, specifiedQuota):
+                return "success"
+            customer_logger.info("Fetching CustomerData for customer %s from Prodis to retry the reprovision attempt.", customer_id,
+                                 extra={"customer_id": customer_id})
+        rate_limiter.wait()
+        customer_data = getDataForReprovision(customer_id)
+        if customer_data is None:
+            return "get_failed"
+        rate_limiter.wait()
+        if reprovisionCustomer(customer_id, customer_data, specifiedQuota):
+            return "success"
+        return "put_failed"
+    except Exception as e:
+        logger.error(f"An error occured while reprovisioning customer {customer_id}. Exception object = {e}")
+        countEvent("reprovision_errors")
+        return "error"
+
+
+def getDataForReprovision(customer_id):
+    """
+    Makes a Get request to Prodis to fetch the 'CustomerData' field for the subsequent Put request.
+    
+    Args:
+        customer_id | An integer representing the id of a specific customer. 
+    
+    Returns:
+        customer_data | A string corresponding to a customer. Required for making a put request for that customer.
+    """
+
+    url = f"{prodisURL}/{customer_id}"
+    start = time.perf_counter()
+    response = getSession("prodis").get(url, timeout=getTimeout())
+    recordRequest("GET", time.perf_counter() - start, response.status_code == 200)
+    if response.status_code == 200:
+        root = ET.fromstring(response.content)
+        namespaces = {'ns': 'urn:eventis:crm:2.0'}
+        customer_data = root.find('ns:CustomerData', namespaces).text
+        customer_logger.info("Get request to prodis for customer %s successful.", customer_id, extra={"customer_id": customer_id})
+        return customer_data
+    else:
+        customer_logger.error("Get request to Prodis for customer %s failed.", customer_id, extra={"customer_id": customer_id})
+        return None
+
+
+def reprovisionCustomer(customer_id, customer_data, new_npvr_quota):
+    """
+    Makes a Put request to Prodis to reprovision the customer.
+    
+    Args:
+        customer_id | An integer representing the id of a specific customer.
+        customer_data | A string corresponding to a customer. Required for making a put request for that customer.
+        new_npvr_quota | Integer, representing how many minutes a customer should be provisioned for NPVR. 
+
+    Returns:
+        True if Prodis accepted the put request, otherwise False.
+    """
+
+    xml_data = f'''<?xml version="1.0" encoding="utf-8"?>
+    <Customer id="{customer_id}" xmlns="urn:eventis:crm:2.0" xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+        <NPVRQuota>{new_npvr_quota}</NPVRQuota>
+        <CustomerData>{customer_data}</CustomerData>
+    </Customer>'''
+    if payload_journal is not None:
+        payload_journal.record(customer_id, xml_data)
+        countEvent("puts_recorded")
+        customer_logger.info("Dry run: put request for customer %s recorded instead of sent.", customer_id, extra={"customer_id": customer_id})
+        return True
+    url = f"{prodisURL}/{customer_id}"
+    headers = {'Content-Type': 'application/xml'}
+    start = time.perf_counter()
+    response = getSession("prodis").put(url, data=xml_data, headers=headers, timeout=getTimeout())
+    recordRequest("PUT", time.perf_counter() - start, response.status_code == 200)
+    if response.status_code == 200:
+        customer_logger.info("Attempt to reprovision customer %s succeeded.", customer_id, extra={"customer_id": customer_id})
+        return True
+    else:
+        customer_logger.info("Attempt to reprovision customer %s returned status code %s.", customer_id, response.status_code,
+                             extra={"customer_id": customer_id})
+        return False
+
+
+# -----------------------
+# FIRST MAIN CONTINUATION
+# -----------------------
+
+def findMismatches(customers, bundle_index, incremental=False, engine="python", on_mismatch=None):
+    """
+    Searches for mismatches between actual and intended NPVR provisioning for each customer to build list of reprovision targets.
+    In an incremental scan, customers which were correctly provisioned on the previous incremental run, and whose record and bundles
+    have not changed since, are skipped.
+    
+    Args:
+        customers | A CustomerStore holding every customer from the customer file.
+        bundle_index | A dict mapping each bundle id to its intended NPVR provisioning (in minutes), as built by buildBundleIndex().
+        incremental | Boolean. If True, the snapshot of the previous incremental run is used to skip customers, and a new one is written.
+                      Otherwise every customer is checked and the snapshot is neither read nor written.
+        engine | String, "python" or "numpy". The NumPy engine checks every customer in one vectorised pass and leaves the snapshot untouched.
+        on_mismatch | Optional callable, called with the CustomerRecord and intended NPVR quota of each mismatch as soon as it is found.
+
+    Modifies:
+        reprovision_targets | Dict mapping the customer IDs of customers which will be reprovisioned to the NPVR quota (in minutes) they should have.
+        target_customer_data | Dict mapping the customer IDs of the reprovision targets to their CustomerData from the customer file.
+        history_store | If open, every mismatch found is added to it in one batch.
+    """
+
+    logger.info("Checking all customers for mismatches to build list of reprovision targets.")
+    mismatches = []
+    if engine == "numpy" and importlib.util.find_spec("numpy") is None:
+        logger.error("NumPy is not installed. Falling back to the Python mismatch search.")
+    elif engine == "numpy" and len(bundle_index) > 0:
+        for row, specifiedQuota in findMismatchesVectorized(customers, bundle_index):
+            customer = customers.getRecord(row)
+            reprovision_targets[customer.customer_id] = specifiedQuota
+            target_customer_data[customer.customer_id] = customer.customer_data
+            if history_store is not None:
+                mismatches.append((customer, customer.npvr_quota, specifiedQuota))
+            if on_mismatch:
+                on_mismatch(customer, specifiedQuota)
+        countEvent("customers_scanned", len(customers))
+        if history_store is not None:
+            history_store.recordMismatches(mismatches, bundle_index)
+        return
+    snapshot = loadSnapshot() if incremental else None
+    if snapshot is None:
+        previous_records = {}
+        changed_bundles = set()
+    else:
+        previous_bundle_index, previous_records = snapshot
+        changed_bundles = getChangedBundles(previous_bundle_index, bundle_index)
+        logger.info(f"Incremental scan: {len(changed_bundles)} bundles have changed since the previous run.")
+    customer_records = {}
+    skippedCount = 0
+    for customer in customers:
+        if incremental:
+            # Comparing the quota and subscriptions themselves costs less than working out the intended quota, so a skip saves time.
+            record = (customer.npvr_quota, customer.subscription_ids)
+            if previous_records.get(customer.customer_id) == record and changed_bundles.isdisjoint(customer.subscription_ids):
+                customer_records[customer.customer_id] = record
+                skippedCount += 1
+                continue
+        fileQuota, specifiedQuota = getIntendedNPVR(customer, bundle_index)
+        if fileQuota != specifiedQuota:
+            reprovision_targets[customer.customer_id] = specifiedQuota
+            target_customer_data[customer.customer_id] = customer.customer_data
+            if history_store is not None:
+                mismatches.append((customer, fileQuota, specifiedQuota))
+            if on_mismatch:
+                on_mismatch(customer, specifiedQuota)
+        elif incremental:
+            customer_records[customer.customer_id] = record
+    countEvent("customers_scanned", len(customers))
+    if incremental:
+        logger.info(f"{skippedCount} unchanged customers were skipped.")
+        countEvent("customers_skipped", skippedCount)
+        saveSnapshot(bundle_index, customer_records)
+    if history_store is not None:
+        history_store.recordMismatches(mismatches, bundle_index)
+
+
+def getIntendedNPVR(customer, NPVR_bundle_data):
+    """
+    Determines how many minutes of NPVR a given customer has, and how many they should have.
+    
+    Args:
+        customer | A CustomerRecord, or an xml.dom node, representing a customer.
+        NPVR_bundle_data | A bundle_index as built by buildBundleIndex(), or a list of tuples reflecting the intended NPVR provisioning (in minutes) for each bundle.
+    
+    Returns:
+        fileQuota | Integer representing how many minutes of NPVR the customer currently has provisioned.
+        specifiedQuota | Integer representing how many minutes of NPVR the customer is supposed to have provisioned.
+    """
+
+    if NPVR_bundle_data == None:
+        logger.error("NPVR_bundle_data list is missing. Aborting script.")
+        sys.exit(1)
+    elif len(NPVR_bundle_data) == 0:
+        logger.error("NPVR_bundle_data list is empty. Aborting script.")
+        sys.exit(1)
+    else:
+        # CustomerRecords from the customer file are validated while it is read, so only xml.dom nodes still need converting here.
+        if not isinstance(customer, CustomerRecord):
+            customer = parseCustomerNode(customer)
+        if isinstance(NPVR_bundle_data, dict):
+            bundle_index = NPVR_bundle_data
+        else:
+            bundle_index = buildBundleIndex(NPVR_bundle_data)
+        fileQuota = customer.npvr_quota
+        specifiedQuota = 0
+        for subscription_id in customer.subscription_ids:
+            bundle_npvr = bundle_index.get(subscription_id, 0)
+            if specifiedQuota < bundle_npvr:
+                specifiedQuota = bundle_npvr
+        return fileQuota, specifiedQuota
+
+
+def getDeterminingBundle(customer, bundle_index, specifiedQuota):
+    """
+    Finds the subscription which gives a customer their intended NPVR provisioning.
+
+    Args:
+        customer | A CustomerRecord.
+        bundle_index | A dict mapping each bundle id to its intended NPVR provisioning (in minutes), as built by buildBundleIndex().
+        specifiedQuota | Integer representing how many minutes of NPVR the customer is supposed to have provisioned.
+
+    Returns:
+        bundle_id | Integer id of the bundle, or None if the customer has no bundle with NPVR.
+    """
+
+    if not specifiedQuota:
+        return None
+    return max(customer.subscription_ids, key=lambda subscription_id: bundle_index.get(subscription_id, 0), default=None)
+
+
+def findMismatchesVectorized(customers, bundle_index):
+    """
+    Applies the rule in getIntendedNPVR to every customer at once: each subscription is looked up in a sorted bundle table,
+    the highest NPVR provisioning is taken per customer, and the result is compared with the quotas from the customer file.
+
+    Args:
+        customers | A CustomerStore holding every customer from the customer file.
+        bundle_index | A dict mapping each bundle id to its intended NPVR provisioning (in minutes), as built by buildBundleIndex(). Must not be empty.
+
+    Returns:
+        mismatches | A list of (row, specifiedQuota) tuples for every mismatched customer, in file order.
+    """
 
-pendenzenURL = "REDACTED"
-prodisURL = "REDACTED"
-preprod_prodisURL = "REDACTED"
-headers = {"X-Atlassian-Token": "no-check"}
-auth = ('REDACTED', 'REDACTED')
+    import numpy as np
+    file_quotas = np.frombuffer(customers.npvr_quotas, dtype=np.int64)
+    offsets = np.frombuffer(customers.subscription_offsets, dtype=np.int64)
+    subscription_ids = np.frombuffer(customers.subscription_ids, dtype=np.int64)
+    bundle_ids = np.fromiter(bundle_index.keys(), dtype=np.int64, count=len(bundle_index))
+    bundle_npvr = np.fromiter(bundle_index.values(), dtype=np.int64, count=len(bundle_index))
+    order = np.argsort(bundle_ids)
+    bundle_ids = bundle_ids[order]
+    bundle_npvr = bundle_npvr[order]
 
-cutoff = 25
-reprovision_targets = []
+    # NPVR provisioning of every subscription. Products which aren't bundles count as 0, as do negative values.
+    positions = np.minimum(np.searchsorted(bundle_ids, subscription_ids), len(bundle_ids) - 1)
+    subscription_npvr = np.where(bundle_ids[positions] == subscription_ids, bundle_npvr[positions], 0)
+    subscription_npvr = np.maximum(subscription_npvr, 0)
+
+    # Highest value per customer. Customers without subscriptions keep 0. Empty segments are left out of reduceat,
+    # so each remaining start index reduces exactly one customer's subscriptions.
+    specified_quotas = np.zeros(len(file_quotas), dtype=np.int64)
+    has_subscriptions = np.diff(offsets) > 0
+    if has_subscriptions.any():
+        specified_quotas[has_subscriptions] = np.maximum.reduceat(subscription_npvr, offsets[:-1][has_subscriptions])
+
+    rows = np.flatnonzero(file_quotas != specified_quotas)
+    return list(zip(rows.tolist(), specified_quotas[rows].tolist()))
 
 
-def main():
+def getChangedBundles(previous_bundle_index, bundle_index):
     """
-    Main function for the reprovision_quota.py script. 
-    This script is for the purpose of correcting mistakes in Quickline customers NPVR (Network Personal Video Recording) provisioning.
-    Mismatches are detected from customer files and fixed. 
+    Finds the bundles whose intended NPVR provisioning differs between two bundle indexes, including bundles which were added or removed.
 
-    This script has three paths:
-    1. Main: Default path that detects mismatches and reprovisions.
-    2. Manual: Path for a manual script run. Does not detect mismatches, but reprovisions based on the content of manual_reprovision_targets.csv.
-    3. Abort: Path for when the number of misprovisioned customers is above a cutoff. Raises alert and prepares manual_reprovision_targets.csv for manual run.
+    Args:
+        previous_bundle_index | The bundle_index from the previous run.
+        bundle_index | The bundle_index from this run.
+
+    Returns:
+        changed_bundles | A set of bundle ids (integers).
+    """
+
+    all_bundles = previous_bundle_index.keys() | bundle_index.keys()
+    return {bundle_id for bundle_id in all_bundles if previous_bundle_index.get(bundle_id) != bundle_index.get(bundle_id)}
+
+
+def loadSnapshot():
+    """
+    Loads the snapshot written by the previous incremental run.
+
+    Returns:
+        (previous_bundle_index, previous_records) | The previous run's bundle_index, and a dict mapping each correctly provisioned customer's id
+                                                    to a tuple of its NPVR quota and subscription product ids.
+        None if there is no usable snapshot, in which case every customer is checked.
     """
 
-    # Main branch.
     try:
-        manual_run = checkIfManualRun()
-        logger.info("reprovision_quota.py has been run. Hello!")
-        customers = getLatestCustomerFile()
-        NPVR_bundle_data = getNPVR_bundle_data()
-        if manual_run == True:
-            # Side branch 1: Manual.
-            logger.info("Beginning manual branch.")
-            readManualTargetList()
-            clearManualTargetList()
-            startReprovisionLoop(customers, NPVR_bundle_data)
-            logger.info("Customer reprovisioning attempts complete. Manual run has concluded. ")
-        else:
-            # Continuation of main branch. Search for mismatches and then continue or abort.
-            findMismatches(customers, NPVR_bundle_data)
-            logger.info("Checking number of reprovision targets against cutoff.")
-            mismatchCount = len(reprovision_targets)
-            if mismatchCount > cutoff:
-                # Side branch 2: Abort.
-                logger.info(f"Number of reprovision targets exceeds {cutoff}. No automatic reprovision will be attempted.")
-                logMismatchedCustomers(mismatchCount)
-                writeManualTargetList()
-                createNewTicket(mismatchCount)
-                logger.info("Script concluding without reprovisioning mismatched customers. A manual script run, by running the script with the '--manual' argument, is required.")
-            else:
-                # Continuation of main branch: Reprovision mismatched customers.
-                startReprovisionLoop(customers, NPVR_bundle_data)
-                logger.info("Customer reprovisioning attempts complete.")
+        with open(snapshot_file, 'r') as snapshot:
+            data = json.load(snapshot)
+        if "records" not in data:
+            logger.info(f"{snapshot_file} was written by an older version of the script. All customers will be checked.")
+            return None
+        previous_bundle_index = {int(bundle_id): bundle_npvr for bundle_id, bundle_npvr in data["bundles"].items()}
+        previous_records = {customer_id: (npvr_quota, tuple(subscription_ids)) for customer_id, (npvr_quota, subscription_ids) in data["records"].items()}
+        return previous_bundle_index, previous_records
+    except FileNotFoundError:
+        logger.info(f"No {snapshot_file} found. All customers will be checked.")
     except Exception as e:
-        logger.error(f"An error occured during the running of this script. Exception object = {e}")
-        sys.exit(1)
+        logger.error(f"Error reading {snapshot_file}. All customers will be checked. Exception object = {e}")
+    return None
 
-# -----------------
-# INITIAL FUNCTIONS
-# -----------------
 
-def getLatestCustomerFile():
+def saveSnapshot(bundle_index, customer_records):
     """
-    Fetches the latest customer file, stores the data in variable 'customers', and returns it.
+    Writes the snapshot used by the next run. The file is replaced atomically, so an interrupted write never leaves a corrupt snapshot behind.
 
-    Returns:
-        customers | An xml.dom nodelist where each node represents a customer from the XML file.
+    Args:
+        bundle_index | A dict mapping each bundle id to its intended NPVR provisioning (in minutes), as built by buildBundleIndex().
+        customer_records | A dict mapping each correctly provisioned customer's id to a tuple of its NPVR quota and subscription product ids.
     """
 
-    logger.info("Fetching latest customer list from /home/divitel/customerfiles.")
-    list_of_files = glob.glob('/home/divitel/customerfiles/*.xml')
-    latest_file = max(list_of_files, key=os.path.getctime)
-    xml = minidom.parse(latest_file)
-    customers = xml.getElementsByTagName("Customer")
-    return customers
+    try:
+        with open(snapshot_file + '.tmp', 'w') as snapshot:
+            json.dump({"bundles": bundle_index, "records": customer_records}, snapshot, separators=(',', ':'))
+        os.replace(snapshot_file + '.tmp', snapshot_file)
+    except Exception as e:
+        logger.error(f"Error writing {snapshot_file}. The next run will check all customers. Exception object = {e}")
 
 
-def getNPVR_bundle_data():
+# -------------
+# PARALLEL LOAD
+# -------------
+
+def loadInParallel(customer_file, workers):
     """
-    Fetches data on how many NPVR hours a given bundle should have, and stores this in variable 'NPVR_bundle_data' after converting it to minutes.
-    
+    Parses the customer file using a pool of processes, each of which reads its own byte range of the file into a CustomerStore.
+    The partial stores are merged in file order, so the result is identical to a serial read.
+
+    Args:
+        customer_file | String representing the path of the customer file.
+        workers | Integer number of processes to use.
+
     Returns:
-        NPVR_bundle_data | A list of tuples reflecting the intended NPVR provisioning (in minutes) for each bundle. 
+        customers | A CustomerStore holding every valid customer from the customer file, in file order.
+        quarantined | A list holding an entry for each customer which failed validation, in file order.
     """
 
-    logger.info("Fetching data on bundles and intended NPVR provisioning.")
-    connection = mysql.connector.connect(host=HOST, user=USER, password=PASSWORD, port=PORT)
-    myCursor = connection.cursor()
-    myCursor.execute("SELECT bundle_id, npvr*60 FROM divitel_config_validator.product_bundle;")
-    NPVR_bundle_data = myCursor.fetchall()
-    connection.close()
-    return NPVR_bundle_data
+    shards, root_tag = getShards(customer_file, workers * shards_per_worker)
+    logger.info(f"Reading {len(shards)} shards of the customer file using {workers} processes.")
+    customers = CustomerStore()
+    quarantined = []
+    shard_args = [(customer_file, start, end, root_tag) for start, end in shards]
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for shard_customers, shard_quarantined in executor.map(loadShard, shard_args):
+            customers.extend(shard_customers)
+            quarantined.extend(shard_quarantined)
+    return customers, quarantined
 
 
-def checkIfManualRun():
+def getShards(customer_file, shard_count):
     """
-    Checks sys.args to determine if this is a manual run.
-    
-    Returns either True or False and assigns it to the manual_run variable so the script knows which type of run it is.
+    Splits the customer file into byte ranges which each start at a <Customer> element. Each ends where the next one starts,
+    and the last one at the closing tag of the root element.
+
+    Args:
+        customer_file | String representing the path of the customer file.
+        shard_count | Integer number of shards wanted. Fewer are returned if the file has fewer customers.
+
+    Returns:
+        shards | A list of (start, end) byte offsets, in file order.
+        root_tag | Bytes holding an XML declaration and a start tag that re-declares the file's namespaces. Each shard is parsed inside it.
+
+    Raises:
+        ET.ParseError | If the file isn't empty but no customer boundaries were found in it, so that the caller can read it serially instead.
     """
 
-    if len(sys.argv) == 1:
-        return False
-    elif len(sys.argv) == 2 and sys.argv[1] == '--manual':
-        logger.info("Script has been run manually. Reprovisioning will occur based on the contents of manual_reprovision_targets.csv")
-        return True
-    elif len(sys.argv) == 2 and sys.argv[1] != '--manual':
-        logger.error("The wrong sys.arg has been provided. Please provide either no sys.args, or '--manual'.")
-        sys.exit(1)
-    elif len(sys.argv) > 2:
-        logger.error("Too many sys.args have been provided. This script accepts either no sys.args, or '--manual'.")
-        sys.exit(1)
-    else:
-        logger.error("Unspecified issue with sys.args. Please provide either no sys.args, or '--manual'.")
-        sys.exit(1)
+    with open(customer_file, 'rb') as xml_file:
+        if os.fstat(xml_file.fileno()).st_size == 0:
+            return [], b''
+        with mmap.mmap(xml_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            customer_start = re.compile(rb'<Customer[\s/>]')
+            first = customer_start.search(data)
+            if first is None:
+                # Customer elements with a namespace prefix, such as <c:Customer>, can't be found by a byte search.
+                raise ET.ParseError(f"No <Customer> element without a namespace prefix was found in {customer_file}")
+            # The last shard ends at the closing tag of the root element, so that it holds the last customer whether or not it is self-closing.
+            end = data.rfind(b'</')
+            if end < first.start():
+                raise ET.ParseError(f"No closing tag of the root element was found after the customers in {customer_file}")
+            boundaries = [first.start()]
+            for shard in range(1, shard_count):
+                match = customer_start.search(data, boundaries[0] + (end - boundaries[0]) * shard // shard_count)
+                if match is None or match.start() >= end:
+                    break
+                if match.start() > boundaries[-1]:
+                    boundaries.append(match.start())
+            boundaries.append(end)
+            header = data[:boundaries[0]]
+    declaration = re.match(rb'\s*(<\?xml[^>]*\?>)', header)
+    namespaces = dict(re.findall(rb'\s(xmlns(?::[\w.-]+)?)="([^"]*)"', header))
+    root_tag = (declaration.group(1) if declaration else b'') + b'<shard' + b''.join(
+        b' %s="%s"' % (name, uri) for name, uri in namespaces.items()) + b'>'
+    return list(zip(boundaries, boundaries[1:])), root_tag
 
 
-# -----------
-# MANUAL PATH
-# -----------
+def loadShard(shard_args):
+    """
+    Parses one shard of the customer file into a CustomerStore. Runs in a worker process.
 
-def readManualTargetList():
-    """Reads external target list file to build list of reprovision targets for a manual run."""
+    Args:
+        shard_args | A tuple of (customer_file, start, end, root_tag), as described in getShards().
 
-    logger.info("Reading manual_reprovision_targets.csv to build list of reprovision targets.")
-    try:
-        with open('manual_reprovision_targets.csv', 'r') as target_list:
-            csv_reader = csv.reader(target_list, delimiter=',')
-            for row in csv_reader:
-                reprovision_targets.append(row[0])
-    except Exception as e:
-        logger.error(f"Error, likely because no manual_reprovision_targets.csv was found. Exception object = {e}")
+    Returns:
+        customers | A CustomerStore holding the valid customers of the shard, in file order.
+        quarantined | A list holding an entry for each customer of the shard which failed validation.
+    """
 
+    customer_file, start, end, root_tag = shard_args
+    customers = CustomerStore()
+    quarantined = []
+    for customer in readCustomerEvents(readShardEvents(customer_file, start, end, root_tag), quarantined):
+        customers.append(customer)
+    return customers, quarantined
 
-def clearManualTargetList():
-    """Clears the external target list"""
 
-    logger.info("Clearing manual_reprovision_targets.csv")
-    try:
-        with open('manual_reprovision_targets.csv', 'w'):
-            pass
-        logger.info("manual_reprovision_targets.csv has been cleared.")
-    except Exception as e:
-        logger.error(f"Error clearing manual_reprovision_targets.csv. Exception object = {e}")
+def readShardEvents(customer_file, start, end, root_tag):
+    """
+    Incrementally parses one byte range of the customer file, wrapped in root_tag so that it forms a complete XML document.
 
+    Args:
+        customer_file | String representing the path of the customer file.
+        start | Integer byte offset at which the shard begins.
+        end | Integer byte offset at which the shard ends.
+        root_tag | Bytes to feed the parser before the shard, as returned by getShards().
+
+    Yields:
+        (event, element) | ElementTree 'start' and 'end' events.
+    """
+
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    parser.feed(root_tag)
+    with open(customer_file, 'rb') as xml_file:
+        xml_file.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = xml_file.read(min(shard_read_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            parser.feed(chunk)
+            yield from parser.read_events()
+    parser.feed(b'</shard>')
+    parser.close()
+    yield from parser.read_events()
 
-# --------------
-# REPROVISIONING
-# --------------
 
-def startReprovisionLoop(customers, NPVR_bundle_data):
+# -------------
+# PIPELINED RUN
+# -------------
+
+async def runPipeline(args):
     """
-    Begins looping through all customers and calling necessary functions to reprovision each.
+    Runs the main path with its stages overlapped, for '--pipeline'.
+    The bundle query runs in the background while the customer file is found and read. While mismatches are searched for, the first cutoff
+    of them are queued and their CustomerData is fetched from Prodis by max_workers workers. No put request is made until the search
+    has finished and the number of mismatches is known to be within the cutoff. Otherwise the run aborts as usual.
 
     Args:
-        customers | An xml.dom nodelist where each node represents a customer from the XML file.
-        NPVR_bundle_data | A list of tuples reflecting the intended NPVR provisioning (in minutes) for each bundle. 
+        args | The argparse.Namespace returned by parseArguments().
+
+    Modifies:
+        reprovision_targets | Dict mapping the customer IDs of customers which will be reprovisioned to the NPVR quota (in minutes) they should have.
+        reprovision_results | Dict mapping the customer ID of each reprovision target to the outcome of its reprovision attempt.
     """
 
-    logger.info("Looping through all targets to make a reprovision attempt for each.")
-    for customer in customers:
-        handleReprovision(customer, NPVR_bundle_data)
+    import asyncio
+    logger.info("Running the main path as a pipeline.")
+    loop = asyncio.get_running_loop()
+    bundle_task = asyncio.create_task(asyncio.to_thread(runStage, "get_npvr_bundle_data", lambda: buildBundleIndex(getNPVR_bundle_data())))
+    customer_file = await asyncio.to_thread(runStage, "get_latest_customer_file", getLatestCustomerFile)
+    run_metrics["customer_file"] = customer_file
+    customers = await asyncio.to_thread(runStage, "load_customers", loadCustomerStore, customer_file, args.workers)
+    countEvent("customers_loaded", len(customers))
+    bundle_index = await bundle_task
+
+    skip_get = canSkipGet(customer_file, args.skip_get)
+    completed_targets = set()
+    if args.resume:
+        completed_targets = {customer_id for customer_id, outcome in readJournal().items() if outcome == "success"}
+    # Only the first cutoff mismatches are ever queued, plus one end marker per worker waiting to be taken.
+    queue = asyncio.Queue(maxsize=cutoff + max_workers)
+    queued_targets = set()
+    prefetched_customer_data = {}
+    rate_limiter = RateLimiter(max_requests_per_second)
+    early_abort = EarlyAbort(bundle_index) if args.early_abort else None
+
+    def queueMismatch(customer, specifiedQuota):
+        # Called from the thread running findMismatches().
+        if early_abort:
+            early_abort.record(customer, specifiedQuota)
+        customer_id = customer.customer_id
+        if skip_get or customer_id in completed_targets or customer_id in queued_targets or len(queued_targets) >= cutoff:
+            return
+        queued_targets.add(customer_id)
+        loop.call_soon_threadsafe(queue.put_nowait, customer_id)
+
+    workers = [asyncio.create_task(prefetchWorker(queue, prefetched_customer_data, rate_limiter)) for _ in range(max_workers)]
+    try:
+        await asyncio.to_thread(runStage, "find_mismatches", findMismatches, customers, bundle_index, args.incremental and not args.full_rescan, args.engine, queueMismatch)
+    finally:
+        for _ in workers:
+            await queue.put(None)
+    logger.info("Checking number of reprovision targets against cutoff.")
+    mismatchCount = len(reprovision_targets)
+    countEvent("mismatches", mismatchCount)
+    if mismatchCount > cutoff:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        await asyncio.to_thread(abortRun, mismatchCount, early_abort)
+        return
+    with timeStage("prefetch_wait"):
+        await asyncio.gather(*workers)
+    await asyncio.to_thread(runStage, "start_reprovision_loop", startReprovisionLoop, skip_get, args.resume, prefetched_customer_data)
+    run_metrics["outcome"] = "reprovisioned"
+    logger.info("Customer reprovisioning attempts complete.")
 
 
-def handleReprovision(customer, NPVR_bundle_data):
+async def prefetchWorker(queue, prefetched_customer_data, rate_limiter):
     """
-    For a given customer, calls the functions to get the proper data for a put request, and the function to make the put request.
-    
+    Takes customer IDs from the queue and fetches their CustomerData from Prodis, until it takes None.
+    Once the number of reprovision targets is over the cutoff, queued IDs are dropped, as the run will abort.
+
     Args:
-        customer | an xml.dom node representing a customer. 
-        NPVR_bundle_data | A list of tuples reflecting the intended NPVR provisioning (in minutes) for each bundle. 
+        queue | An asyncio.Queue of customer IDs.
+        prefetched_customer_data | Dict that each customer's fetched CustomerData is added to.
+        rate_limiter | A RateLimiter shared by all workers, waited on before each request to Prodis.
     """
 
-    customer_id = customer.getAttribute("id")
-    fileQuota, specifiedQuota = getIntendedNPVR(customer, NPVR_bundle_data)
-    for target_id in reprovision_targets:
-        if target_id == customer_id:
-            customer_data = getDataForReprovision(customer_id)
-            if customer_data is not None:
-                reprovisionCustomer(customer_id, customer_data, specifiedQuota)
+    import asyncio
+    while True:
+        customer_id = await queue.get()
+        if customer_id is None:
+            return
+        if len(reprovision_targets) > cutoff:
+            continue
+        customer_data = await asyncio.to_thread(prefetchCustomerData, customer_id, rate_limiter)
+        if customer_data is not None:
+            prefetched_customer_data[customer_id] = customer_data
 
 
-def getDataForReprovision(customer_id):
+def prefetchCustomerData(customer_id, rate_limiter):
     """
-    Makes a Get request to Prodis to fetch the 'CustomerData' field for the subsequent Put request.
-    
+    Fetches a customer's CustomerData from Prodis ahead of its reprovision attempt. Failures are logged, and leave the get request
+    to be made again by handleReprovision().
+
     Args:
-        customer_id | An integer representing the id of a specific customer. 
-    
+        customer_id | A string representing the id of a specific customer.
+        rate_limiter | A RateLimiter shared by all workers, waited on before the request.
+
     Returns:
-        customer_data | A string corresponding to a customer. Required for making a put request for that customer.
+        customer_data | The customer's CustomerData, or None if it could not be fetched.
     """
 
-    url = f"{prodisURL}/{customer_id}"
-    response = requests.get(url)
-    if response.status_code == 200:
-        root = ET.fromstring(response.content)
-        namespaces = {'ns': 'urn:eventis:crm:2.0'}
-        customer_data = root.find('ns:CustomerData', namespaces).text
-        logger.info(f"Get request to prodis for customer {customer_id} successful.")
-        return customer_data
-    else:
-        logger.error(f"Get request to Prodis for customer {customer_id} failed.")
+    try:
+        rate_limiter.wait()
+        customer_data = getDataForReprovision(customer_id)
+    except Exception as e:
+        logger.error(f"An error occured while fetching CustomerData for customer {customer_id}. Exception object = {e}")
         return None
+    if customer_data is not None:
+        countEvent("gets_prefetched")
+    return customer_data
 
 
-def reprovisionCustomer(customer_id, customer_data, new_npvr_quota):
+def runStage(stage, function, *args):
     """
-    Makes a Put request to Prodis to reprovision the customer.
-    
-    Args:
-        customer_id | An integer representing the id of a specific customer.
-        customer_data | A string corresponding to a customer. Required for making a put request for that customer.
-        new_npvr_quota | Integer, representing how many minutes a customer should be provisioned for NPVR. 
+    Calls function(*args) inside timeStage(stage), so that a stage run on a worker thread is still timed.
+
+    Returns:
+        The return value of function.
     """
 
-    xml_data = f'''<?xml version="1.0" encoding="utf-8"?>
-    <Customer id="{customer_id}" xmlns="urn:eventis:crm:2.0" xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
-        <NPVRQuota>{new_npvr_quota}</NPVRQuota>
-        <CustomerData>{customer_data}</CustomerData>
-    </Customer>'''
-    url = f"{prodisURL}/{customer_id}"
-    headers = {'Content-Type': 'application/xml'}
-    response = requests.put(url, data=xml_data, headers=headers)
-    if response.status_code == 200:
-        logger.info(f"Attempt to reprovision customer {customer_id} succeeded.")
-    else:
-        logger.info(f"Attempt to reprovision customer {customer_id} returned status code {response.status_code}.")
+    with timeStage(stage):
+        return function(*args)
 
 
-# -----------------------
-# FIRST MAIN CONTINUATION
-# -----------------------
+# ----------------------
+# MULTI-ENVIRONMENT RUNS
+# ----------------------
 
-def findMismatches(customers, NPVR_bundle_data):
+def loadConfig(config_file):
     """
-    Searches for mismatches between actual and intended NPVR provisioning for each customer to build list of reprovision targets.
-    
+    Reads and checks a '--config' file. The file holds a list of environments, for example:
+        {"environments": [{"name": "prod", "customer_file_dir": "/home/divitel/customerfiles"},
+                          {"name": "preprod", "customer_file_dir": "/home/divitel/preprod_customerfiles", "prodis_url": "preprod",
+                           "bundle_table": "divitel_config_validator_preprod.product_bundle", "cutoff": 100}]}
+    Each environment needs a unique name. It may set work_dir, the directory its cache, snapshot, journal, target list and report are kept in
+    (defaults to its name), and any of the keys in environment_settings. Settings it leaves out keep their default values.
+
     Args:
-        customers | An xml.dom nodelist where each node represents a customer from the XML file.
-        NPVR_bundle_data | A list of tuples reflecting the intended NPVR provisioning (in minutes) for each bundle.
+        config_file | String representing the path of the config file.
+
+    Returns:
+        environments | A list of dicts, one per environment.
+    """
+
+    with open(config_file, 'r') as config:
+        environments = json.load(config)["environments"]
+    names = set()
+    for environment in environments:
+        unknown_settings = set(environment) - set(environment_settings) - {"name", "work_dir"}
+        if unknown_settings:
+            raise ValueError(f"Unknown settings {sorted(unknown_settings)} for environment {environment.get('name')} in {config_file}.")
+        if not environment.get("name") or environment["name"] in names:
+            raise ValueError(f"Every environment in {config_file} needs a unique name.")
+        names.add(environment["name"])
+    return environments
+
+
+def runEnvironments(args):
+    """
+    Runs every environment in the config file concurrently, each in a new process of its own, and combines their run reports.
+    A process is never reused for a second environment, so no targets, journals or settings can leak from one environment to another.
+    Environments are independent of each other: one failing does not stop the others, but makes this run exit with 1.
+
+    Args:
+        args | The argparse.Namespace returned by parseArguments(). args.config is the path of the config file.
 
     Modifies:
-        reprovision_targets | List containing customer IDs of customers which will be reprovisioned. 
+        run_metrics | Holds the report of each environment under "environments", and the counts of all environments added together.
     """
 
-    logger.info("Checking all customers for mismatches to build list of reprovision targets.")
-    for customer in customers:
-        customer_id = customer.getAttribute("id")
-        fileQuota, specifiedQuota = getIntendedNPVR(customer, NPVR_bundle_data)
-        if fileQuota != specifiedQuota:
-            reprovision_targets.append(customer_id)
+    environments = loadConfig(args.config)
+    logger.info(f"Running {len(environments)} environments from {args.config}: {', '.join(environment['name'] for environment in environments)}.")
+    run_metrics["environments"] = {}
+    # Forked processes start with this module already imported, so no environment pays for interpreter startup and imports again.
+    import multiprocessing
+    import multiprocessing.connection
+    mp_context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else None)
+    processes = {}
+    for environment in environments:
+        receiver, sender = mp_context.Pipe(duplex=False)
+        process = mp_context.Process(target=runEnvironmentProcess, args=(environment, args, sender), name=f"environment-{environment['name']}")
+        process.start()
+        sender.close()
+        processes[receiver] = (environment["name"], process)
+    while processes:
+        for receiver in multiprocessing.connection.wait(list(processes)):
+            name, process = processes.pop(receiver)
+            try:
+                report = receiver.recv()
+            except EOFError:
+                process.join()
+                report = {"outcome": "failed", "error": f"Its process exited with code {process.exitcode} without a report."}
+            receiver.close()
+            process.join()
+            if "error" in report:
+                logger.error(f"Environment {name} could not be run. {report['error']}")
+            run_metrics["environments"][name] = report
+            for event, count in report.get("counts", {}).items():
+                countEvent(event, count)
+            logger.info(f"Environment {name} finished with outcome {report['outcome']}.")
+    failedEnvironments = [name for name, report in run_metrics["environments"].items() if report["outcome"] == "failed"]
+    if failedEnvironments:
+        logger.error(f"Environments {', '.join(sorted(failedEnvironments))} failed.")
+        sys.exit(1)
+    run_metrics["outcome"] = "completed"
 
 
-def getIntendedNPVR(customer, NPVR_bundle_data):
+def runEnvironmentProcess(environment, args, connection):
     """
-    Determines how many minutes of NPVR a given customer has, and how many they should have.
-    
+    Entry point of the process started for one environment by runEnvironments(). Sends the environment's run report back to the parent.
+
     Args:
-        customer | an xml.dom node representing a customer.
-        NPVR_bundle_data | A list of tuples reflecting the intended NPVR provisioning (in minutes) for each bundle.
-    
+        environment | A dict of settings for the environment, as returned by loadConfig().
+        args | The argparse.Namespace returned by parseArguments().
+        connection | The sending end of a multiprocessing Pipe.
+    """
+
+    try:
+        report = runEnvironment(environment, args)
+    except Exception as e:
+        report = {"outcome": "failed", "error": f"Exception object = {e}"}
+    connection.send(report)
+    connection.close()
+
+
+def runEnvironment(environment, args):
+    """
+    Runs one environment of a '--config' run. Called in a process of its own, so that the settings, caches, HTTP sessions
+    and metrics it changes are its own. Log lines are tagged with the environment's name.
+
+    Args:
+        environment | A dict of settings for the environment, as returned by loadConfig().
+        args | The argparse.Namespace returned by parseArguments().
+
     Returns:
-        fileQuota | Integer representing how many minutes of NPVR the customer currently has provisioned.
-        specifiedQuota | Integer representing how many minutes of NPVR the customer is supposed to have provisioned.
+        report | The environment's run report, as built by buildRunReport().
     """
 
-    if NPVR_bundle_data == []:
-        logger.error("NPVR_bundle_data list is empty. Aborting script.")
-        sys.exit(1)
-    elif NPVR_bundle_data == None:
-        logger.error("NPVR_bundle_data list is missing. Aborting script.")
-        sys.exit(1)     
-    else:
+    global prometheus_textfile, log_environment
+    name = environment["name"]
+    prometheus_textfile = None
+    for setting, value in environment.items():
+        if setting in environment_settings:
+            if setting == "prodis_url":
+                value = {"prod": prodisURL, "preprod": preprod_prodisURL}.get(value, value)
+            globals()[environment_settings[setting]] = value
+    work_dir = os.path.abspath(environment.get("work_dir", name))
+    os.makedirs(work_dir, exist_ok=True)
+    os.chdir(work_dir)
+    log_environment = name
+    startLogListener()
+    configureLogging()
+    http_sessions.clear()
+    for latencies in http_latencies.values():
+        latencies.clear()
+    run_metrics.clear()
+    run_metrics.update({"stages": {}, "counts": {}, "environment": name})
+    try:
+        main(argparse.Namespace(**{**vars(args), "config": None}))
+    except SystemExit:
+        pass
+    return buildRunReport()
+
+
+# -------
+# HISTORY
+# -------
+
+class HistoryStore:
+    """
+    SQLite store of the mismatches and reprovision outcomes of every run, so that drift can be followed across runs with quota_history.py.
+    Each run gets a row in runs. Mismatches and reprovision outcomes are added in batches, and indexed by run, customer and bundle.
+    Alongside the mismatches, running totals per run and bundle (bundle_counts) and per customer (customer_counts) are kept up to date,
+    so that the summary queries don't have to scan months of mismatches. The connection may be used from any thread, one call at a time.
+
+    Args:
+        path | String representing the path of the SQLite database. It is created if it doesn't exist.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS runs (
+            run_id INTEGER PRIMARY KEY,
+            started_at REAL NOT NULL,
+            finished_at REAL,
+            customer_file TEXT,
+            outcome TEXT,
+            mismatch_count INTEGER);
+        CREATE TABLE IF NOT EXISTS mismatches (
+            run_id INTEGER NOT NULL REFERENCES runs(run_id),
+            customer_id TEXT NOT NULL,
+            file_quota INTEGER,
+            intended_quota INTEGER,
+            bundle_id INTEGER);
+        CREATE TABLE IF NOT EXISTS reprovisions (
+            run_id INTEGER NOT NULL REFERENCES runs(run_id),
+            customer_id TEXT NOT NULL,
+            outcome TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS bundle_counts (
+            run_id INTEGER NOT NULL REFERENCES runs(run_id),
+            bundle_id INTEGER,
+            mismatches INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS customer_counts (
+            customer_id TEXT PRIMARY KEY,
+            mismatch_runs INTEGER NOT NULL,
+            first_run_id INTEGER NOT NULL,
+            last_run_id INTEGER NOT NULL);
+        CREATE INDEX IF NOT EXISTS mismatches_by_customer ON mismatches(customer_id, run_id);
+        CREATE INDEX IF NOT EXISTS mismatches_by_bundle ON mismatches(bundle_id, run_id);
+        CREATE INDEX IF NOT EXISTS mismatches_by_run ON mismatches(run_id);
+        CREATE INDEX IF NOT EXISTS reprovisions_by_customer ON reprovisions(customer_id, run_id);
+        CREATE INDEX IF NOT EXISTS reprovisions_by_run ON reprovisions(run_id);
+        CREATE INDEX IF NOT EXISTS bundle_counts_by_bundle ON bundle_counts(bundle_id, run_id, mismatches);
+        CREATE INDEX IF NOT EXISTS customer_counts_by_runs ON customer_counts(mismatch_runs DESC, customer_id);
+        """
+
+    def __init__(self, path):
+        import sqlite3
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.executescript(self.schema)
+            self.run_id = self.connection.execute("INSERT INTO runs (started_at) VALUES (?)", (run_metrics.get("started_at", time.time()),)).lastrowid
+
+    def recordMismatches(self, mismatches, bundle_index):
+        """
+        Adds the mismatches found in this run. Failures are logged rather than raised.
+
+        Args:
+            mismatches | A list of (CustomerRecord, fileQuota, specifiedQuota) tuples.
+            bundle_index | A dict mapping each bundle id to its intended NPVR provisioning (in minutes), used to find each mismatch's determining bundle.
+        """
+
+        rows = [(self.run_id, str(customer.customer_id), fileQuota, specifiedQuota, getDeterminingBundle(customer, bundle_index, specifiedQuota))
+                for customer, fileQuota, specifiedQuota in mismatches]
+        bundle_counts = {}
+        for row in rows:
+            bundle_counts[row[4]] = bundle_counts.get(row[4], 0) + 1
         try:
-            npvr_quota = customer.getElementsByTagName("NPVRQuota")
-            if npvr_quota.length > 0:
-                fileQuota = int(customer.getElementsByTagName("NPVRQuota")[0].firstChild.data)
-            else:
-                fileQuota = 0
-            subscriptions = customer.getElementsByTagName("SubscriptionProduct")
-            specifiedQuota = 0
-            for subscriptionProduct in subscriptions:
-                subscription_id = int(subscriptionProduct.getAttribute("id"))
-                for line in NPVR_bundle_data:
-                    bundle_id = int(line[0])
-                    bundle_npvr = int(line[1])
-                    if bundle_id == subscription_id:
-                        if specifiedQuota < bundle_npvr:
-                            specifiedQuota = bundle_npvr
-            return fileQuota, specifiedQuota
+            with self.lock, self.connection:
+                self.connection.executemany("INSERT INTO mismatches VALUES (?, ?, ?, ?, ?)", rows)
+                self.connection.executemany("INSERT INTO bundle_counts VALUES (?, ?, ?)",
+                                            [(self.run_id, bundle_id, count) for bundle_id, count in bundle_counts.items()])
+                # A customer only counts once per run, however often it is recorded.
+                self.connection.executemany("""
+                    INSERT INTO customer_counts VALUES (?, 1, ?, ?)
+                    ON CONFLICT(customer_id) DO UPDATE SET mismatch_runs = mismatch_runs + 1, last_run_id = excluded.last_run_id
+                    WHERE last_run_id != excluded.last_run_id""", [(row[1], self.run_id, self.run_id) for row in rows])
+        except Exception as e:
+            logger.error(f"Error recording mismatches in {history_file}. Exception object = {e}")
+
+    def recordReprovisions(self, outcomes):
+        """
+        Adds the outcomes of reprovision attempts made in this run. Failures are logged rather than raised.
+
+        Args:
+            outcomes | An iterable of (customer_id, outcome) tuples.
+        """
+
+        rows = [(self.run_id, str(customer_id), outcome) for customer_id, outcome in outcomes]
+        try:
+            with self.lock, self.connection:
+                self.connection.executemany("INSERT INTO reprovisions VALUES (?, ?, ?)", rows)
         except Exception as e:
-            logger.error(f"An error occured while getting NPVR data for customer {customer.getAttribute('id')}. Exception object = {e}")
+            logger.error(f"Error recording reprovision outcomes in {history_file}. Exception object = {e}")
+
+    def close(self, outcome, customer_file, mismatchCount):
+        """Completes this run's row and closes the store."""
+
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE runs SET finished_at = ?, customer_file = ?, outcome = ?, mismatch_count = ? WHERE run_id = ?",
+                                    (time.time(), customer_file, outcome, mismatchCount, self.run_id))
+        self.connection.close()
+
+
+def openHistoryStore():
+    """
+    Opens history_file and starts this run's entry in it. A store that can't be opened is logged, and the run goes on without it.
+
+    Modifies:
+        history_store | Set to the open HistoryStore.
+    """
+
+    global history_store
+    try:
+        history_store = HistoryStore(history_file)
+    except Exception as e:
+        logger.error(f"Error opening {history_file}. This run will not be recorded in it. Exception object = {e}")
+
+
+def closeHistoryStore():
+    """
+    Completes this run's entry in the history store with its outcome, and closes the store. Failures are logged rather than raised.
+
+    Modifies:
+        history_store | Set back to None.
+    """
+
+    global history_store
+    try:
+        history_store.close(run_metrics.get("outcome"), run_metrics.get("customer_file"), run_metrics["counts"].get("mismatches"))
+    except Exception as e:
+        logger.error(f"Error completing this run in {history_file}. Exception object = {e}")
+    history_store = None
 
 
 # ----------
 # ABORT PATH
 # ----------
 
+def abortRun(mismatchCount, early_abort=None):
+    """
+    Runs the abort path: logs the mismatches, writes the target list for a manual run and raises a ticket.
+
+    Args:
+        mismatchCount | Integer representing the number of entries in reprovision_targets.
+        early_abort | Optional EarlyAbort which followed the search. If given, the ticket has already been raised and the target list
+                      already written, so they are only finished off here.
+    """
+
+    logger.info(f"Number of reprovision targets exceeds {cutoff}. No automatic reprovision will be attempted.")
+    with timeStage("abort"):
+        if early_abort:
+            early_abort.finish(mismatchCount)
+        else:
+            logMismatchedCustomers(mismatchCount)
+            writeManualTargetList()
+            createNewTicket(mismatchCount)
+    run_metrics["outcome"] = "aborted"
+    logger.info("Script concluding without reprovisioning mismatched customers. A manual script run, by running the script with the '--manual' argument, is required.")
+
+
+class EarlyAbort:
+    """
+    Follows a mismatch search for '--early-abort'. The moment the number of mismatches passes the cutoff, the ticket is raised and
+    the target list is opened. From then on each mismatch is written to it as it is found, through a large buffer.
+    Mismatches are also counted per determining bundle (the subscription which gives the customer's intended quota) for the summary.
+
+    Args:
+        bundle_index | A dict mapping each bundle id to its intended NPVR provisioning (in minutes), as built by buildBundleIndex().
+    """
+
+    def __init__(self, bundle_index):
+        self.bundle_index = bundle_index
+        self.mismatchCount = 0
+        self.bundle_counts = {}
+        self.sample_ids = []
+        self.ticket_raised = False
+        self.target_list = None
+
+    def record(self, customer, specifiedQuota):
+        """Passed to findMismatches() as on_mismatch. Counts one mismatch, and writes it to the target list once the cutoff has been passed."""
+
+        self.mismatchCount += 1
+        bundle_id = getDeterminingBundle(customer, self.bundle_index, specifiedQuota)
+        self.bundle_counts[bundle_id] = self.bundle_counts.get(bundle_id, 0) + 1
+        if len(self.sample_ids) < abort_sample_size:
+            self.sample_ids.append(customer.customer_id)
+        if self.target_list:
+            self.target_list.writeTarget(customer.customer_id, specifiedQuota, customer.customer_data)
+        elif self.mismatchCount > cutoff:
+            self.abort()
+
+    def abort(self):
+        """Raises the ticket and starts the target list with every mismatch found so far."""
+
+        logger.info(f"Number of reprovision targets has passed {cutoff}. Raising the ticket before the search has finished.")
+        self.raiseTicket()
+        self.target_list = TargetListWriter(target_list_file, abort_write_buffer)
+        for customer_id, specifiedQuota in reprovision_targets.items():
+            self.target_list.writeTarget(customer_id, specifiedQuota, target_customer_data.get(customer_id))
+
+    def raiseTicket(self):
+        """Creates the ticket. A failure is logged, and the ticket is tried again when the search has finished."""
+
+        try:
+            self.ticket_raised = createNewTicket(f"More than {cutoff}")
+            if not self.ticket_raised:
+                logger.error("The ticket could not be created early. It will be tried again once the search has finished.")
+        except Exception as e:
+            logger.error(f"Issue with creating the ticket early. It will be tried again once the search has finished. Exception object = {e}")
+
+    def finish(self, mismatchCount):
+        """
+        Closes the target list and logs the summary of the mismatches. Called from abortRun() once the search has finished.
+
+        Args:
+            mismatchCount | Integer representing the number of entries in reprovision_targets.
+        """
+
+        if self.target_list is None:
+            self.abort()
+        self.target_list.close()
+        logger.info(f"{target_list_file} is ready for a manual script run.")
+        logger.info(f"Number of customers with NPVR mismatch = {mismatchCount}.")
+        summary = ", ".join(f"{bundle_id if bundle_id is not None else 'no bundle'}: {count}"
+                            for bundle_id, count in sorted(self.bundle_counts.items(), key=lambda item: item[1], reverse=True))
+        logger.info(f"Mismatches per determining bundle: {summary}.")
+        logger.info(f"Example mismatched customers: {', '.join(str(customer_id) for customer_id in self.sample_ids)}.")
+        if not self.ticket_raised:
+            createNewTicket(mismatchCount)
+
+
 def logMismatchedCustomers(mismatchCount):
     """
-    Logs all mismatched customers.
+    Logs all mismatched customers. With customer_logging set to 'summary', only the first abort_sample_size are named.
     
     Args:
-        mismatchCount | Integer representing length of list reprovision_targets, and thus how many customers have been found with a mismatch between actual and intended NPVR provisioning.
+        mismatchCount | Integer representing the number of entries in reprovision_targets, and thus how many customers have been found with a mismatch between actual and intended NPVR provisioning.
     """
 
-    logger.info("Logging all customers with a mismatch.")
-    for customer_id in reprovision_targets:
-        logger.info(f"Mismatch detected for customer {customer_id}.")
+    if customer_logger.isEnabledFor(logging.INFO):
+        logger.info("Logging all customers with a mismatch.")
+        for customer_id in reprovision_targets:
+            customer_logger.info("Mismatch detected for customer %s.", customer_id, extra={"customer_id": customer_id})
+    else:
+        sample_ids = [str(customer_id) for customer_id, _ in zip(reprovision_targets, range(abort_sample_size))]
+        logger.info(f"Example mismatched customers: {', '.join(sample_ids)}.")
     logger.info(f"Number of customers with NPVR mismatch = {mismatchCount}.")
 
 
 def writeManualTargetList():
-    """Writes the list of customer ids to an external file which acts as the input for a manual script run."""
+    """Writes the reprovision targets, with their intended NPVR quota and CustomerData, to the target list which acts as the input for a manual script run."""
 
-    logger.info("Writing list of reprovision targets to manual_reprovision_targets.csv.")
+    logger.info(f"Writing list of reprovision targets to {target_list_file}.")
     try:
-        with open('manual_reprovision_targets.csv', 'w') as target_list:
-            writer = csv.writer(target_list, delimiter=',', quoting=csv.QUOTE_MINIMAL)
-            for customer in reprovision_targets:
-                writer.writerow([str(customer)])
-        logger.info("manual_reprovision_targets.csv is ready for a manual script run.")
+        target_list = TargetListWriter(target_list_file)
+        for customer_id, specifiedQuota in reprovision_targets.items():
+            target_list.writeTarget(customer_id, specifiedQuota, target_customer_data.get(customer_id))
+        target_list.close()
+        logger.info(f"{target_list_file} is ready for a manual script run.")
     except Exception as e:
         logger.error(f"Issue with creating or writing to file. Exception object = {e}")
 
@@ -352,9 +2605,16 @@ def createNewTicket(mismatchCount):
     Creates a JIRA ticket to alert someone to the high number of mismatches.
     
     Args:
-        mismatchCount | Integer representing length of list reprovision_targets, and thus how many customers have been found with a mismatch between actual and intended NPVR provisioning.
+        mismatchCount | Integer representing the number of entries in reprovision_targets, and thus how many customers have been found with a mismatch between actual and intended NPVR provisioning.
+                        A string such as "More than 25" when the ticket is raised before the search has finished.
+
+    Returns:
+        True if the ticket was created, or if none is needed because this is a dry run. False if JIRA refused it.
     """
 
+    if payload_journal is not None:
+        logger.info(f"Dry run: no JIRA ticket is created for {mismatchCount} mismatches.")
+        return True
     logger.info("Creating and assigning a JIRA ticket.")
     jsonBody = {
         "fields": {
@@ -372,16 +2632,18 @@ def createNewTicket(mismatchCount):
             "customfield_11211": {"value": "<img src=\"/images/icons/priorities/minor.png\"/>Prio 4"}
         }
     }
-    response = requests.post(url=pendenzenURL + "/issue",
-                             json=jsonBody, auth=auth)
+    response = getSession("jira").post(url=pendenzenURL + "/issue",
+                                       json=jsonBody, auth=auth, timeout=getTimeout())
     if response.status_code == 201:
         responseTicket = json.loads(response.text)
         assignTicket(responseTicket["self"])
         issue_key = responseTicket.get('key', 'Unknown')
         web_url = f"https://<REDACTED>/{issue_key}"
         logger.info(f"New ticket created at {web_url}")
+        return True
     else:
-        logger.error("Failed to create a new ticket.")
+        logger.error(f"Failed to create a new ticket. JIRA returned status code {response.status_code}.")
+        return False
 
 
 def assignTicket(url):
@@ -395,8 +2657,8 @@ def assignTicket(url):
     assignee = {
         "name": "dsupport"
     }
-    response = requests.put(url=url + "/assignee",
-                            json=assignee, auth=auth)
+    response = getSession("jira").put(url=url + "/assignee",
+                                      json=assignee, auth=auth, timeout=getTimeout())
     if response.status_code == 204:
         logger.info("Ticket successfully assigned.")
     else:
@@ -1,9 +1,37 @@
+import argparse
+import asyncio
+import gzip
+import importlib.util
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
 from xml.dom import minidom
 from unittest.mock import MagicMock
 from unittest.mock import patch
 
+import mysql.connector
+
 from reprovision_quota import getIntendedNPVR
+from reprovision_quota import buildBundleIndex
+from reprovision_quota import streamCustomers
+from reprovision_quota import CustomerRecord
+from reprovision_quota import RateLimiter
+from reprovision_quota import startReprovisionLoop
+from reprovision_quota import findMismatches
+from reprovision_quota import loadCustomerStore
+from reprovision_quota import getNPVR_bundle_data
+from reprovision_quota import getPercentiles
+from reprovision_quota import getLatestCustomerFile
+import reprovision_quota
+import prodis_stub_server
+import quota_history
 
 
 class TestGetIntendedNPVR(unittest.TestCase):
@@ -196,5 +224,1195 @@ class TestGetIntendedNPVR(unittest.TestCase):
 
 
 
+    def testPrebuiltBundleIndex(self):
+        """Test case: A prebuilt bundle index gives the same result as the list of tuples."""
+        mock_customer_xml = """
+    <Customer id="171669">
+        <NPVRQuota>7777</NPVRQuota>
+        <CustomerData>PartnerSystemID:66;Zip:6386;PartnerId:25;Source:QMC;CustomerAT:Cable</CustomerData>
+        <SubscriptionProducts>
+            <SubscriptionProduct id="134" />
+            <SubscriptionProduct id="784" />
+            <SubscriptionProduct id="957" />
+        </SubscriptionProducts>
+    </Customer>
+        """
+
+        customer_data = minidom.parseString(mock_customer_xml)
+        customer_node = customer_data.getElementsByTagName("Customer")[0]
+        mock_npvr_bundle_data = [(647, 250*60), (784, 500*60), (957, 2000*60)]
+        bundle_index = buildBundleIndex(mock_npvr_bundle_data)
+
+        self.assertEqual(bundle_index, {647: 15000, 784: 30000, 957: 120000})
+        self.assertEqual(getIntendedNPVR(customer_node, bundle_index),
+                         getIntendedNPVR(customer_node, mock_npvr_bundle_data))
+
+
+
+    def testBundleIndexKeepsHighestDuplicate(self):
+        """Test case: A bundle listed twice in the bundle data keeps its highest NPVR."""
+        mock_npvr_bundle_data = [("957", "60000"), ("957", "120000"), ("784", "30000"), ("957", "90000")]
+
+        self.assertEqual(buildBundleIndex(mock_npvr_bundle_data), {957: 120000, 784: 30000})
+
+
+
+class TestStreamCustomers(unittest.TestCase):
+
+    def writeCustomerFile(self, xml):
+        """Writes mock XML to a temporary customer file and returns its path."""
+        handle, path = tempfile.mkstemp(suffix=".xml")
+        with os.fdopen(handle, 'w') as customer_file:
+            customer_file.write(xml)
+        self.addCleanup(os.remove, path)
+        return path
+
+
+
+    def testStreamsCompactRecords(self):
+        """Test case: Each customer in the file is yielded as a CustomerRecord."""
+        mock_customer_xml = """<?xml version="1.0" encoding="utf-8"?>
+<Customers xmlns="urn:eventis:crm:2.0">
+    <Customer id="171669">
+        <NPVRQuota>120000</NPVRQuota>
+        <CustomerData>PartnerSystemID:66;Zip:6386;PartnerId:25;Source:QMC;CustomerAT:Cable</CustomerData>
+        <SubscriptionProducts>
+            <SubscriptionProduct id="134" />
+            <SubscriptionProduct id="957" />
+        </SubscriptionProducts>
+    </Customer>
+    <Customer id="171670">
+        <CustomerData>PartnerSystemID:66;Zip:6386;PartnerId:25;Source:QMC;CustomerAT:Cable</CustomerData>
+        <SubscriptionProducts></SubscriptionProducts>
+    </Customer>
+</Customers>
+        """
+
+        customers = list(streamCustomers(self.writeCustomerFile(mock_customer_xml)))
+
+        self.assertEqual(customers, [CustomerRecord("171669", 120000, (134, 957), "PartnerSystemID:66;Zip:6386;PartnerId:25;Source:QMC;CustomerAT:Cable"),
+                                     CustomerRecord("171670", 0, (), "PartnerSystemID:66;Zip:6386;PartnerId:25;Source:QMC;CustomerAT:Cable")])
+
+
+
+    def testStreamedRecordMatchesDomNode(self):
+        """Test case: A streamed record gives the same NPVR result as the equivalent xml.dom node."""
+        mock_customer_xml = """
+    <Customer id="171669">
+        <NPVRQuota>7777</NPVRQuota>
+        <CustomerData>PartnerSystemID:66;Zip:6386;PartnerId:25;Source:QMC;CustomerAT:Cable</CustomerData>
+        <SubscriptionProducts>
+            <SubscriptionProduct id="134" />
+            <SubscriptionProduct id="784" />
+            <SubscriptionProduct id="957" />
+        </SubscriptionProducts>
+    </Customer>
+        """
+
+        customer_node = minidom.parseString(mock_customer_xml).getElementsByTagName("Customer")[0]
+        customer_record = next(streamCustomers(self.writeCustomerFile(mock_customer_xml.strip())))
+        mock_npvr_bundle_data = [(647, 250*60), (784, 500*60), (957, 2000*60)]
+
+        self.assertEqual(getIntendedNPVR(customer_record, mock_npvr_bundle_data),
+                         getIntendedNPVR(customer_node, mock_npvr_bundle_data))
+
+
+
+    def testBadRecordsAreQuarantined(self):
+        """Test case: Customers with a malformed quota or subscription id are skipped and written to the quarantine file, serially and in parallel."""
+        mock_customer_xml = """<?xml version="1.0" encoding="utf-8"?>
+<Customers xmlns="urn:eventis:crm:2.0">
+    <Customer id="1"><NPVRQuota>120000</NPVRQuota><SubscriptionProducts><SubscriptionProduct id="957" /></SubscriptionProducts></Customer>
+    <Customer id="2"><NPVRQuota>lots</NPVRQuota><SubscriptionProducts><SubscriptionProduct id="957" /></SubscriptionProducts></Customer>
+    <Customer id="3"><NPVRQuota>0</NPVRQuota><SubscriptionProducts><SubscriptionProduct id="95x" /></SubscriptionProducts></Customer>
+    <Customer><NPVRQuota>0</NPVRQuota></Customer>
+    <Customer id="5"><NPVRQuota>7777</NPVRQuota><SubscriptionProducts><SubscriptionProduct /></SubscriptionProducts></Customer>
+    <Customer id="6"><NPVRQuota>0</NPVRQuota></Customer>
+</Customers>
+"""
+        customer_file = self.writeCustomerFile(mock_customer_xml)
+        quarantine_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(quarantine_dir.cleanup)
+        quarantine_path = os.path.join(quarantine_dir.name, "quarantine.jsonl")
+
+        for workers in (1, 2):
+            with patch.object(reprovision_quota, "quarantine_file", quarantine_path):
+                customers = loadCustomerStore(customer_file, workers)
+            with open(quarantine_path) as quarantine:
+                entries = [json.loads(line) for line in quarantine]
+
+            self.assertEqual([customer.customer_id for customer in customers], ["1", "6"])
+            self.assertEqual([(entry["customer_id"], entry["reason"]) for entry in entries],
+                             [("2", "NPVRQuota 'lots' is not an integer"), ("3", "SubscriptionProduct id '95x' is not an integer"),
+                              (None, "Customer has no id"), ("5", "SubscriptionProduct id None is not an integer")])
+            self.assertIn("lots", entries[0]["record"])
+
+
+
+    def testQuarantineFileIsRemovedWhenClean(self):
+        """Test case: A customer file without bad records removes the quarantine file of an earlier run."""
+        customer_file = self.writeCustomerFile('<Customers><Customer id="1"><NPVRQuota>0</NPVRQuota></Customer></Customers>')
+        quarantine_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(quarantine_dir.cleanup)
+        quarantine_path = os.path.join(quarantine_dir.name, "quarantine.jsonl")
+        with open(quarantine_path, 'w') as quarantine:
+            quarantine.write("{}\n")
+
+        with patch.object(reprovision_quota, "quarantine_file", quarantine_path):
+            loadCustomerStore(customer_file)
+
+        self.assertFalse(os.path.exists(quarantine_path))
+
+
+
+class TestLatestCustomerFile(unittest.TestCase):
+
+    def setUp(self):
+        self.customer_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.customer_dir.cleanup)
+        for patcher in [patch.object(reprovision_quota, "customer_file_dir", self.customer_dir.name),
+                        patch.object(reprovision_quota, "customer_file_manifest", os.path.join(self.customer_dir.name, "manifest.json"))]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        mock_customer_xml = b'<Customers><Customer id="171669"><NPVRQuota>120000</NPVRQuota></Customer></Customers>'
+        for age, name in enumerate(["customers_3.xml.gz", "customers_2.xml", "customers_1.xml"]):
+            path = os.path.join(self.customer_dir.name, name)
+            with (gzip.open(path, 'wb') if name.endswith('.gz') else open(path, 'wb')) as customer_file:
+                customer_file.write(mock_customer_xml)
+            time.sleep(0.01)
+
+
+
+    def testNewestCompressedFileIsStreamed(self):
+        """Test case: The newest export is found even when it is compressed, and can be streamed."""
+        newest = os.path.join(self.customer_dir.name, "customers_0.xml.gz")
+        with gzip.open(newest, 'wb') as customer_file:
+            customer_file.write(b'<Customers><Customer id="171670"><NPVRQuota>60</NPVRQuota></Customer></Customers>')
+
+        customer_file = getLatestCustomerFile()
+
+        self.assertEqual(customer_file, newest)
+        self.assertEqual([customer.customer_id for customer in streamCustomers(customer_file)], ["171670"])
+
+
+
+    def testLatestPointerIsUsed(self):
+        """Test case: A LATEST pointer written by the exporter takes precedence over the directory listing."""
+        with open(os.path.join(self.customer_dir.name, "LATEST"), 'w') as pointer:
+            pointer.write("customers_2.xml\n")
+
+        self.assertEqual(getLatestCustomerFile(), os.path.join(self.customer_dir.name, "customers_2.xml"))
+
+
+
+class TestCustomerStore(unittest.TestCase):
+
+    def testRoundTrip(self):
+        """Test case: Every record added to the store comes back unchanged, including ids which aren't plain numbers."""
+        records = [CustomerRecord("171669", 120000, (134, 957), "Zip:6386"),
+                   CustomerRecord("007", 0, (), None),
+                   CustomerRecord("A-1", 7777, (957, 957), "Zip:6386"),
+                   CustomerRecord(None, 30000, (784,), "Zip:8000")]
+        customers = reprovision_quota.CustomerStore()
+        for record in records[:2]:
+            customers.append(record)
+        other = reprovision_quota.CustomerStore()
+        for record in records[2:]:
+            other.append(record)
+
+        customers.extend(other)
+
+        self.assertEqual(len(customers), 4)
+        self.assertEqual(list(customers), records)
+        self.assertEqual(customers.customer_data_values, ["Zip:6386", "Zip:8000"])
+
+
+
+class TestResolveManualTargets(unittest.TestCase):
+
+    def setUp(self):
+        self.customers = reprovision_quota.CustomerStore()
+        for record in [CustomerRecord("171669", 7777, (134, 957), "Zip:6386"),
+                       CustomerRecord("171670", 30000, (784,), "Zip:8000"),
+                       CustomerRecord("171671", 0, (), None)]:
+            self.customers.append(record)
+        for patcher in [patch.dict(reprovision_quota.reprovision_targets, clear=True),
+                        patch.dict(reprovision_quota.target_customer_data, clear=True)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+
+    def testTargetsAreResolved(self):
+        """Test case: Each target of a manual run gets the intended quota and CustomerData from the customer file, and targets missing from it are dropped."""
+        reprovision_quota.reprovision_targets.update({"171669": None, "171671": None, "404": None})
+
+        reprovision_quota.resolveManualTargets(self.customers, {784: 30000, 957: 120000})
+
+        self.assertEqual(reprovision_quota.reprovision_targets, {"171669": 120000, "171671": 0})
+        self.assertEqual(reprovision_quota.target_customer_data, {"171669": "Zip:6386", "171671": None})
+
+
+
+    def testShardsShareOneSearch(self):
+        """Test case: The customers are searched once for the targets of every shard, and each shard is resolved from that search alone."""
+        target_rows = reprovision_quota.indexTargetRows(self.customers, {"171669", "171670", "404"})
+        self.assertEqual(target_rows, {"171669": 0, "171670": 1})
+
+        with patch.object(reprovision_quota, "indexTargetRows", side_effect=AssertionError("customers searched again")):
+            reprovision_quota.reprovision_targets.update({"171669": None})
+            reprovision_quota.resolveManualTargets(self.customers, {784: 30000, 957: 120000}, target_rows)
+            self.assertEqual(reprovision_quota.reprovision_targets, {"171669": 120000})
+
+            reprovision_quota.reprovision_targets.clear()
+            reprovision_quota.reprovision_targets.update({"171670": None, "404": None})
+            reprovision_quota.resolveManualTargets(self.customers, {784: 30000, 957: 120000}, target_rows)
+
+        self.assertEqual(reprovision_quota.reprovision_targets, {"171670": 30000})
+
+
+
+class TestIncrementalMismatches(unittest.TestCase):
+
+    def setUp(self):
+        mock_customer_xml = """<?xml version="1.0" encoding="utf-8"?>
+<Customers>
+    <Customer id="1"><NPVRQuota>120000</NPVRQuota><SubscriptionProducts><SubscriptionProduct id="957" /></SubscriptionProducts></Customer>
+    <Customer id="2"><NPVRQuota>7777</NPVRQuota><SubscriptionProducts><SubscriptionProduct id="957" /></SubscriptionProducts></Customer>
+    <Customer id="3"><NPVRQuota>30000</NPVRQuota><SubscriptionProducts><SubscriptionProduct id="784" /></SubscriptionProducts></Customer>
+</Customers>
+        """
+        handle, self.customer_file = tempfile.mkstemp(suffix=".xml")
+        with os.fdopen(handle, 'w') as customer_file:
+            customer_file.write(mock_customer_xml)
+        self.addCleanup(os.remove, self.customer_file)
+        snapshot_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(snapshot_dir.cleanup)
+        for patcher in [patch.object(reprovision_quota, "snapshot_file", os.path.join(snapshot_dir.name, "snapshot.json")),
+                        patch.dict(reprovision_quota.reprovision_targets, clear=True)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+
+    def runScan(self, bundle_index, incremental=True):
+        """Runs findMismatches and returns the targets found and the ids of the customers that were actually checked."""
+        reprovision_quota.reprovision_targets.clear()
+        with patch.object(reprovision_quota, "getIntendedNPVR", wraps=reprovision_quota.getIntendedNPVR) as mock_check:
+            findMismatches(loadCustomerStore(self.customer_file), bundle_index, incremental)
+        checked = [call.args[0].customer_id for call in mock_check.call_args_list]
+        return dict(reprovision_quota.reprovision_targets), checked
+
+
+
+    def testUnchangedCustomersAreSkipped(self):
+        """Test case: Only previous mismatches are re-checked when nothing has changed."""
+        bundle_index = {784: 30000, 957: 120000}
+
+        first_targets, first_checked = self.runScan(bundle_index)
+        second_targets, second_checked = self.runScan(bundle_index)
+
+        self.assertEqual(first_checked, ["1", "2", "3"])
+        self.assertEqual(second_checked, ["2"])
+        self.assertEqual(first_targets, {"2": 120000})
+        self.assertEqual(second_targets, first_targets)
+
+
+
+    def testChangedBundleForcesRecheck(self):
+        """Test case: Customers holding a bundle whose NPVR changed are re-checked."""
+        self.runScan({784: 30000, 957: 120000})
+
+        targets, checked = self.runScan({784: 60000, 957: 120000})
+
+        self.assertEqual(checked, ["2", "3"])
+        self.assertEqual(targets, {"2": 120000, "3": 60000})
+
+
+
+    def testFullRescan(self):
+        """Test case: A full rescan checks every customer despite the snapshot, and neither reads nor rewrites it."""
+        bundle_index = {784: 30000, 957: 120000}
+        self.runScan(bundle_index)
+        with open(reprovision_quota.snapshot_file) as snapshot:
+            saved_snapshot = snapshot.read()
+
+        with patch.object(reprovision_quota, "loadSnapshot") as mock_load, patch.object(reprovision_quota, "saveSnapshot") as mock_save:
+            targets, checked = self.runScan(bundle_index, incremental=False)
+
+        self.assertEqual(checked, ["1", "2", "3"])
+        self.assertEqual(targets, {"2": 120000})
+        mock_load.assert_not_called()
+        mock_save.assert_not_called()
+        with open(reprovision_quota.snapshot_file) as snapshot:
+            self.assertEqual(snapshot.read(), saved_snapshot)
+
+
+
+    def testChangedRecordIsRechecked(self):
+        """Test case: A customer whose quota or subscriptions changed since the snapshot is checked again."""
+        bundle_index = {784: 30000, 957: 120000}
+        self.runScan(bundle_index)
+        with open(self.customer_file) as customer_file:
+            mock_customer_xml = customer_file.read().replace('<NPVRQuota>30000</NPVRQuota>', '<NPVRQuota>60000</NPVRQuota>')
+        with open(self.customer_file, 'w') as customer_file:
+            customer_file.write(mock_customer_xml)
+
+        targets, checked = self.runScan(bundle_index)
+
+        self.assertEqual(checked, ["2", "3"])
+        self.assertEqual(targets, {"2": 120000, "3": 30000})
+
+
+
+class TestParallelMismatches(unittest.TestCase):
+
+    def setUp(self):
+        customers = []
+        for customer_id in range(1000, 1400):
+            subscriptions = "".join(f'<SubscriptionProduct id="{bundle_id}" />' for bundle_id in (134, 784, 957)[:customer_id % 4])
+            quota = "" if customer_id % 11 == 0 else f"<NPVRQuota>{(0, 30000, 120000, 7777)[customer_id % 4]}</NPVRQuota>"
+            customers.append(f'    <Customer id="{customer_id}">{quota}<CustomerData>Zip:{customer_id}</CustomerData>'
+                             f'<SubscriptionProducts>{subscriptions}</SubscriptionProducts></Customer>')
+        # Self-closing customers after the last </Customer> must still fall inside the last shard.
+        customers += ['    <Customer id="1400"/>', '    <Customer id="1401" />']
+        mock_customer_xml = '<?xml version="1.0" encoding="utf-8"?>\n<Customers xmlns="urn:eventis:crm:2.0">\n' + "\n".join(customers) + "\n</Customers>\n"
+        handle, self.customer_file = tempfile.mkstemp(suffix=".xml")
+        with os.fdopen(handle, 'w') as customer_file:
+            customer_file.write(mock_customer_xml)
+        self.addCleanup(os.remove, self.customer_file)
+        snapshot_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(snapshot_dir.cleanup)
+        for patcher in [patch.object(reprovision_quota, "snapshot_file", os.path.join(snapshot_dir.name, "snapshot.json")),
+                        patch.dict(reprovision_quota.reprovision_targets, clear=True)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+
+    def testParallelLoadMatchesSerialLoad(self):
+        """Test case: A sharded parallel read gives exactly the same customers, in the same order, as a serial read."""
+        serial_customers = loadCustomerStore(self.customer_file, workers=1)
+        parallel_customers = loadCustomerStore(self.customer_file, workers=3)
+
+        self.assertEqual(len(serial_customers), 402)
+        self.assertEqual(list(parallel_customers), list(serial_customers))
+
+
+
+    def testParallelScanMatchesSerialScan(self):
+        """Test case: Customers read in parallel give exactly the same mismatches, in the same order, as a serial read."""
+        bundle_index = {784: 30000, 957: 120000}
+
+        findMismatches(loadCustomerStore(self.customer_file, workers=1), bundle_index)
+        serial_targets = list(reprovision_quota.reprovision_targets.items())
+        reprovision_quota.reprovision_targets.clear()
+        findMismatches(loadCustomerStore(self.customer_file, workers=3), bundle_index)
+        parallel_targets = list(reprovision_quota.reprovision_targets.items())
+
+        self.assertTrue(serial_targets)
+        self.assertEqual(parallel_targets, serial_targets)
+
+
+
+    def testPrefixedCustomersFallBackToSerialLoad(self):
+        """Test case: Customer elements with a namespace prefix can't be split into shards, so a parallel load reads them serially instead of finding none."""
+        customers = "".join(f'<c:Customer id="{customer_id}"><c:NPVRQuota>7777</c:NPVRQuota></c:Customer>' for customer_id in range(10))
+        handle, customer_file = tempfile.mkstemp(suffix=".xml")
+        with os.fdopen(handle, 'w') as output:
+            output.write(f'<?xml version="1.0" encoding="utf-8"?><c:Customers xmlns:c="urn:eventis:crm:2.0">{customers}</c:Customers>')
+        self.addCleanup(os.remove, customer_file)
+
+        self.assertEqual(len(loadCustomerStore(customer_file, workers=1)), 10)
+        self.assertEqual(list(loadCustomerStore(customer_file, workers=2)), list(loadCustomerStore(customer_file, workers=1)))
+
+
+
+@unittest.skipIf(importlib.util.find_spec("numpy") is None, "NumPy is not installed")
+class TestVectorizedMismatches(unittest.TestCase):
+
+    def setUp(self):
+        customers = []
+        for customer_id in range(2000, 2300):
+            # Duplicate products, products which aren't bundles and customers with no subscriptions are all included.
+            subscriptions = "".join(f'<SubscriptionProduct id="{product_id}" />' for product_id in (957, 134, 957, 784, 55)[:customer_id % 6])
+            quota = "" if customer_id % 13 == 0 else f"<NPVRQuota>{(0, 0, 30000, 120000, 7777)[customer_id % 5]}</NPVRQuota>"
+            customers.append(f'    <Customer id="{customer_id}">{quota}<CustomerData>Zip:{customer_id}</CustomerData>'
+                             f'<SubscriptionProducts>{subscriptions}</SubscriptionProducts></Customer>')
+        customers.append('    <Customer id="CUST-A"><NPVRQuota>0</NPVRQuota><SubscriptionProducts><SubscriptionProduct id="957" /></SubscriptionProducts></Customer>')
+        mock_customer_xml = '<?xml version="1.0" encoding="utf-8"?>\n<Customers xmlns="urn:eventis:crm:2.0">\n' + "\n".join(customers) + "\n</Customers>\n"
+        handle, customer_file = tempfile.mkstemp(suffix=".xml")
+        with os.fdopen(handle, 'w') as output:
+            output.write(mock_customer_xml)
+        self.addCleanup(os.remove, customer_file)
+        self.customers = loadCustomerStore(customer_file)
+        snapshot_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(snapshot_dir.cleanup)
+        for patcher in [patch.object(reprovision_quota, "snapshot_file", os.path.join(snapshot_dir.name, "snapshot.json")),
+                        patch.dict(reprovision_quota.reprovision_targets, clear=True),
+                        patch.dict(reprovision_quota.target_customer_data, clear=True)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+
+    def runScan(self, bundle_index, engine):
+        reprovision_quota.reprovision_targets.clear()
+        reprovision_quota.target_customer_data.clear()
+        findMismatches(self.customers, bundle_index, engine=engine)
+        return list(reprovision_quota.reprovision_targets.items()), dict(reprovision_quota.target_customer_data)
+
+
+
+    def testNumpyEngineMatchesPythonEngine(self):
+        """Test case: The NumPy engine finds exactly the same mismatches, quotas and CustomerData, in the same order, as the Python engine."""
+        bundle_index = {134: -60, 784: 30000, 957: 120000, 4000: 500}
+
+        python_targets, python_customer_data = self.runScan(bundle_index, "python")
+        numpy_targets, numpy_customer_data = self.runScan(bundle_index, "numpy")
+
+        self.assertTrue(python_targets)
+        self.assertIn(("CUST-A", 120000), python_targets)
+        self.assertEqual(numpy_targets, python_targets)
+        self.assertEqual(numpy_customer_data, python_customer_data)
+
+
+
+    def testNumpyEngineWithoutMatchingBundles(self):
+        """Test case: When no subscription is a bundle, every customer with a non-zero quota is a mismatch with a specified quota of 0."""
+        python_targets, _ = self.runScan({1: 60}, "python")
+        numpy_targets, _ = self.runScan({1: 60}, "numpy")
+
+        self.assertEqual(numpy_targets, python_targets)
+        self.assertTrue(all(quota == 0 for _, quota in numpy_targets))
+
+
+
+class TestEarlyAbort(unittest.TestCase):
+
+    def setUp(self):
+        work_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(work_dir.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(work_dir.name)
+        customers = []
+        for customer_id in range(3000, 3010):
+            subscriptions = '<SubscriptionProduct id="957" />' if customer_id % 2 else '<SubscriptionProduct id="784" /><SubscriptionProduct id="80" />'
+            customers.append(f'<Customer id="{customer_id}"><NPVRQuota>7777</NPVRQuota><SubscriptionProducts>{subscriptions}</SubscriptionProducts></Customer>')
+        with open("customers.xml", 'w') as customer_file:
+            customer_file.write('<?xml version="1.0" encoding="utf-8"?><Customers xmlns="urn:eventis:crm:2.0">' + "".join(customers) + '</Customers>')
+        self.customers = loadCustomerStore("customers.xml")
+        for patcher in [patch.object(reprovision_quota, "cutoff", 3),
+                        patch.dict(reprovision_quota.reprovision_targets, clear=True),
+                        patch.dict(reprovision_quota.target_customer_data, clear=True)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+
+    def testTicketRaisedAtCutoff(self):
+        """Test case: The ticket is raised as soon as the cutoff is passed, and the target list still holds every mismatch."""
+        bundle_index = {784: 30000, 957: 120000}
+        early_abort = reprovision_quota.EarlyAbort(bundle_index)
+        targets_at_ticket = []
+
+        with patch.object(reprovision_quota, "createNewTicket", side_effect=lambda count: targets_at_ticket.append(len(reprovision_quota.reprovision_targets)) or True) as mock_ticket:
+            findMismatches(self.customers, bundle_index, on_mismatch=early_abort.record)
+            reprovision_quota.abortRun(len(reprovision_quota.reprovision_targets), early_abort)
+
+        mock_ticket.assert_called_once_with("More than 3")
+        self.assertEqual(targets_at_ticket, [4])
+        target_list = reprovision_quota.scanTargetList("manual_reprovision_targets.csv")
+        self.assertEqual([customer_id for shard in target_list.shards for customer_id, _, _ in reprovision_quota.readTargetShard("manual_reprovision_targets.csv", *shard)],
+                         [str(customer_id) for customer_id in range(3000, 3010)])
+        self.assertEqual(early_abort.bundle_counts, {784: 5, 957: 5})
+
+
+
+    def testFailedEarlyTicketIsRetried(self):
+        """Test case: If the early ticket cannot be raised, it is raised again once the search has finished."""
+        early_abort = reprovision_quota.EarlyAbort({784: 30000, 957: 120000})
+
+        with patch.object(reprovision_quota, "createNewTicket", side_effect=[Exception("Jira is down"), None]) as mock_ticket:
+            findMismatches(self.customers, {784: 30000, 957: 120000}, on_mismatch=early_abort.record)
+            reprovision_quota.abortRun(10, early_abort)
+
+        self.assertEqual(mock_ticket.call_count, 2)
+        mock_ticket.assert_called_with(10)
+
+
+
+    def testRefusedEarlyTicketIsRetried(self):
+        """Test case: If JIRA refuses the early ticket without an exception, it is raised again once the search has finished."""
+        early_abort = reprovision_quota.EarlyAbort({784: 30000, 957: 120000})
+        session = MagicMock(post=MagicMock(return_value=MagicMock(status_code=501)))
+
+        with patch.object(reprovision_quota, "getSession", return_value=session):
+            findMismatches(self.customers, {784: 30000, 957: 120000}, on_mismatch=early_abort.record)
+            reprovision_quota.abortRun(10, early_abort)
+
+        self.assertFalse(early_abort.ticket_raised)
+        self.assertEqual(session.post.call_count, 2)
+        self.assertIn("10 NPVR mismatches", session.post.call_args.kwargs["json"]["fields"]["summary"])
+
+
+
+class TestManualTargetList(unittest.TestCase):
+
+    def setUp(self):
+        work_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(work_dir.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(work_dir.name)
+        self.targets = {str(customer_id): customer_id * 60 for customer_id in range(1, 6)}
+        for patcher in [patch.object(reprovision_quota, "target_shard_size", 2),
+                        patch.dict(reprovision_quota.reprovision_targets, self.targets, clear=True),
+                        patch.dict(reprovision_quota.target_customer_data, {"1": 'Zip:1;Name:"A, B"', "2": "Line\nbreak", "3": None}, clear=True),
+                        patch.dict(reprovision_quota.reprovision_results, clear=True)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        reprovision_quota.writeManualTargetList()
+
+
+
+    def readTargets(self):
+        target_list = reprovision_quota.scanTargetList(reprovision_quota.target_list_file)
+        return [target for shard in target_list.shards for target in reprovision_quota.readTargetShard(reprovision_quota.target_list_file, *shard)]
+
+
+
+    def testRoundTrip(self):
+        """Test case: Quotas and CustomerData survive the target list, even with commas, quotes and line breaks, and each shard holds whole rows."""
+        target_list = reprovision_quota.scanTargetList(reprovision_quota.target_list_file)
+
+        self.assertFalse(target_list.legacy)
+        self.assertEqual(target_list.run_id, reprovision_quota.getRunId())
+        self.assertEqual(target_list.target_count, 5)
+        self.assertEqual(len(target_list.shards), 3)
+        self.assertEqual(self.readTargets(), [("1", 60, 'Zip:1;Name:"A, B"'), ("2", 120, "Line\nbreak"), ("3", 180, None), ("4", 240, None), ("5", 300, None)])
+
+
+
+    def testChangedListIsRefused(self):
+        """Test case: A list whose rows don't match the checksum in its header, such as one whose writer never finished, is not used."""
+        with open(reprovision_quota.target_list_file, 'r+b') as target_list:
+            data = target_list.read().replace(b"4,240", b"4,999")
+            target_list.seek(0)
+            target_list.write(data)
+
+        self.assertIsNone(reprovision_quota.scanTargetList(reprovision_quota.target_list_file))
+
+
+
+    def testLegacyListOfIds(self):
+        """Test case: A list holding only customer ids, as written by older versions, is still read, without quotas or CustomerData."""
+        with open(reprovision_quota.target_list_file, 'w') as target_list:
+            target_list.write("171669\n171670\n171671\n")
+
+        self.assertTrue(reprovision_quota.scanTargetList(reprovision_quota.target_list_file).legacy)
+        self.assertEqual(self.readTargets(), [("171669", None, None), ("171670", None, None), ("171671", None, None)])
+
+
+
+    def testShardClaims(self):
+        """Test case: A shard can only be claimed once, a done shard can't be claimed, and a stale claim is taken over."""
+        os.makedirs("shards")
+
+        self.assertTrue(reprovision_quota.claimTargetShard("shards", 0))
+        self.assertFalse(reprovision_quota.claimTargetShard("shards", 0))
+        reprovision_quota.markTargetShardDone("shards", 0)
+        self.assertFalse(reprovision_quota.claimTargetShard("shards", 0))
+        self.assertTrue(reprovision_quota.claimTargetShard("shards", 1))
+        os.utime("shards/shard-00001.claim", (0, 0))
+        self.assertTrue(reprovision_quota.claimTargetShard("shards", 1))
+
+
+
+    def testAbandonedClaims(self):
+        """Test case: A claim is taken over when its process has died on this host, but not while its process is alive."""
+        os.makedirs("shards")
+        finished = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"], capture_output=True, text=True, check=True)
+        for shard, pid in [(0, finished.stdout.strip()), (1, os.getppid())]:
+            with open(f"shards/shard-{shard:05d}.claim", 'w') as claim:
+                claim.write(f"{socket.gethostname()} {pid} other-run\n")
+
+        self.assertTrue(reprovision_quota.claimTargetShard("shards", 0))
+        self.assertFalse(reprovision_quota.claimTargetShard("shards", 1))
+
+
+
+    def testResumeLeavesLiveClaims(self):
+        """Test case: '--resume' only continues from the shard journals, and doesn't take over a shard whose run is still alive."""
+        target_list = reprovision_quota.scanTargetList(reprovision_quota.target_list_file)
+        shard_dir = reprovision_quota.getTargetShardDir(target_list)
+        os.makedirs(shard_dir)
+        live_claim = f"{socket.gethostname()} {os.getppid()} other-run\n"
+        with open(os.path.join(shard_dir, "shard-00000.claim"), 'w') as claim:
+            claim.write(live_claim)
+        processed = []
+
+        with patch.object(reprovision_quota, "startReprovisionLoop", side_effect=lambda *args, **kwargs: processed.append(dict(reprovision_quota.reprovision_targets))):
+            reprovision_quota.startManualRun(argparse.Namespace(resume=True, skip_get=False, workers=1))
+
+        self.assertEqual(processed, [{"3": 180, "4": 240}, {"5": 300}])
+        with open(os.path.join(shard_dir, "shard-00000.claim")) as claim:
+            self.assertEqual(claim.read(), live_claim)
+
+
+
+    def testClaimRenewedDuringTakeOverIsKept(self):
+        """Test case: A claim that another run renews between the check and the take over is put back, and the shard is left to that run."""
+        os.makedirs("shards")
+        with open("shards/shard-00000.claim", 'w') as claim:
+            claim.write("other-host 1 dead-run\n")
+        os.utime("shards/shard-00000.claim", (0, 0))
+
+        def renewClaim(claim_path):
+            os.remove(claim_path)
+            with open(claim_path, 'w') as claim:
+                claim.write("other-host 2 new-run\n")
+            return True
+
+        with patch.object(reprovision_quota, "isClaimAbandoned", side_effect=renewClaim):
+            self.assertFalse(reprovision_quota.claimTargetShard("shards", 0))
+
+        self.assertEqual(os.listdir("shards"), ["shard-00000.claim"])
+        with open("shards/shard-00000.claim") as claim:
+            self.assertEqual(claim.read(), "other-host 2 new-run\n")
+
+
+
+    def testJournalSyncTouchesClaim(self):
+        """Test case: Every sync of a shard's journal touches its claim, so a shard that takes long isn't mistaken for an abandoned one."""
+        with open("shard.claim", 'w'):
+            pass
+        os.utime("shard.claim", (0, 0))
+
+        with patch.object(reprovision_quota, "journal_sync_every", 1):
+            journal = reprovision_quota.ProgressJournal("shard.journal", False, "shard.claim")
+            journal.record("1", "success")
+            journal.close()
+
+        self.assertFalse(reprovision_quota.isClaimAbandoned("shard.claim"))
+        self.assertGreater(os.path.getmtime("shard.claim"), time.time() - 60)
+
+
+
+    def testCrashedManualRunIsResumed(self):
+        """Test case: A shard left claimed by a manual run that died is taken over by the next one, which continues from its journal."""
+        target_list = reprovision_quota.scanTargetList(reprovision_quota.target_list_file)
+        shard_dir = reprovision_quota.getTargetShardDir(target_list)
+        os.makedirs(shard_dir)
+        finished = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"], capture_output=True, text=True, check=True)
+        with open(os.path.join(shard_dir, "shard-00000.claim"), 'w') as claim:
+            claim.write(f"{socket.gethostname()} {finished.stdout.strip()} other-run\n")
+        with open(os.path.join(shard_dir, "shard-00000.journal"), 'w') as journal:
+            journal.write("1,success\n")
+        resumed = []
+
+        with patch.object(reprovision_quota, "startReprovisionLoop", side_effect=lambda skip_get, resume, **kwargs: resumed.append(resume)):
+            reprovision_quota.startManualRun(argparse.Namespace(resume=False, skip_get=False, workers=1))
+
+        self.assertEqual(resumed, [True, False, False])
+        self.assertEqual(os.path.getsize(reprovision_quota.target_list_file), 0)
+
+
+
+    def testSkipGetFollowsCustomerFileAge(self):
+        """Test case: '--skip-get' is judged by the age of the customer file the CustomerData was read from, not by the age of the target list."""
+        with open("customer_file.xml", 'w'):
+            pass
+        skipped = []
+
+        with patch.dict(reprovision_quota.run_metrics, {"customer_file": "customer_file.xml"}), \
+                patch.object(reprovision_quota, "startReprovisionLoop", side_effect=lambda skip_get, resume, **kwargs: skipped.append(skip_get)):
+            reprovision_quota.writeManualTargetList()
+            reprovision_quota.startManualRun(argparse.Namespace(resume=False, skip_get=True, workers=1))
+            self.assertEqual(skipped, [True, True, True])
+
+            os.utime("customer_file.xml", (0, 0))
+            reprovision_quota.reprovision_targets.update(self.targets)
+            reprovision_quota.writeManualTargetList()
+            skipped.clear()
+            reprovision_quota.startManualRun(argparse.Namespace(resume=False, skip_get=True, workers=1))
+
+        self.assertEqual(skipped, [False, False, False])
+
+
+
+    def testManualRunWorksThroughShards(self):
+        """Test case: A manual run reprovisions each unclaimed shard in turn, and only clears the list once every shard is done."""
+        args = argparse.Namespace(resume=False, skip_get=True, workers=1)
+        target_list = reprovision_quota.scanTargetList(reprovision_quota.target_list_file)
+        shard_dir = reprovision_quota.getTargetShardDir(target_list)
+        os.makedirs(shard_dir)
+        reprovision_quota.claimTargetShard(shard_dir, 1)
+        processed = []
+
+        with patch.object(reprovision_quota, "startReprovisionLoop", side_effect=lambda *args, **kwargs: processed.append(dict(reprovision_quota.reprovision_targets))):
+            reprovision_quota.startManualRun(args)
+            self.assertEqual(processed, [{"1": 60, "2": 120}, {"5": 300}])
+            self.assertTrue(os.path.getsize(reprovision_quota.target_list_file))
+
+            reprovision_quota.markTargetShardDone(shard_dir, 1)
+            reprovision_quota.startManualRun(args)
+
+        self.assertEqual(len(processed), 2)
+        self.assertEqual(os.path.getsize(reprovision_quota.target_list_file), 0)
+        self.assertFalse(os.path.exists(shard_dir))
+
+
+
+class TestHistoryStore(unittest.TestCase):
+
+    def setUp(self):
+        history_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(history_dir.cleanup)
+        self.history_file = os.path.join(history_dir.name, "history.sqlite")
+        self.bundle_index = {784: 30000, 957: 120000}
+        for patcher in [patch.dict(reprovision_quota.reprovision_targets, clear=True),
+                        patch.dict(reprovision_quota.target_customer_data, clear=True),
+                        patch.object(reprovision_quota, "snapshot_file", os.path.join(history_dir.name, "snapshot.json"))]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+
+    def recordRun(self, customers, outcomes, started_at):
+        store = reprovision_quota.HistoryStore(self.history_file)
+        store.connection.execute("UPDATE runs SET started_at = ? WHERE run_id = ?", (started_at, store.run_id))
+        with patch.object(reprovision_quota, "history_store", store):
+            reprovision_quota.reprovision_targets.clear()
+            findMismatches(customers, self.bundle_index)
+            store.recordReprovisions(outcomes.items())
+        store.close("reprovisioned", "customers.xml", len(reprovision_quota.reprovision_targets))
+
+
+
+    def testHistoryQueries(self):
+        """Test case: Mismatches and reprovision outcomes of every run can be queried per customer, per bundle and for repeat offenders."""
+        customers = reprovision_quota.CustomerStore()
+        for customer in [CustomerRecord("171669", 7777, [957], "Zip:1"), CustomerRecord("171670", 0, [784, 80], "Zip:2"), CustomerRecord("171671", 120000, [957], "Zip:3")]:
+            customers.append(customer)
+        self.recordRun(customers, {"171669": "success", "171670": "put_failed"}, started_at=1000)
+        customers = reprovision_quota.CustomerStore()
+        for customer in [CustomerRecord("171669", 7777, [957], "Zip:1"), CustomerRecord("171672", 60, [], "Zip:4")]:
+            customers.append(customer)
+        self.recordRun(customers, {"171669": "success"}, started_at=2000)
+
+        connection = quota_history.connectHistory(self.history_file)
+        self.addCleanup(connection.close)
+        self.assertEqual(quota_history.getCustomerHistory(connection, "171669"),
+                         [(1, 1000, 7777, 120000, 957, "success"), (2, 2000, 7777, 120000, 957, "success")])
+        self.assertEqual(quota_history.getBundleCounts(connection), [(957, 2, 2), (784, 1, 1), (None, 1, 1)])
+        self.assertEqual(quota_history.getBundleCounts(connection, since=1500), [(957, 1, 1), (None, 1, 1)])
+        self.assertEqual(quota_history.getBundleCounts(connection, since=3000), [])
+        self.assertEqual(quota_history.getRepeatOffenders(connection), [("171669", 2, 1000, 2000)])
+        self.assertEqual(quota_history.getRepeatOffenders(connection, min_runs=1, since=1500), [("171669", 1, 2000, 2000), ("171672", 1, 2000, 2000)])
+        self.assertEqual([run[:4] for run in quota_history.getRecentRuns(connection)], [(2, 2000, "reprovisioned", 2), (1, 1000, "reprovisioned", 2)])
+
+
+
+class TestBundleCache(unittest.TestCase):
+
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        patcher = patch.object(reprovision_quota, "bundle_cache_file", os.path.join(cache_dir.name, "bundle_cache.json"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cursor = MagicMock()
+        self.cursor.fetchone.return_value = (3, "123456")
+        self.cursor.fetchall.return_value = [(647, 250*60), (784, 500*60), (957, 2000*60)]
+        self.connection = MagicMock()
+        self.connection.cursor.return_value = self.cursor
+
+
+
+    def testFreshCacheSkipsDB(self):
+        """Test case: Within the TTL the cached bundle data is used without connecting to the DB."""
+        with patch("mysql.connector.connect", return_value=self.connection) as mock_connect:
+            first = getNPVR_bundle_data()
+            second = getNPVR_bundle_data()
+
+        self.assertEqual(mock_connect.call_count, 1)
+        self.assertEqual(second, first)
+
+
+
+    def testUnchangedTableSkipsFullFetch(self):
+        """Test case: After the TTL, an unchanged checksum means the table is not fetched again."""
+        with patch("mysql.connector.connect", return_value=self.connection):
+            getNPVR_bundle_data()
+            with patch.object(reprovision_quota, "bundle_cache_ttl", 0):
+                bundle_data = getNPVR_bundle_data()
+
+        self.assertEqual(self.cursor.fetchall.call_count, 1)
+        self.assertEqual(bundle_data, [(647, 15000), (784, 30000), (957, 120000)])
+
+
+
+    def testFallbackWhenDBIsDown(self):
+        """Test case: The cached bundle data is used when the DB can't be reached."""
+        with patch("mysql.connector.connect", return_value=self.connection):
+            getNPVR_bundle_data()
+        with patch("mysql.connector.connect", side_effect=mysql.connector.Error("DB down")), \
+             patch.object(reprovision_quota, "bundle_cache_ttl", 0):
+            bundle_data = getNPVR_bundle_data()
+
+        self.assertEqual(bundle_data, [(647, 15000), (784, 30000), (957, 120000)])
+
+
+
+class TestRunReport(unittest.TestCase):
+
+    def testLatencyPercentiles(self):
+        """Test case: Latency percentiles are taken from the sorted latencies."""
+        latencies = [i / 1000 for i in range(100, 0, -1)]
+
+        percentiles = getPercentiles(latencies)
+
+        self.assertEqual(percentiles, {"count": 100, "p50": 0.051, "p90": 0.091, "p99": 0.1, "max": 0.1})
+
+
+
+    def testNoLatencies(self):
+        """Test case: A run without any requests only reports a count of zero."""
+        self.assertEqual(getPercentiles([]), {"count": 0})
+
+
+
+class ListHandler(logging.Handler):
+    """Collects the lines it is given, formatted, in place of the quota.log handler."""
+
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+
+
+
+class TestLogging(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = ListHandler()
+        for patcher in [patch.object(reprovision_quota, "hdlr", self.handler),
+                        patch.object(reprovision_quota, "log_format", "text"),
+                        patch.object(reprovision_quota, "customer_logging", "per-customer")]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(reprovision_quota.customer_logger.setLevel, reprovision_quota.customer_logger.level)
+        self.addCleanup(reprovision_quota.stopLogging)
+        reprovision_quota.stopLogging()
+
+
+
+    def configure(self, log_format, customer_logging):
+        reprovision_quota.configureLogging(argparse.Namespace(log_format=log_format, customer_logging=customer_logging))
+
+
+
+    def testRecordsAreWrittenByListener(self):
+        """Test case: The logger only queues records, and they reach the file handler by the time logging is stopped."""
+        self.configure("text", "per-customer")
+
+        self.assertNotIn(self.handler, reprovision_quota.logger.handlers)
+        reprovision_quota.logger.info("Queued line.")
+        reprovision_quota.stopLogging()
+
+        self.assertTrue(self.handler.lines[-1].endswith("INFO Queued line."))
+
+
+
+    def testJsonLines(self):
+        """Test case: In JSON format each line is an object, and lines about a customer carry its id."""
+        self.configure("json", "per-customer")
+
+        reprovision_quota.customer_logger.info("Attempt to reprovision customer %s succeeded.", 42, extra={"customer_id": 42})
+        reprovision_quota.stopLogging()
+
+        entry = json.loads(self.handler.lines[-1])
+        self.assertEqual(entry["message"], "Attempt to reprovision customer 42 succeeded.")
+        self.assertEqual(entry["customer_id"], "42")
+        self.assertEqual(entry["level"], "INFO")
+
+
+
+    def testSummaryLeavesOutCustomerLines(self):
+        """Test case: Summary logging drops informational lines about single customers, but keeps their errors and the run's own lines."""
+        self.configure("text", "summary")
+
+        reprovision_quota.customer_logger.info("Get request to prodis for customer 1 successful.")
+        reprovision_quota.customer_logger.error("Get request to Prodis for customer 2 failed.")
+        reprovision_quota.logger.info("Run line.")
+        reprovision_quota.stopLogging()
+
+        self.assertEqual([line.split(" ", 3)[-1] for line in self.handler.lines],
+                         ["Get request to Prodis for customer 2 failed.", "Run line."])
+
+
+
+    def testSummaryOfMismatches(self):
+        """Test case: Summary logging names a sample of the mismatched customers instead of every one."""
+        self.configure("text", "summary")
+
+        with patch.dict(reprovision_quota.reprovision_targets, {str(i): 0 for i in range(100)}, clear=True), \
+             patch.object(reprovision_quota, "abort_sample_size", 3):
+            reprovision_quota.logMismatchedCustomers(100)
+        reprovision_quota.stopLogging()
+
+        self.assertFalse(any("Mismatch detected" in line for line in self.handler.lines))
+        self.assertTrue(any(line.endswith("Example mismatched customers: 0, 1, 2.") for line in self.handler.lines))
+
+
+
+@unittest.skipUnless("fork" in multiprocessing.get_all_start_methods(), "Mocks only reach environment processes that are forked")
+class TestMultiEnvironment(unittest.TestCase):
+
+    def setUp(self):
+        work_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(work_dir.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(work_dir.name)
+        for name in ("prod", "preprod"):
+            os.makedirs(f"{name}_customerfiles")
+            with open(f"{name}_customerfiles/customers.xml", 'w') as customer_file:
+                customer_file.write('<?xml version="1.0" encoding="utf-8"?><Customers xmlns="urn:eventis:crm:2.0">'
+                                    '<Customer id="1"><NPVRQuota>0</NPVRQuota><CustomerData>Zip:1</CustomerData><SubscriptionProducts><SubscriptionProduct id="957" /></SubscriptionProducts></Customer>'
+                                    '<Customer id="2"><NPVRQuota>7777</NPVRQuota><CustomerData>Zip:2</CustomerData><SubscriptionProducts /></Customer>'
+                                    '<Customer id="3"><NPVRQuota>120000</NPVRQuota><CustomerData>Zip:3</CustomerData><SubscriptionProducts><SubscriptionProduct id="957" /></SubscriptionProducts></Customer>'
+                                    '</Customers>')
+            with open(f"{name}_customerfiles/LATEST", 'w') as pointer:
+                pointer.write("customers.xml")
+        response = MagicMock(status_code=200, content=b'<Customer xmlns="urn:eventis:crm:2.0"><CustomerData>Zip:1</CustomerData></Customer>')
+        for patcher in [patch.object(reprovision_quota, "getNPVR_bundle_data", return_value=[(957, 2000*60)]),
+                        patch.object(reprovision_quota, "getSession", return_value=MagicMock(get=MagicMock(return_value=response), put=MagicMock(return_value=response))),
+                        patch.object(reprovision_quota, "createNewTicket"),
+                        patch.object(reprovision_quota, "max_requests_per_second", 0),
+                        patch.dict(reprovision_quota.run_metrics, {"stages": {}, "counts": {}}, clear=True)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.args = argparse.Namespace(config="environments.json", manual=False, incremental=False, full_rescan=False, workers=1, resume=False, engine="python",
+                                       skip_get=False, early_abort=False, pipeline=False, dry_run=False, log_format="text",
+                                       customer_logging="per-customer")
+
+
+
+    def writeConfig(self, environments):
+        with open("environments.json", 'w') as config:
+            json.dump({"environments": environments}, config)
+
+
+
+    def testEnvironmentsRunSeparately(self):
+        """Test case: Each environment runs with its own settings and directory, and their reports are combined."""
+        self.writeConfig([{"name": "prod", "customer_file_dir": os.path.abspath("prod_customerfiles"), "cutoff": 5},
+                          {"name": "preprod", "customer_file_dir": os.path.abspath("preprod_customerfiles"), "cutoff": 1, "prodis_url": "preprod"}])
+
+        reprovision_quota.main(self.args)
+
+        environments = reprovision_quota.run_metrics["environments"]
+        self.assertEqual({name: report["outcome"] for name, report in environments.items()}, {"prod": "reprovisioned", "preprod": "aborted"})
+        self.assertEqual(reprovision_quota.run_metrics["counts"]["mismatches"], 4)
+        self.assertEqual(reprovision_quota.run_metrics["outcome"], "completed")
+        self.assertTrue(os.path.isfile("prod/quota_run_report.json"))
+        self.assertTrue(os.path.isfile("preprod/manual_reprovision_targets.csv"))
+        self.assertFalse(os.path.exists("prod/manual_reprovision_targets.csv"))
+
+
+
+    def testFailedEnvironmentFailsRun(self):
+        """Test case: An environment that fails does not stop the others, but the run exits with 1."""
+        self.writeConfig([{"name": "prod", "customer_file_dir": os.path.abspath("prod_customerfiles")},
+                          {"name": "broken", "customer_file_dir": os.path.abspath("missing_customerfiles")}])
+
+        with self.assertRaises(SystemExit) as exit_context:
+            reprovision_quota.main(self.args)
+
+        self.assertEqual(exit_context.exception.code, 1)
+        self.assertEqual(reprovision_quota.run_metrics["environments"]["prod"]["outcome"], "reprovisioned")
+        self.assertEqual(reprovision_quota.run_metrics["environments"]["broken"]["outcome"], "failed")
+
+
+
+    def testEachEnvironmentGetsItsOwnProcess(self):
+        """Test case: No process runs more than one environment, so nothing an environment changes can reach another."""
+        names = ["prod", "preprod", "lab", "staging"]
+        self.writeConfig([{"name": name, "customer_file_dir": os.path.abspath("prod_customerfiles")} for name in names])
+
+        with patch.object(reprovision_quota, "runEnvironment", side_effect=lambda environment, args: {"outcome": "reprovisioned", "pid": os.getpid()}):
+            reprovision_quota.main(self.args)
+
+        pids = [report["pid"] for report in reprovision_quota.run_metrics["environments"].values()]
+        self.assertEqual(len(set(pids)), len(names))
+        self.assertNotIn(os.getpid(), pids)
+
+
+
+    def testUnknownSettingIsRejected(self):
+        """Test case: A config file with a setting that isn't recognised is rejected before anything runs."""
+        self.writeConfig([{"name": "prod", "customer_dir": "/tmp"}])
+
+        with self.assertRaises(ValueError):
+            reprovision_quota.loadConfig("environments.json")
+
+
+
+class TestReprovisionEngine(unittest.TestCase):
+
+    def setUp(self):
+        # Customer 404 is unknown to Prodis, Prodis refuses to update customer 500, and the first get for customer 503 fails.
+        self.server = prodis_stub_server.startStubServer()
+        self.server.unknown_customers.add("404")
+        self.server.refused_customers.add("500")
+        self.server.transient_failures["503"] = 1
+        self.journal_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.journal_dir.cleanup)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        prodis_url = f"http://127.0.0.1:{self.server.server_address[1]}/customers"
+        for patcher in [patch.object(reprovision_quota, "prodisURL", prodis_url),
+                        patch.dict(reprovision_quota.reprovision_targets, clear=True),
+                        patch.dict(reprovision_quota.reprovision_results, clear=True),
+                        patch.dict(reprovision_quota.target_customer_data, clear=True),
+                        patch.object(reprovision_quota, "journal_file", os.path.join(self.journal_dir.name, "journal.log")),
+                        patch.dict(reprovision_quota.http_sessions, clear=True),
+                        patch.object(reprovision_quota, "http_retry_backoff", 0)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+
+    def testPerCustomerResults(self):
+        """Test case: Each target gets its own outcome, and failures don't stop the other targets."""
+        reprovision_quota.reprovision_targets.update({"171669": 120000, "171670": 30000, "404": 120000, "500": 120000})
+
+        startReprovisionLoop()
+
+        self.assertEqual(reprovision_quota.reprovision_results,
+                         {"171669": "success", "171670": "success", "404": "get_failed", "500": "put_failed"})
+        self.assertIn("<NPVRQuota>30000</NPVRQuota>", self.server.put_bodies["171670"])
+        self.assertIn("<CustomerData>Zip:171670</CustomerData>", self.server.put_bodies["171670"])
+
+
+
+    def testServerErrorsAreRetried(self):
+        """Test case: A 5xx response from Prodis is retried instead of failing the target."""
+        reprovision_quota.reprovision_targets.update({"503": 120000})
+
+        startReprovisionLoop()
+
+        self.assertEqual(reprovision_quota.reprovision_results, {"503": "success"})
+        self.assertEqual(self.server.get_counts["503"], 2)
+
+
+
+    def testSkipGetUsesFileCustomerData(self):
+        """Test case: With CustomerData from the file, Prodis is only asked for it after a failed put."""
+        reprovision_quota.reprovision_targets.update({"171669": 120000, "500": 120000})
+        reprovision_quota.target_customer_data.update({"171669": "Zip:from-file", "500": "Zip:from-file"})
+
+        startReprovisionLoop(skip_get=True)
+
+        self.assertEqual(reprovision_quota.reprovision_results, {"171669": "success", "500": "put_failed"})
+        self.assertNotIn("171669", self.server.get_counts)
+        self.assertEqual(self.server.get_counts["500"], 1)
+        self.assertIn("<CustomerData>Zip:from-file</CustomerData>", self.server.put_bodies["171669"])
+
+
+
+    def testResumeSkipsCompletedTargets(self):
+        """Test case: A resumed run only retries the targets that did not succeed before."""
+        reprovision_quota.reprovision_targets.update({"171669": 120000, "404": 120000})
+        startReprovisionLoop()
+        reprovision_quota.reprovision_results.clear()
+
+        startReprovisionLoop(resume=True)
+
+        self.assertEqual(reprovision_quota.reprovision_results, {"404": "get_failed"})
+        self.assertEqual(self.server.get_counts, {"171669": 1, "404": 2})
+
+
+
+    def runPipeline(self, customer_ids):
+        customers = "".join(f'<Customer id="{customer_id}"><NPVRQuota>7777</NPVRQuota><CustomerData>Zip:{customer_id}</CustomerData>'
+                            '<SubscriptionProducts><SubscriptionProduct id="957" /></SubscriptionProducts></Customer>' for customer_id in customer_ids)
+        customer_file = os.path.join(self.journal_dir.name, "customers.xml")
+        with open(customer_file, 'w') as output:
+            output.write(f'<?xml version="1.0" encoding="utf-8"?><Customers xmlns="urn:eventis:crm:2.0">{customers}</Customers>')
+        args = argparse.Namespace(workers=1, incremental=False, full_rescan=True, engine="python", skip_get=False, resume=False, early_abort=False)
+        with patch.object(reprovision_quota, "getLatestCustomerFile", return_value=customer_file), \
+             patch.object(reprovision_quota, "getNPVR_bundle_data", return_value=[(957, 2000*60)]), \
+             patch.object(reprovision_quota, "snapshot_file", os.path.join(self.journal_dir.name, "snapshot.json")), \
+             patch.object(reprovision_quota, "writeManualTargetList"), \
+             patch.object(reprovision_quota, "createNewTicket") as mock_ticket:
+            asyncio.run(reprovision_quota.runPipeline(args))
+        return mock_ticket
+
+
+
+    def testPipelineReusesPrefetchedCustomerData(self):
+        """Test case: A pipelined run fetches each target's CustomerData once, while searching, and reprovisions every target."""
+        with patch.object(reprovision_quota, "cutoff", 5):
+            mock_ticket = self.runPipeline(["171669", "171670", "404"])
+
+        mock_ticket.assert_not_called()
+        self.assertEqual(reprovision_quota.reprovision_results, {"171669": "success", "171670": "success", "404": "get_failed"})
+        self.assertEqual(self.server.get_counts, {"171669": 1, "171670": 1, "404": 2})
+
+
+
+    def testPipelineAbortsWithoutPuts(self):
+        """Test case: A pipelined run over the cutoff raises a ticket and never makes a put request."""
+        with patch.object(reprovision_quota, "cutoff", 2):
+            mock_ticket = self.runPipeline(["171669", "171670", "171671"])
+
+        mock_ticket.assert_called_once_with(3)
+        self.assertEqual(self.server.put_bodies, {})
+        self.assertLessEqual(sum(self.server.get_counts.values()), 2)
+
+
+
+    def testDryRunRecordsPayloads(self):
+        """Test case: A dry run records each put request it would have made, and a replay against the stub sends exactly the same bodies."""
+        reprovision_quota.reprovision_targets.update({"171669": 120000, "171670": 30000})
+        payload_journal_path = os.path.join(self.journal_dir.name, "payloads.jsonl.gz")
+        with patch.object(reprovision_quota, "payload_journal", reprovision_quota.PayloadJournal(payload_journal_path)):
+            startReprovisionLoop()
+            reprovision_quota.payload_journal.close()
+
+        self.assertEqual(self.server.put_bodies, {})
+        recorded = {entry["customer_id"]: entry["body"] for entry in reprovision_quota.readPayloadJournal(payload_journal_path)}
+        self.assertEqual(set(recorded), {"171669", "171670"})
+        self.assertIn("<NPVRQuota>30000</NPVRQuota>", recorded["171670"])
+
+        reprovision_quota.reprovision_targets.clear()
+        reprovision_quota.reprovision_results.clear()
+        stub = prodis_stub_server.startStubServer(error_rate=0.3, seed=4)
+        self.addCleanup(stub.server_close)
+        self.addCleanup(stub.shutdown)
+        with patch.object(reprovision_quota, "max_workers", 4), patch.object(reprovision_quota, "max_requests_per_second", 0), \
+             patch.object(reprovision_quota, "http_retries", 10):
+            results = prodis_stub_server.replayPayloadJournal(stub, payload_journal_path, workers=4, rate=0, retry_backoff=0)
+
+        self.assertEqual(results["outcomes"], {"success": 2})
+        self.assertEqual(results["identical_bodies"], 2)
+
+
+
+    def testRateLimiterSpacesCalls(self):
+        """Test case: The rate limiter never lets calls through faster than its limit."""
+        rate_limiter = RateLimiter(50)
+
+        start = time.monotonic()
+        for _ in range(6):
+            rate_limiter.wait()
+
+        self.assertGreaterEqual(time.monotonic() - start, 5 / 50)
+
+
+
 if __name__ == '__main__':
     unittest.main()